@@ -0,0 +1,276 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Time the steps of the report pipeline on a fixed synthetic dataset with the stub LLM server, save the results
+      as JSON and compare them with a baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+report_dir = os.path.join(repo_dir, 'report_generation')
+sys.path.extend([repo_dir, report_dir, os.path.join(repo_dir, 'data_retrieval')])
+from data_retrieval.yifangda_news.generate_synthetic_dataset import generate_x_dataset, generate_policy_reports, \
+    generate_news_documents
+import stub_llm_server
+
+benchmark_date = '2024-06-30'  # report date, must be a month end of the synthetic dataset
+dataset_start, dataset_end = '2016-01-31', '2024-12-31'
+num_news = 2000  # synthetic news articles in the FAISS database
+news_query = 'LPR 降息 货币政策'
+stub_latency = 0.05  # seconds of each stub model call, constant so that results only change with the code
+default_repeat = 3
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json')
+regression_threshold = 0.2  # relative slowdown of the median time above which a metric is a regression
+min_regression_seconds = 0.05  # slowdowns shorter than this are considered noise
+metric_thresholds = {}  # regression threshold of specific metrics, e.g. {'stage.news_analysis': 0.5}
+
+
+def create_workspace(root, seed=0):
+    """
+    Creates a copy of the repository data layout filled with synthetic data.
+
+    The report code reads its data with paths relative to `report_generation`, so running it from
+    `{root}/report_generation` reads only the synthetic files.
+
+    Args:
+        root (str): The workspace folder.
+        seed (int, optional): Seed of the synthetic data. Default is 0.
+
+    Returns:
+        str: The `report_generation` folder of the workspace.
+    """
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+    from langchain_community.vectorstores import FAISS
+    from news_index import build_news_index
+    from faiss_shards import build_faiss_shards
+    from segment_store import save_faiss_db
+
+    data_dir = os.path.join(root, 'data_retrieval', 'data')
+    generate_x_dataset(os.path.join(data_dir, 'XY_aug_feat.csv'), dataset_start, dataset_end, seed=seed)
+    generate_policy_reports(data_dir, dataset_start, dataset_end, seed=seed)
+    news = generate_news_documents(num_news, '2016-01-01', dataset_end, seed=seed)
+    news['date'] = pd.to_datetime(news['date'])  # the news ingestion stores the dates as timestamps
+    faiss_path = os.path.join(root, 'data_retrieval', 'faiss_db')
+    faiss_db = FAISS.from_texts(news['text'].tolist(), DeterministicFakeEmbedding(size=64),
+                                metadatas=news[['date', 'title', 'url', 'category']].to_dict('records'))
+    news_index = build_news_index(faiss_db)
+    save_faiss_db(faiss_path, faiss_db, indexes=[news_index, build_faiss_shards(faiss_db, news_index)])
+    fonts_dir = os.path.join(repo_dir, 'fonts')
+    if os.path.isdir(fonts_dir) and not os.path.exists(os.path.join(root, 'fonts')):
+        os.symlink(fonts_dir, os.path.join(root, 'fonts'))
+    workspace_report_dir = os.path.join(root, 'report_generation')
+    os.makedirs(os.path.join(workspace_report_dir, 'test_results'), exist_ok=True)
+    return workspace_report_dir
+
+
+@contextmanager
+def timer(timings, name):
+    """ Appends the duration of the block to `timings[name]`. """
+    start = time.perf_counter()
+    yield
+    timings[name].append(time.perf_counter() - start)
+
+
+def clear_caches():
+    """
+    Clears the in-process caches of the pipeline, so that each run loads the data, counts the tokens and loads the
+    news indexes again instead of timing cache hits.
+    """
+    import prompt_budget
+    import news_index
+    import faiss_shards
+    from data_retrieval import x_dataset_store
+
+    x_dataset_store._load_x_dataset.cache_clear()
+    prompt_budget.count_tokens.cache_clear()
+    news_index._indexes.clear()
+    faiss_shards._shards.clear()
+
+
+def summarize(timings):
+    """
+    Summarizes the durations of each metric.
+
+    Args:
+        timings (dict): Maps each metric to its durations in seconds.
+
+    Returns:
+        dict: Maps each metric to its median, min and max durations, the duration of the first run (which also
+            writes the on-disk caches, e.g. the Parquet copy of the dataset) and the duration of each run.
+    """
+    return {name: {'median': statistics.median(runs), 'min': min(runs), 'max': max(runs), 'first': runs[0],
+                   'runs': [round(run, 4) for run in runs]}
+            for name, runs in sorted(timings.items())}
+
+
+def run_benchmarks(workspace, date=benchmark_date, repeat=default_repeat, latency=stub_latency, seed=0):
+    """
+    Times data loading, feature calculation, news retrieval, each stage of `detailed_analysis` and the Word
+    export, with every model call answered by the stub LLM server. The in-process caches are cleared before each
+    run.
+
+    Args:
+        workspace (str): The workspace folder, created with synthetic data.
+        date (str, optional): The report date. Default is `benchmark_date`.
+        repeat (int, optional): Number of runs of each step. Default is `default_repeat`.
+        latency (float, optional): Seconds of each stub model call. Default is `stub_latency`.
+        seed (int, optional): Seed of the synthetic data. Default is 0.
+
+    Returns:
+        dict: The results, with the run settings under 'meta' and the metrics under 'metrics'.
+    """
+    workspace_report_dir = create_workspace(workspace, seed=seed)
+    # no delay between streamed chunks, each call only waits `latency`
+    server = stub_llm_server.start_server(port=0, distribution='constant', median=latency, seed=seed, chunk_delay=0)
+    os.environ['LLM_STUB_URL'] = f'http://{server.server_address[0]}:{server.server_address[1]}'
+    cwd = os.getcwd()
+    os.chdir(workspace_report_dir)
+    try:
+        # imported once the workspace is ready: models reads LLM_STUB_URL and the news analysis loads the FAISS
+        # database of the working directory
+        import llm_cache
+        import telemetry
+        import pipeline
+        import main
+        import main_utils
+        from faiss_db_utils import filter_by_similarity
+        from create_word import generate_word_doc
+        from generate_news_analysis import faiss_db, faiss_db_path
+
+        llm_cache.cache_enabled = False
+        telemetry.telemetry_path = os.path.join(workspace, 'llm_calls.jsonl')
+        main.resume = False
+        chatbot = main.get_model(model='efund', max_tokens=4096 * 4, model_name='gpt-4o')
+        chatbot_reflection = main.get_model(model='efund', max_tokens=4096 * 4, model_name='deepseek-r1')
+
+        timings = defaultdict(list)
+
+        def observe_stage(name, start, end, error):
+            if error is None:
+                timings[f'stage.{name}'].append(end - start)
+
+        pipeline.add_stage_observer(observe_stage)
+        try:
+            for i in range(repeat):
+                print(f'Benchmark run {i + 1}/{repeat}')
+                clear_caches()
+                with timer(timings, 'data_load'):
+                    df, df2, df3, data, target_col, features_col, year_col = main_utils.get_data()
+                with timer(timings, 'feature_calc'):
+                    main_utils.calculate_auxiliary_features(data, features_col + [target_col])
+                with timer(timings, 'retrieval'):
+                    end_date = datetime.strptime(date, '%Y-%m-%d')
+                    filter_by_similarity(query=news_query, start_date=end_date.replace(day=1, month=1),
+                                         end_date=end_date, top_kk=500, top_k=5, use_tfidf=True, faiss_db=faiss_db,
+                                         index_path=faiss_db_path)
+                shutil.rmtree(os.path.join(main.results_path, date), ignore_errors=True)
+                dataset = main.load_report_data()
+                with timer(timings, 'detailed_analysis'):
+                    main.detailed_analysis(chatbot, date, chatbot_reflection, dataset=dataset)
+                with timer(timings, 'word_export'):
+                    generate_word_doc(date)
+        finally:
+            pipeline.remove_stage_observer(observe_stage)
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+    return {
+        'meta': {
+            'date': date,
+            'repeat': repeat,
+            'latency': latency,
+            'seed': seed,
+            'model_calls': server.synthetic + server.replayed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+        },
+        'metrics': summarize(timings),
+    }
+
+
+def compare_results(results, baseline, threshold=regression_threshold, min_seconds=min_regression_seconds):
+    """
+    Compares the median times of the results with a baseline and prints them.
+
+    Args:
+        results (dict): The results returned by `run_benchmarks`.
+        baseline (dict): Results of a previous run.
+        threshold (float, optional): Relative slowdown above which a metric is a regression, overridden by
+            `metric_thresholds`. Default is `regression_threshold`.
+        min_seconds (float, optional): Slowdowns shorter than this are ignored. Default is `min_regression_seconds`.
+
+    Returns:
+        list: Names of the metrics slower than in the baseline.
+    """
+    regressions = []
+    print(f"{'metric':<45}{'baseline':>10}{'current':>10}{'change':>9}")
+    for name, metric in results['metrics'].items():
+        base = baseline['metrics'].get(name)
+        if base is None:
+            print(f"{name:<45}{'-':>10}{metric['median']:>10.3f}{'new':>9}")
+            continue
+        change = metric['median'] / base['median'] - 1 if base['median'] > 0 else 0.0
+        regressed = (change > metric_thresholds.get(name, threshold)
+                     and metric['median'] - base['median'] > min_seconds)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<45}{base['median']:>10.3f}{metric['median']:>10.3f}{change:>+9.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    if baseline.get('meta', {}).get('latency') != results['meta']['latency']:
+        print('Warning: baseline recorded with a different stub latency, model stages are not comparable.')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline on synthetic data.')
+    parser.add_argument('--date', default=benchmark_date, help='report date (month end of 2016-2024)')
+    parser.add_argument('--repeat', type=int, default=default_repeat, help='number of runs, the median is kept')
+    parser.add_argument('--latency', type=float, default=stub_latency, help='seconds of each stub model call')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--workspace', default=None, help='folder of the synthetic data (default: temporary)')
+    parser.add_argument('--output', default=results_path, help='JSON file of the results')
+    parser.add_argument('--baseline', default=baseline_path, help='JSON file of the baseline results')
+    parser.add_argument('--save_baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=regression_threshold,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix='report_benchmark_')
+    try:
+        results = run_benchmarks(workspace, date=args.date, repeat=args.repeat, latency=args.latency, seed=args.seed)
+    finally:
+        if args.workspace is None:
+            shutil.rmtree(workspace, ignore_errors=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    print(f'Results saved to {args.output}')
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_results(results, json.load(f), threshold=args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions: {regressions}')
+            sys.exit(1)
+    else:
+        print(f'No baseline found at {args.baseline}, run with --save_baseline to record one.')
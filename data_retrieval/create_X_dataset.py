@@ -9,12 +9,13 @@ Goal: Create X dataset
 """
 import pandas as pd
 from utils import *
+from x_dataset_store import save_x_dataset
 
 
 def merge_csv_files(file1, file2, m1_m2_data, ppi_data, output_file):
     """
     Merges multiple CSV files, processes missing values, adds composite indicators,
-    and saves the final dataset to a new CSV file.
+    and saves the final dataset to a new CSV file, plus a Parquet copy with the column names used in reports.
 
     Parameters:
     file1 (str): Path to the first CSV file.
@@ -60,6 +61,7 @@ def merge_csv_files(file1, file2, m1_m2_data, ppi_data, output_file):
 
     # Save to new CSV file
     merged_df.to_csv(output_file, encoding='utf-8')
+    save_x_dataset(merged_df, output_file)
     return merged_df
 
 
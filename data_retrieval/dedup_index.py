@@ -0,0 +1,291 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: URL and SimHash index of the FAISS docstore, used to drop the news already stored, or copied from another
+source with small edits, before they are added to the database
+"""
+import hashlib
+import json
+import os
+import re
+import unicodedata
+import numpy as np
+import pandas as pd
+from segment_store import load_indexes
+
+index_folder = 'dedup_index'  # folder of the FAISS database storing the index
+shingle_size = 3  # characters of the shingles hashed by SimHash
+max_hamming_distance = 3  # SimHashes differing by at most this number of bits are near duplicates
+min_simhash_length = 50  # shorter texts (e.g. titles) are duplicates only if their SimHash is equal
+max_short_days = 1  # and if they were published at most this number of days apart (e.g. recurring titles)
+index_version = 2  # saved indexes of another version are rebuilt
+
+_missing_day = np.iinfo(np.int64).min  # saved day of the documents without a valid date
+
+
+def normalize_text(text):
+    """ Keeps the lowercase letters and digits of a text, after Unicode normalization. """
+    return re.sub(r'[\W_]+', '', unicodedata.normalize('NFKC', str(text))).lower()
+
+
+def url_hash(url):
+    """
+    Computes the 64 bit hash of a URL.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        int: The hash, or None for a missing URL.
+    """
+    if not isinstance(url, str) or not url:
+        return None
+    return int.from_bytes(hashlib.blake2b(url.strip().encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _mix(x):
+    """ SplitMix64 finalizer, spreads the bits of the shingle codes over the 64 bits. """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def simhash(text):
+    """
+    Computes the 64 bit SimHash of the character shingles of a normalized text: texts sharing most of their
+    shingles have hashes differing by a few bits.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The SimHash.
+    """
+    codes = np.frombuffer(normalize_text(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return 0
+    n = max(len(codes) - shingle_size + 1, 1)
+    shingles = np.zeros(n, dtype=np.uint64)
+    for i in range(min(shingle_size, len(codes))):
+        shingles = shingles * np.uint64(0x100000001B3) + codes[i:i + n]  # wraps around 2 ** 64
+    hashes = np.unique(_mix(shingles))
+    bits = np.unpackbits(hashes.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    majority = 2 * bits.sum(axis=0, dtype=np.int64) > len(hashes)
+    return int(np.packbits(majority, bitorder='little').view('<u8')[0])
+
+
+def to_day(date):
+    """
+    Converts a publication date to a day number.
+
+    Args:
+        date (object): The date, e.g. a Timestamp or a string.
+
+    Returns:
+        int: Days since 1970-01-01, or None for a missing or invalid date.
+    """
+    date = pd.to_datetime(date, errors='coerce') if date is not None else None
+    if date is None or pd.isna(date):
+        return None
+    return int(date.value // 86400_000_000_000)
+
+
+class DedupIndex:
+    """
+    URL hashes and SimHashes of the documents of a FAISS database.
+
+    Near duplicates are found with `max_hamming_distance + 1` tables of bands of the SimHash: two hashes differing
+    by at most `max_hamming_distance` bits have at least one equal band. Short texts are duplicates only if their
+    SimHash is equal and they were published at most `max_short_days` apart.
+
+    Args:
+        url_hashes (array-like, optional): URL hash of each document, 0 if missing.
+        simhashes (array-like, optional): SimHash of each document.
+        short (array-like, optional): True for the documents shorter than `min_simhash_length`.
+        days (array-like, optional): Publication day of each document (see `to_day`), None if missing.
+    """
+
+    def __init__(self, url_hashes=(), simhashes=(), short=(), days=()):
+        self.url_hashes = [int(h) for h in url_hashes]
+        self.simhashes = [int(h) for h in simhashes]
+        self.short = [bool(s) for s in short]
+        self.days = [None if d is None or d == _missing_day else int(d) for d in days]
+        self.urls = set(self.url_hashes) - {0}
+        self.bands = [{} for _ in range(max_hamming_distance + 1)]
+        for row, value in enumerate(self.simhashes):
+            self._add_bands(row, value)
+
+    def __len__(self):
+        return len(self.simhashes)
+
+    def _band_keys(self, value):
+        width = 64 // len(self.bands)
+        return [(value >> (i * width)) & ((1 << width) - 1) for i in range(len(self.bands))]
+
+    def _add_bands(self, row, value):
+        for band, key in zip(self.bands, self._band_keys(value)):
+            band.setdefault(key, []).append(row)
+
+    def find_duplicate(self, url, text, date=None):
+        """
+        Checks whether a document is already in the index.
+
+        Args:
+            url (str): The URL of the document.
+            text (str): The text of the document.
+            date (object, optional): The publication date of the document, needed to match short texts.
+
+        Returns:
+            str: 'url' if the URL is already stored, 'text' if a near duplicate text is, None otherwise.
+        """
+        return self._find(*self._key(url, text, date))
+
+    @staticmethod
+    def _key(url, text, date):
+        return url_hash(url), simhash(text), len(normalize_text(text)) < min_simhash_length, to_day(date)
+
+    def _find(self, h, value, short, day):
+        if h in self.urls:
+            return 'url'
+        for band, key in zip(self.bands, self._band_keys(value)):
+            for row in band.get(key, ()):
+                if short or self.short[row]:
+                    # the same title published on other days is a different news (e.g. a daily market summary)
+                    if (value != self.simhashes[row] or day is None or self.days[row] is None
+                            or abs(day - self.days[row]) > max_short_days):
+                        continue
+                    return 'text'
+                if bin(self.simhashes[row] ^ value).count('1') <= max_hamming_distance:
+                    return 'text'
+        return None
+
+    def add(self, url, text, date=None):
+        """
+        Adds a document to the index.
+
+        Args:
+            url (str): The URL of the document.
+            text (str): The text of the document.
+            date (object, optional): The publication date of the document.
+        """
+        self._add(*self._key(url, text, date))
+
+    def _add(self, h, value, short, day):
+        h = h or 0
+        self.url_hashes.append(h)
+        self.simhashes.append(value)
+        self.short.append(short)
+        self.days.append(day)
+        if h:
+            self.urls.add(h)
+        self._add_bands(len(self.simhashes) - 1, value)
+
+    def filter(self, documents):
+        """
+        Drops the documents already in the index, or duplicated in the list, and adds the others to the index.
+
+        Args:
+            documents (list): Document objects with 'url' and 'date' metadata.
+
+        Returns:
+            list: The new documents.
+        """
+        new_documents = []
+        for doc in documents:
+            key = self._key(doc.metadata.get('url'), doc.page_content, doc.metadata.get('date'))
+            if self._find(*key) is None:
+                self._add(*key)
+                new_documents.append(doc)
+        return new_documents
+
+    def save(self, save_path):
+        """
+        Saves the index in the folder of a FAISS database.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+        """
+        folder = os.path.join(save_path, index_folder)
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'url_hashes.npy'), np.array(self.url_hashes, dtype=np.uint64))
+        np.save(os.path.join(folder, 'simhashes.npy'), np.array(self.simhashes, dtype=np.uint64))
+        np.save(os.path.join(folder, 'short.npy'), np.array(self.short, dtype=bool))
+        np.save(os.path.join(folder, 'days.npy'),
+                np.array([_missing_day if d is None else d for d in self.days], dtype=np.int64))
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_docs': len(self), 'shingle_size': shingle_size, 'version': index_version}, f)
+
+    @classmethod
+    def load(cls, save_path):
+        """
+        Loads the index saved in the folder of a FAISS database.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+
+        Returns:
+            DedupIndex: The index.
+        """
+        folder = os.path.join(save_path, index_folder)
+        return cls(np.load(os.path.join(folder, 'url_hashes.npy')), np.load(os.path.join(folder, 'simhashes.npy')),
+                   np.load(os.path.join(folder, 'short.npy')), np.load(os.path.join(folder, 'days.npy')))
+
+
+def build_dedup_index(documents):
+    """
+    Builds the index of a list of documents, duplicates included.
+
+    Args:
+        documents (iterable): Document objects with 'url' and 'date' metadata.
+
+    Returns:
+        DedupIndex: The index.
+    """
+    dedup_index = DedupIndex()
+    for doc in documents:
+        dedup_index.add(doc.metadata.get('url'), doc.page_content, doc.metadata.get('date'))
+    return dedup_index
+
+
+def load_dedup_index(save_path, n_docs):
+    """
+    Loads the dedup index saved with a FAISS database.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        n_docs (int): Number of documents of the database.
+
+    Returns:
+        DedupIndex: The index, or None if it is missing or does not match the number of documents.
+    """
+    def load(path):
+        with open(os.path.join(path, index_folder, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if (meta['n_docs'] == n_docs and meta.get('shingle_size') == shingle_size
+                and meta.get('version') == index_version):
+            return DedupIndex.load(path)
+        print(f'Dedup index of {save_path} is outdated, rebuilding it')
+        return None
+    return load_indexes(save_path, index_folder, load)
+
+
+def get_dedup_index(faiss_db, save_path=None):
+    """
+    Returns the dedup index of a FAISS database, built from the docstore if the saved one is missing or does not
+    match the size of the docstore.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        save_path (str, optional): Path of the FAISS database, where the index is saved.
+
+    Returns:
+        DedupIndex: The index.
+    """
+    dedup_index = load_dedup_index(save_path, len(faiss_db.docstore._dict)) if save_path is not None else None
+    if dedup_index is None:
+        dedup_index = build_dedup_index(faiss_db.docstore._dict.values())
+    return dedup_index
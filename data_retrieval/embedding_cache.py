@@ -0,0 +1,222 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Persistent cache of text embeddings, so that the FAISS database is rebuilt without embedding the same news
+      twice and an interrupted build resumes from the last embedded batch
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from tracing import span
+
+cache_folder = 'embedding_cache'  # one sub folder per embedding model
+cache_dtype = 'float32'  # 'float16' halves the cache size, with a precision loss negligible for similarity search
+embedding_batch_size = 256  # texts sent in each embedding call
+embedding_workers = 4  # embedding calls running at the same time
+
+vectors_file = 'vectors.bin'
+keys_file = 'keys.txt'
+meta_file = 'meta.json'
+
+
+def text_key(text):
+    """
+    Computes the cache key of a text, equal for texts differing only by Unicode form or whitespace.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: The SHA-256 hex digest of the normalized text.
+    """
+    normalized = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', str(text))).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Append-only store of embeddings: the vectors are rows of a memory-mapped binary file and the key of each row is
+    a line of a text file.
+
+    Rows are appended before their keys, so a row whose key was not written (e.g. the process was killed) is
+    ignored and overwritten by the next append.
+
+    Args:
+        folder (str): Folder of the cache files.
+        dtype (str, optional): Type of the stored values. Default is `cache_dtype`.
+    """
+
+    def __init__(self, folder, dtype=cache_dtype):
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.rows = {}
+        self._vectors = None
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        meta_path = os.path.join(folder, meta_file)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.dim, self.dtype = meta['dim'], np.dtype(meta['dtype'])
+            keys_path = os.path.join(folder, keys_file)
+            lines = []
+            if os.path.exists(keys_path):
+                with open(keys_path, 'r', encoding='utf-8') as f:
+                    lines = f.read().split('\n')
+            keys = lines[:-1]  # the last line is empty, or a key whose writing was interrupted
+            vectors_path = os.path.join(folder, vectors_file)
+            size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+            n_rows = min(size // (self.dim * self.dtype.itemsize), len(keys))
+            self.rows = {key: row for row, key in enumerate(keys[:n_rows])}
+            if n_rows < len(lines) - 1 or lines[-1:] not in ([], ['']):
+                with open(keys_path, 'w', encoding='utf-8') as f:
+                    f.write(''.join(f'{key}\n' for key in keys[:n_rows]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _open(self):
+        """ Maps the rows with a key, the mapping is reopened after each append. """
+        if self._vectors is None and self.rows:
+            self._vectors = np.memmap(os.path.join(self.folder, vectors_file), dtype=self.dtype, mode='r',
+                                      shape=(len(self.rows), self.dim))
+        return self._vectors
+
+    def get(self, keys):
+        """
+        Looks up the vectors of some keys.
+
+        Args:
+            keys (list): The keys.
+
+        Returns:
+            dict: Maps each key found to its vector, as a float32 array.
+        """
+        with self._lock:
+            rows = {key: self.rows[key] for key in set(keys) if key in self.rows}
+            if not rows:
+                return {}
+            vectors = self._open()
+            return {key: np.asarray(vectors[row], dtype=np.float32) for key, row in rows.items()}
+
+    def add(self, keys, vectors):
+        """
+        Appends vectors to the cache, keys already stored are skipped.
+
+        Args:
+            keys (list): The keys.
+            vectors (list): The vectors, in the same order.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(os.path.join(self.folder, meta_file), 'w', encoding='utf-8') as f:
+                    json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embeddings of size {vectors.shape[1]} cannot be stored in a cache of size "
+                                 f"{self.dim}: {self.folder}")
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+            with open(os.path.join(self.folder, vectors_file), 'r+b' if self.rows else 'wb') as f:
+                f.seek(len(self.rows) * self.dim * self.dtype.itemsize)
+                f.write(np.stack(list(new.values())).astype(self.dtype).tobytes())
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            with open(os.path.join(self.folder, keys_file), 'w' if not self.rows else 'a', encoding='utf-8') as f:
+                f.write(''.join(f'{key}\n' for key in new))
+            for key in new:
+                self.rows[key] = len(self.rows)
+            self._vectors = None
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding model computing only the embeddings missing from an `EmbeddingCache`.
+
+    Identical texts are embedded once, missing texts are embedded in batches by concurrent calls and every batch is
+    stored as soon as it is returned, so an interrupted run loses at most the batches in progress.
+
+    Args:
+        embeddings (Embeddings): The embedding model.
+        folder (str): Folder of the cache, one per embedding model.
+        batch_size (int, optional): Texts of each embedding call. Default is `embedding_batch_size`.
+        max_workers (int, optional): Embedding calls running at the same time. Default is `embedding_workers`.
+        dtype (str, optional): Type of the stored values of a new cache. Default is `cache_dtype`.
+    """
+
+    def __init__(self, embeddings, folder, batch_size=None, max_workers=None, dtype=cache_dtype):
+        self.embeddings = embeddings
+        self.cache = EmbeddingCache(folder, dtype=dtype)
+        self.batch_size = batch_size or embedding_batch_size
+        self.max_workers = max_workers or embedding_workers
+
+    def _embed_batch(self, texts):
+        with span('embed_batch', category='faiss', texts=len(texts)):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_documents(self, texts):
+        """
+        Embeds texts, reading the cached ones from disk.
+
+        Args:
+            texts (list): The texts.
+
+        Returns:
+            list: The embedding of each text.
+        """
+        keys = [text_key(text) for text in texts]
+        found = self.cache.get(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            print(f'Embedding {len(missing)} texts, {len(texts) - len(missing)} found in {self.cache.folder}')
+            missing_keys = list(missing)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self._embed_batch, [missing[key] for key in batch]): batch
+                           for batch in batches}
+                errors = []
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    try:
+                        vectors = future.result()
+                    except Exception as e:
+                        # keep storing the other batches, the next run only embeds the failed ones
+                        errors.append(e)
+                        continue
+                    self.cache.add(batch, vectors)
+                    found.update(zip(batch, np.asarray(vectors, dtype=np.float32)))
+            if errors:
+                raise errors[0]
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        """
+        Embeds a search query, queries are not cached.
+
+        Args:
+            text (str): The query.
+
+        Returns:
+            list: The embedding.
+        """
+        return self.embeddings.embed_query(text)
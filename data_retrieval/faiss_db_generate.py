@@ -9,19 +9,26 @@ Goal: Generate FAISS database from news articles
 """
 import os
 from keys import openai_key
-from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import FakeEmbeddings
 import pandas as pd
 from collections import defaultdict
 from __init__ import fake_embedding_size
+from news_index import build_news_index
+from news_ingest import load_news_documents
+from dedup_index import DedupIndex
+from faiss_shards import build_faiss_shards
+from segment_store import save_faiss_db
+from embedding_cache import CachedEmbeddings, cache_folder as embedding_cache_folder
+from tracing import span
 
 news_files = ['news_xinhua_政策执行.csv', 'news_xinhua_银行.csv', 'news_xinhua_LPR.csv', 'news_xinhua_债券.csv',
               'news_xinhua_利率.csv', 'news_xinhua_general.csv', 'news_wind.csv', 'news_eastmoney.csv']
 yifangda_news_files = ['yifangda_news/通联宏观类舆情的表.csv']
 
 
+@span('create_faiss_db', category='faiss')
 def create_faiss_db(data_path='data', no_embeddings=False, save_path="faiss_db", add_yifangda_news=False):
     """
     Creates a FAISS database from news article CSV files.
@@ -36,63 +43,33 @@ def create_faiss_db(data_path='data', no_embeddings=False, save_path="faiss_db",
     list: A list of Document objects processed from the input files.
     """
     if not no_embeddings:
-        embedding_model = OpenAIEmbeddings(model="text-embedding-ada-002", openai_key=openai_key)
+        # embeddings already computed by a previous build are read from the cache
+        embedding_model = CachedEmbeddings(OpenAIEmbeddings(model="text-embedding-ada-002", openai_key=openai_key),
+                                           os.path.join(embedding_cache_folder, "text-embedding-ada-002"))
     else:
         embedding_model = FakeEmbeddings(size=fake_embedding_size)
+    # the same news is often published by several sources, only its first copy is kept
+    dedup_index = DedupIndex()
     all_documents = []
-    for file in news_files:
-        file_path = os.path.join(data_path, file)
-        if not os.path.exists(file_path):
-            print(f"Skipping missing file: {file_path}")
-            continue
-        print(f"Processing file: {file_path}")
-        df = pd.read_csv(file_path, index_col=0)
-        for index, row in df.iterrows():
-            text = row['text']
-            date = pd.to_datetime(index, errors='coerce')
-            if pd.isna(pd.to_datetime(date, errors='coerce')):
-                # print(f"Skipping row with invalid date: {index}")
-                continue
-            url = row['url']
-            category = file.split('.csv')[0]
-            doc = Document(
-                page_content=text,
-                metadata={"date": date, "url": url, "category": category}
-            )
-            all_documents.append(doc)
-    if add_yifangda_news:
-        for file_path in yifangda_news_files:
-            if not os.path.exists(file_path):
-                print(f"Skipping missing file: {file_path}")
-                continue
-            print(f"Processing file: {file_path}")
-            df = pd.read_csv(file_path, index_col=0)
-            df['news_publish_time'] = pd.to_datetime(df['news_publish_time'])
-            df.set_index('news_publish_time', inplace=True)
-            for index, row in df.iterrows():
-                text = row['news_title']
-                date = pd.to_datetime(index, errors='coerce')
-                if pd.isna(pd.to_datetime(date, errors='coerce')):
-                    # print(f"Skipping row with invalid date: {index}")
-                    continue
-                url = row['news_url']
-                s3_url = row['s3_url']
-                category = file_path.split('.csv')[0]
-                doc = Document(
-                    page_content=text,
-                    metadata={"date": date, "url": url, "category": category, "s3_url": s3_url}
-                )
-                all_documents.append(doc)
+    n_documents = 0
+    for documents in load_news_documents(data_path, news_files,
+                                         yifangda_news_files if add_yifangda_news else (), verbose=False):
+        n_documents += len(documents)
+        all_documents.extend(dedup_index.filter(documents))
+    print(f'Dropped {n_documents - len(all_documents)} duplicated docs')
 
     if all_documents:
         print('Generating FAISS database...')
-        faiss_db = FAISS.from_documents(all_documents, embedding_model)
+        with span('faiss_embed', category='faiss', documents=len(all_documents)):
+            faiss_db = FAISS.from_documents(all_documents, embedding_model)
         print("FAISS database generated")
     else:
         print("No documents found. FAISS database not created.")
         return None
 
-    faiss_db.save_local(save_path)
+    with span('faiss_save', category='faiss'):
+        news_index = build_news_index(faiss_db)
+        save_faiss_db(save_path, faiss_db, indexes=[news_index, build_faiss_shards(faiss_db, news_index), dedup_index])
     print(f"FAISS database saved to {save_path}")
     return all_documents
 
@@ -9,15 +9,50 @@ Goal: Update FAISS database from news articles
 """
 import os
 from keys import openai_key
-from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import FakeEmbeddings
-import pandas as pd
 from faiss_db_generate import news_files, yifangda_news_files
 from __init__ import fake_embedding_size
+from news_index import NewsIndex, build_news_index, update_news_index, index_folder as news_index_folder
+from news_ingest import load_news_documents
+from dedup_index import get_dedup_index, load_dedup_index
+from faiss_shards import build_faiss_shards, load_faiss_shards, update_faiss_shards
+from segment_store import (load_faiss_db, append_segment, compact_in_background, read_manifest, load_indexes,
+                           write_lock)
+from embedding_cache import CachedEmbeddings, cache_folder as embedding_cache_folder
+from tracing import span
 
 
+def load_saved_indexes(save_path):
+    """
+    Loads the news index, shards and dedup index saved with a FAISS database, to update them without loading the
+    database.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+
+    Returns:
+        tuple: (NewsIndex, FaissShards, DedupIndex), or None if one of them is missing or does not match the number
+            of documents of the manifest.
+    """
+    manifest = read_manifest(save_path)
+    if manifest is None or manifest['n_docs'] is None:
+        return None
+    n_docs = manifest['n_docs']
+    news_index = load_indexes(save_path, news_index_folder, NewsIndex.load)
+    if news_index is None or news_index.n_docs != n_docs or news_index.tfidf is None:
+        return None
+    faiss_shards = load_faiss_shards(save_path)
+    if faiss_shards is None or faiss_shards.n_docs != n_docs:
+        return None
+    dedup_index = load_dedup_index(save_path, n_docs)
+    if dedup_index is None:
+        return None
+    return news_index, faiss_shards, dedup_index
+
+
+@span('update_faiss_db', category='faiss')
 def update_faiss_db(data_path='data', no_embeddings=False, save_path="faiss_db", add_yifangda_news=False):
     """
     Updates an existing FAISS database with new documents from CSV files.
@@ -32,87 +67,56 @@ def update_faiss_db(data_path='data', no_embeddings=False, save_path="faiss_db",
     list: A list of newly added Document objects.
     """
     if not no_embeddings:
-        embedding_model = OpenAIEmbeddings(model="text-embedding-ada-002", openai_key=openai_key)
+        # embeddings already computed by a previous build are read from the cache
+        embedding_model = CachedEmbeddings(OpenAIEmbeddings(model="text-embedding-ada-002", openai_key=openai_key),
+                                           os.path.join(embedding_cache_folder, "text-embedding-ada-002"))
     else:
         embedding_model = FakeEmbeddings(size=fake_embedding_size)
-    faiss_db = FAISS.load_local(save_path, embedding_model, allow_dangerous_deserialization=True)
-    print("FAISS database loaded and ready to be updated")
-    # Extract existing metadata (e.g., URLs) from the FAISS database
-    existing_metadata = set(
-        doc.metadata["url"] for doc in faiss_db.docstore._dict.values()
-    )
-    all_documents = []
-    for file in news_files:
-        file_path = os.path.join(data_path, file)
-        if not os.path.exists(file_path):
-            print(f"Skipping missing file: {file_path}")
-            continue
-        print(f"Processing file: {file_path}")
-        df = pd.read_csv(file_path, index_col=0)
-        added_docs = 0
-        for index, row in df.iterrows():
-            text = row['text']
-            date = pd.to_datetime(index, errors='coerce')
-            if pd.isna(date):
-                # print(f"Skipping row with invalid date: {index}")
-                continue
-            url = row['url']
-            category = file.split('.csv')[0]
-
-            # Skip the document if it already exists in the FAISS database
-            if url in existing_metadata:
-                # print(f"Skipping duplicate document with URL: {url}")
-                continue
-
-            doc = Document(
-                page_content=text,
-                metadata={"date": date, "url": url, "category": category}
-            )
-            all_documents.append(doc)
-            added_docs += 1
-        print(f'Added new {added_docs} doc')
-
-    if add_yifangda_news:
-        for file_path in yifangda_news_files:
-            if not os.path.exists(file_path):
-                print(f"Skipping missing file: {file_path}")
-                continue
-            print(f"Processing file: {file_path}")
-            df = pd.read_csv(file_path)
-            df['news_publish_time'] = pd.to_datetime(df['news_publish_time'])
-            df.set_index('news_publish_time', inplace=True)
-            added_docs = 0
-            category = ''
-            for index, row in df.iterrows():
-                text = row['news_title']
-                date = pd.to_datetime(index, errors='coerce')
-                if pd.isna(pd.to_datetime(date, errors='coerce')):
-                    # print(f"Skipping row with invalid date: {index}")
-                    continue
-                url = row['news_url']
-                s3_url = row['s3_url']
-                category = file_path.split('.csv')[0]
-                # Skip the document if it already exists in the FAISS database
-                if url in existing_metadata:
-                    # print(f"Skipping duplicate document with URL: {url}")
-                    continue
-                doc = Document(
-                    page_content=text,
-                    metadata={"date": date, "url": url, "category": category, "s3_url": s3_url}
-                )
-                all_documents.append(doc)
-                added_docs += 1
-            if added_docs > 0:
-                print(f'Added new {added_docs} doc from {category}')
+    # the whole update holds the lock, so another process cannot add the same documents meanwhile
+    with write_lock(save_path):
+        saved_indexes = load_saved_indexes(save_path)
+        faiss_db = None
+        if saved_indexes is not None:
+            news_index, faiss_shards, dedup_index = saved_indexes
+            print("FAISS database indexes loaded and ready to be updated")
+        else:
+            faiss_db = load_faiss_db(save_path, embedding_model)
+            print("FAISS database loaded and ready to be updated, its indexes are rebuilt")
+            # URLs and SimHashes of the stored documents
+            dedup_index = get_dedup_index(faiss_db, save_path)
+        all_documents = []
+        for documents in load_news_documents(data_path, news_files, yifangda_news_files if add_yifangda_news else (),
+                                             verbose=False):
+            # news already stored or copied from another source are skipped
+            new_documents = dedup_index.filter(documents)
+            if new_documents:
+                print(f'Added new {len(new_documents)} doc from {new_documents[0].metadata["category"]}')
+            all_documents.extend(new_documents)
 
-    # Add new documents to the existing FAISS database
+        # Add new documents to the existing FAISS database
+        if all_documents:
+            print('Adding new documents to FAISS database...')
+            with span('faiss_embed', category='faiss', documents=len(all_documents)):
+                new_db = FAISS.from_documents(all_documents, embedding_model)
+            print(f'Added in total {len(all_documents)} new docs')
+            print("FAISS database updated")
+            with span('faiss_save', category='faiss'):
+                if faiss_db is None:
+                    # the new documents are inserted in the saved indexes, only the shards of their months are
+                    # rebuilt
+                    news_index = update_news_index(news_index, new_db)
+                    faiss_shards = update_faiss_shards(faiss_shards, news_index, new_db)
+                else:
+                    faiss_db.merge_from(new_db)
+                    news_index = build_news_index(faiss_db)
+                    faiss_shards = build_faiss_shards(faiss_db, news_index, previous=load_faiss_shards(save_path))
+                # only the new documents are written, as a new segment of the database, and the indexes are
+                # written in a new folder switched with the segment, so readers never see indexes of another version
+                append_segment(save_path, new_db, indexes=[news_index, faiss_shards, dedup_index])
+            print(f"Updated FAISS database saved to {save_path}")
     if all_documents:
-        print('Adding new documents to FAISS database...')
-        faiss_db.add_documents(all_documents)
-        print(f'Added in total {len(all_documents)} new docs')
-        print("FAISS database updated")
-        faiss_db.save_local(save_path)
-        print(f"Updated FAISS database saved to {save_path}")
+        # merge the segments once there are too many, while the next steps run
+        compact_in_background(save_path, embedding_model)
     else:
         print("No new documents to add to the FAISS database.")
 
@@ -7,14 +7,15 @@ E-mail: davide97ls@gmail.com
 
 Goal: Do search on FAISS database
 """
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import FakeEmbeddings
 from typing import Optional, List
 from langchain.schema import Document
-from yifangda_news.retrieve_s3_news import download_news_from_s3
+from yifangda_news.retrieve_s3_news import fetch_news_bodies
+from news_index import get_news_index
+from faiss_shards import similarity_search_by_date
+from segment_store import load_faiss_db
 
 
 def filter_by_date(docs, start_date, end_date):
@@ -41,8 +42,28 @@ def filter_by_date(docs, start_date, end_date):
     return filtered_by_date
 
 
+def get_docs_by_date(faiss_db, start_date=None, end_date=None, index_path=None):
+    """
+    Retrieves the documents of a date range using the date index of the FAISS database.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        start_date (datetime): Start of the date range (inclusive). If None, all the documents are returned.
+        end_date (datetime): End of the date range (exclusive). If None, all the documents are returned.
+        index_path (str): Path of the FAISS database, where its date index is saved.
+
+    Returns:
+        list: List of documents in the date range, in docstore order.
+    """
+    docstore = faiss_db.docstore._dict
+    if not (start_date and end_date):
+        return list(docstore.values())
+    news_index = get_news_index(faiss_db, index_path)
+    return [docstore[i] for i in news_index.get_ids(news_index.window(start_date, end_date))]
+
+
 def filter_by_similarity(query=None, start_date=None, end_date=None, top_kk=50, top_k=10, use_tfidf=True,
-                         faiss_db=None, prod_env=False):
+                         faiss_db=None, prod_env=False, index_path=None):
     """
     Filter documents first by similarity (using FAISS or TF-IDF) and then by date.
 
@@ -52,55 +73,47 @@ def filter_by_similarity(query=None, start_date=None, end_date=None, top_kk=50,
     - end_date (datetime): End date for date filtering. If None, only similarity filtering is performed.
     - top_kk (int): Number of top documents to retain after similarity filtering.
     - top_k (int): Number of top documents to retain after date filtering.
-    - use_tfidf (bool): Whether to use TF-IDF instead of FAISS for similarity search.
+    - use_tfidf (bool): Whether to use TF-IDF instead of FAISS for similarity search. TF-IDF vectors are read from
+      the news index, only documents with a valid date are searched.
     - prod_env (bool): if True use prod env to retrieve news.
+    - index_path (str): Path of the FAISS database, where its date index and shards are saved. If None they are
+      built in memory on first use.
 
     Returns:
     - List[Document]: Filtered documents.
     """
     assert faiss_db
     print('Loading news from FAISS db...')
-    all_docs = list(faiss_db.docstore._dict.values())  # Retrieve all stored documents
-
-    # Pre-Filter by date (if date range is provided)
-    if start_date and end_date:
-        all_docs = filter_by_date(all_docs, start_date, end_date)
-
     # Step 1: Filter by similarity
     if query:
         if use_tfidf:
-            # Extract text content from documents
-            doc_texts = [doc.page_content for doc in all_docs]
-
-            # Compute TF-IDF similarity
-            vectorizer = TfidfVectorizer()
-            doc_vectors = vectorizer.fit_transform(doc_texts)
-            query_vector = vectorizer.transform([query])
-
-            # Compute cosine similarity
-            similarities = cosine_similarity(query_vector, doc_vectors).flatten()
+            # Compute TF-IDF cosine similarity with the documents of the date range, using the saved vectors
+            news_index = get_news_index(faiss_db, index_path, tfidf=True)
+            rows = news_index.window(start_date, end_date) if start_date and end_date else slice(None)
+            similarities = news_index.tfidf.similarity(query, rows)
             top_indices = similarities.argsort()[-top_kk:][::-1]  # Get top_kk most relevant
 
-            similarity_results = [all_docs[i] for i in top_indices]
+            ids = news_index.ids[rows]
+            similarity_results = [faiss_db.docstore._dict[ids[i]] for i in top_indices]
+        elif start_date and end_date:
+            # FAISS similarity search in the monthly shards of the date range
+            similarity_results = similarity_search_by_date(faiss_db, query, top_kk, start_date, end_date, index_path)
         else:
             # FAISS similarity search
             similarity_results = faiss_db.similarity_search(query, k=top_kk)
     else:
         # If no query is provided, return all documents
-        similarity_results = all_docs
-
-    # Step 2: Re-Filter by date (if date range is provided)
-    if start_date and end_date:
-        similarity_results = filter_by_date(similarity_results, start_date, end_date)
+        similarity_results = get_docs_by_date(faiss_db, start_date, end_date, index_path)
 
+    # Step 2: Keep the top_k documents, already in the date range
     results = similarity_results[:top_k]
 
-    for doc in results:
-        if doc.metadata.get('s3_url', None):
-            news_code = doc.metadata['s3_url'].split('/')[-1]
-            content = download_news_from_s3(news_code, prod_env=prod_env)
-            if content is None or content != "No news content found":
-                doc.page_content = doc.metadata.get("title", "")
+    # Replace the title of Yifangda news with their body, downloaded in parallel
+    news_codes = [doc.metadata['s3_url'].split('/')[-1] if doc.metadata.get('s3_url', None) else None
+                  for doc in results]
+    contents = fetch_news_bodies([code for code in news_codes if code], prod_env=prod_env)
+    results = [doc.model_copy(update={'page_content': contents[code]}) if code and contents[code] else doc
+               for doc, code in zip(results, news_codes)]
 
     return results
 
@@ -108,7 +121,7 @@ def filter_by_similarity(query=None, start_date=None, end_date=None, top_kk=50,
 if __name__ == "__main__":
     save_path = "faiss_db_test"
     embedding_model = FakeEmbeddings(size=10)
-    faiss_db = FAISS.load_local(save_path, embedding_model, allow_dangerous_deserialization=True)
+    faiss_db = load_faiss_db(save_path, embedding_model)
     start_date = pd.to_datetime("2024-01-01")
     end_date = pd.to_datetime("2024-12-31")
     filtered_docs = filter_by_similarity(query="LPR", start_date=start_date, end_date=end_date, top_k=3, use_tfidf=True,
@@ -0,0 +1,324 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Monthly shards of the FAISS database vectors, so that a similarity search on a period only searches the
+shards of that period and returns the top k documents of the period
+"""
+import json
+import os
+import threading
+import weakref
+import faiss
+import numpy as np
+import pandas as pd
+from news_index import get_news_index
+from segment_store import load_indexes
+
+shards_folder = 'shards'  # folder of the FAISS database storing the shards
+shard_freq = 'M'  # period of each shard, 'M' monthly or 'Q' quarterly
+
+_shards = weakref.WeakKeyDictionary()  # shards of each loaded FAISS database
+
+
+class FaissShards:
+    """
+    Vectors of the documents of a FAISS database split by period, each period in its own flat FAISS index.
+
+    The documents are sorted by date, so each shard holds a contiguous range of rows and the documents of a date
+    range are a contiguous range of rows too.
+
+    Args:
+        periods (list): Name of the period of each shard (e.g. '2024-01').
+        bounds (np.ndarray): First row of each shard, followed by the number of rows.
+        dates (np.ndarray): Sorted datetime64 dates of the documents.
+        ids (np.ndarray): Docstore ids of the documents, aligned with `dates`.
+        n_docs (int): Number of documents of the docstore when the shards were built.
+        indexes (list, optional): FAISS index of each shard, None for the shards read from disk. Default is None,
+            indexes are read from `folder`.
+        folder (str, optional): Folder of the saved shards.
+        sources (dict, optional): Maps the period of some shards to the file of an identical saved shard, read
+            instead of `folder` and hard linked when the shards are saved.
+        freq (str, optional): Period of each shard. Default is `shard_freq`.
+    """
+
+    def __init__(self, periods, bounds, dates, ids, n_docs, indexes=None, folder=None, sources=None, freq=None):
+        self.periods = list(periods)
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+        self.dates = dates
+        self.ids = ids
+        self.n_docs = n_docs
+        self.folder = folder
+        self.sources = dict(sources or {})
+        self.freq = freq or shard_freq
+        self._indexes = {period: index for period, index in zip(self.periods, indexes or ()) if index is not None}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.periods)
+
+    def get_index(self, period):
+        """
+        Returns the FAISS index of a shard, memory mapping it from disk on first use.
+
+        Args:
+            period (str): The period of the shard.
+
+        Returns:
+            faiss.Index: The index.
+        """
+        with self._lock:
+            if period not in self._indexes:
+                self._indexes[period] = faiss.read_index(self.get_path(period),
+                                                         faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            return self._indexes[period]
+
+    def get_path(self, period):
+        """ Returns the file of a saved shard. """
+        return self.sources.get(period) or os.path.join(self.folder, f'{period}.faiss')
+
+    def search(self, vector, k, start_date=None, end_date=None):
+        """
+        Searches the nearest documents of a date range in the shards overlapping it, then merges the results.
+
+        Args:
+            vector (np.ndarray): The query vector.
+            k (int): Number of documents returned.
+            start_date (datetime, optional): Start of the date range (inclusive). If None, all shards are searched.
+            end_date (datetime, optional): End of the date range (exclusive). If None, all shards are searched.
+
+        Returns:
+            list: (docstore id, score) of the nearest documents, the best first.
+        """
+        start, end = 0, int(self.bounds[-1])
+        if start_date is not None and end_date is not None:
+            start = int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date), 'ns'), side='left'))
+            end = int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end_date), 'ns'), side='left'))
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        scores, rows = [], []
+        larger_is_better = None
+        first = max(int(np.searchsorted(self.bounds, start, side='right')) - 1, 0)
+        for shard in range(first, len(self.periods)):
+            lo, hi = max(start, self.bounds[shard]), min(end, self.bounds[shard + 1])
+            if lo >= end:
+                break
+            if lo >= hi:
+                continue
+            index = self.get_index(self.periods[shard])
+            larger_is_better = index.metric_type == faiss.METRIC_INNER_PRODUCT
+            params = None
+            if hi - lo < index.ntotal:
+                # only the rows of the date range, for the shards at the edges of the range
+                params = faiss.SearchParameters(
+                    sel=faiss.IDSelectorRange(int(lo - self.bounds[shard]), int(hi - self.bounds[shard])))
+            distances, indices = index.search(vector, int(min(k, hi - lo)), params=params)
+            valid = indices[0] >= 0
+            scores.append(distances[0][valid])
+            rows.append(indices[0][valid] + self.bounds[shard])
+        if not scores:
+            return []
+        scores, rows = np.concatenate(scores), np.concatenate(rows)
+        order = np.argsort(-scores if larger_is_better else scores, kind='stable')[:k]
+        return [(str(self.ids[rows[i]]), float(scores[i])) for i in order]
+
+    def save(self, save_path):
+        """
+        Saves the shards in the folder of a FAISS database.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+        """
+        folder = os.path.join(save_path, shards_folder)
+        os.makedirs(folder, exist_ok=True)
+        for period in self.periods:
+            path = os.path.join(folder, f'{period}.faiss')
+            if period in self.sources:
+                try:
+                    # the shard did not change since it was saved, share its file instead of writing it again
+                    os.link(self.sources[period], path)
+                    continue
+                except OSError:
+                    pass
+            faiss.write_index(self.get_index(period), path)
+        np.save(os.path.join(folder, 'dates.npy'), self.dates)
+        np.save(os.path.join(folder, 'ids.npy'), self.ids)
+        np.save(os.path.join(folder, 'bounds.npy'), self.bounds)
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_docs': self.n_docs, 'periods': self.periods, 'freq': self.freq}, f)
+
+    @classmethod
+    def load(cls, save_path):
+        """
+        Loads the shards saved in the folder of a FAISS database, the shard indexes are read on first use.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+
+        Returns:
+            FaissShards: The shards.
+        """
+        folder = os.path.join(save_path, shards_folder)
+        with open(os.path.join(folder, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(meta['periods'], np.load(os.path.join(folder, 'bounds.npy')),
+                   np.load(os.path.join(folder, 'dates.npy'), mmap_mode='r'),
+                   np.load(os.path.join(folder, 'ids.npy'), mmap_mode='r'), meta['n_docs'], folder=folder,
+                   freq=meta.get('freq'))
+
+
+def load_faiss_shards(save_path):
+    """
+    Loads the shards saved with a FAISS database, whatever the size of its docstore.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+
+    Returns:
+        FaissShards: The shards, or None if no shards were saved.
+    """
+    return load_indexes(save_path, shards_folder, FaissShards.load)
+
+
+def _split_periods(dates, freq):
+    """ Returns the period of each shard of some sorted dates and the first row of each shard. """
+    labels = pd.PeriodIndex(pd.DatetimeIndex(dates), freq=freq).astype(str).to_numpy()
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]]) if len(labels) else np.array([], dtype=np.int64)
+    return labels[starts].tolist(), np.r_[starts, len(labels)].astype(np.int64)
+
+
+def build_faiss_shards(faiss_db, news_index=None, freq=None, previous=None):
+    """
+    Splits the vectors of a FAISS database by period, without embedding the documents again.
+    Documents without a valid date are left out.
+
+    Args:
+        faiss_db (FAISS): The FAISS database, its index must support `reconstruct_batch` (e.g. a flat index).
+        news_index (NewsIndex, optional): The date index of the database. Built if None.
+        freq (str, optional): Period of each shard. Default is `shard_freq`.
+        previous (FaissShards, optional): Shards saved before an update of the database, the shards holding the
+            same documents are reused instead of being rebuilt.
+
+    Returns:
+        FaissShards: The shards.
+    """
+    if news_index is None:
+        news_index = get_news_index(faiss_db)
+    freq = freq or shard_freq
+    faiss_rows = {doc_id: row for row, doc_id in faiss_db.index_to_docstore_id.items()}
+    dates = np.asarray(news_index.dates)
+    ids = np.asarray(news_index.ids)
+    periods, bounds = _split_periods(dates, freq)
+    previous_shards = {}
+    if previous is not None and previous.folder is not None and previous.freq == freq:
+        previous_shards = {period: shard for shard, period in enumerate(previous.periods)}
+    indexes, sources = [], {}
+    for shard, period in enumerate(periods):
+        shard_ids = ids[bounds[shard]:bounds[shard + 1]]
+        if period in previous_shards:
+            i = previous_shards[period]
+            if np.array_equal(previous.ids[previous.bounds[i]:previous.bounds[i + 1]], shard_ids):
+                sources[period] = previous.get_path(period)
+                indexes.append(None)
+                continue
+        rows = np.array([faiss_rows[doc_id] for doc_id in shard_ids], dtype=np.int64)
+        index = faiss.IndexFlat(faiss_db.index.d, faiss_db.index.metric_type)
+        index.add(faiss_db.index.reconstruct_batch(rows))
+        indexes.append(index)
+    return FaissShards(periods, bounds, dates, ids, len(faiss_db.docstore._dict), indexes=indexes,
+                       sources=sources, freq=freq)
+
+
+def update_faiss_shards(shards, news_index, new_db):
+    """
+    Adds the documents of a new segment to the saved shards of a FAISS database. Only the shards of the periods of
+    the new documents are rebuilt, from their saved vectors and the vectors of the segment; the others are reused.
+
+    Args:
+        shards (FaissShards): The saved shards of the database before the update.
+        news_index (NewsIndex): The date index of the updated database (see `update_news_index`).
+        new_db (FAISS): A FAISS object holding only the new documents, its index must support `reconstruct_batch`.
+
+    Returns:
+        FaissShards: The shards of the updated database.
+    """
+    new_rows = {doc_id: row for row, doc_id in new_db.index_to_docstore_id.items()}
+    dates = np.asarray(news_index.dates)
+    ids = np.asarray(news_index.ids)
+    periods, bounds = _split_periods(dates, shards.freq)
+    previous_shards = {period: shard for shard, period in enumerate(shards.periods)}
+    indexes, sources = [], {}
+    for shard, period in enumerate(periods):
+        shard_ids = ids[bounds[shard]:bounds[shard + 1]]
+        i = previous_shards.get(period)
+        old_ids = shards.ids[shards.bounds[i]:shards.bounds[i + 1]] if i is not None else ids[:0]
+        if len(old_ids) == len(shard_ids):
+            # no new documents in the period
+            sources[period] = shards.get_path(period)
+            indexes.append(None)
+            continue
+        is_new = np.array([doc_id in new_rows for doc_id in shard_ids.tolist()], dtype=bool)
+        vectors = np.empty((len(shard_ids), new_db.index.d), dtype=np.float32)
+        vectors[is_new] = new_db.index.reconstruct_batch(
+            np.array([new_rows[doc_id] for doc_id in shard_ids[is_new].tolist()], dtype=np.int64))
+        if len(old_ids):
+            # the old documents of the period keep their relative order
+            vectors[~is_new] = shards.get_index(period).reconstruct_n(0, len(old_ids))
+        index = faiss.IndexFlat(new_db.index.d, new_db.index.metric_type)
+        index.add(vectors)
+        indexes.append(index)
+    return FaissShards(periods, bounds, dates, ids, news_index.n_docs, indexes=indexes, sources=sources,
+                       freq=shards.freq)
+
+
+def get_faiss_shards(faiss_db, save_path=None):
+    """
+    Returns the shards of a FAISS database, loading or building them once per database.
+
+    The shards saved with the database in `save_path` are used if they match the size of the docstore, otherwise
+    they are rebuilt in memory.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        save_path (str, optional): Path of the FAISS database, where the shards are saved.
+
+    Returns:
+        FaissShards: The shards.
+    """
+    n_docs = len(faiss_db.docstore._dict)
+    shards = _shards.get(faiss_db)
+    if shards is not None and shards.n_docs == n_docs:
+        return shards
+    shards = load_faiss_shards(save_path) if save_path is not None else None
+    if shards is not None and shards.n_docs != n_docs:
+        print(f'FAISS shards of {save_path} are outdated, rebuilding them')
+        shards = None
+    if shards is None:
+        shards = build_faiss_shards(faiss_db, get_news_index(faiss_db, save_path))
+    _shards[faiss_db] = shards
+    return shards
+
+
+def similarity_search_by_date(faiss_db, query, k, start_date, end_date, index_path=None):
+    """
+    Retrieves the documents of a date range most similar to a query, searching only the shards of the range.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        query (str): The query.
+        k (int): Number of documents returned.
+        start_date (datetime): Start of the date range (inclusive).
+        end_date (datetime): End of the date range (exclusive).
+        index_path (str, optional): Path of the FAISS database, where its shards are saved.
+
+    Returns:
+        list: The documents, the most similar first.
+    """
+    shards = get_faiss_shards(faiss_db, index_path)
+    vector = np.asarray(faiss_db._embed_query(query), dtype=np.float32).reshape(1, -1)
+    if getattr(faiss_db, '_normalize_L2', False):
+        faiss.normalize_L2(vector)
+    docstore = faiss_db.docstore._dict
+    return [docstore[doc_id] for doc_id, _ in shards.search(vector, k, start_date, end_date)]
@@ -0,0 +1,348 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Date and TF-IDF index of the FAISS docstore, used to search the news of a period without scanning all the
+documents
+"""
+import json
+import os
+import re
+import weakref
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from segment_store import load_indexes
+
+index_folder = 'news_index'  # folder of the FAISS database storing the index
+
+_indexes = weakref.WeakKeyDictionary()  # index of each loaded FAISS database
+
+
+def tokenize(text):
+    """
+    Splits a text in TF-IDF terms: single characters and pairs of consecutive characters for Chinese text,
+    lowercase words for other scripts.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The terms.
+    """
+    terms = []
+    for run in re.findall(r'[\u4e00-\u9fff]+|[^\W_\u4e00-\u9fff]+', str(text)):
+        if '\u4e00' <= run[0] <= '\u9fff':
+            terms.extend(run)
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run.lower())
+    return terms
+
+
+class TfidfIndex:
+    """
+    TF-IDF vectors of the documents, stored as the arrays of a CSR matrix whose rows are L2 normalized.
+
+    Args:
+        data (np.ndarray): Values of the non-zero entries.
+        indices (np.ndarray): Column of the non-zero entries.
+        indptr (np.ndarray): Offsets of each row in `data` and `indices`.
+        idf (np.ndarray): Inverse document frequency of each term.
+        vocabulary (dict): Maps each term to its column.
+    """
+
+    def __init__(self, data, indices, indptr, idf, vocabulary):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.idf = idf
+        self.vocabulary = vocabulary
+
+    def transform(self, text):
+        """
+        Computes the L2 normalized TF-IDF vector of a text with the terms of the index.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            np.ndarray: The dense vector.
+        """
+        vector = np.zeros(len(self.idf), dtype=np.float32)
+        for term in tokenize(text):
+            column = self.vocabulary.get(term)
+            if column is not None:
+                vector[column] += 1
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def transform_texts(self, texts):
+        """
+        Computes the L2 normalized TF-IDF vectors of some texts with the terms and IDF of the index.
+
+        Args:
+            texts (list): The texts.
+
+        Returns:
+            csr_matrix: One row per text.
+        """
+        counts = CountVectorizer(analyzer=tokenize, vocabulary=self.vocabulary, dtype=np.float32).transform(texts)
+        return normalize(counts.multiply(self.idf).tocsr()).astype(np.float32)
+
+    def get_matrix(self):
+        """ Returns the TF-IDF vectors of the documents as a CSR matrix. """
+        return csr_matrix((self.data, self.indices, self.indptr), shape=(len(self.indptr) - 1, len(self.idf)))
+
+    def similarity(self, text, rows=slice(None)):
+        """
+        Computes the cosine similarity between a text and some documents.
+
+        Args:
+            text (str): The text (e.g. the query).
+            rows (slice, optional): Contiguous rows of the documents. Default is all the rows.
+
+        Returns:
+            np.ndarray: The similarity of each row.
+        """
+        start, stop, _ = rows.indices(len(self.indptr) - 1)
+        stop = max(start, stop)
+        begin, end = self.indptr[start], self.indptr[stop]
+        matrix = csr_matrix((self.data[begin:end], self.indices[begin:end], self.indptr[start:stop + 1] - begin),
+                            shape=(stop - start, len(self.idf)))
+        return matrix @ self.transform(text)
+
+    def save(self, folder):
+        """
+        Saves the index in a folder.
+
+        Args:
+            folder (str): The folder.
+        """
+        for name in ('data', 'indices', 'indptr', 'idf'):
+            np.save(os.path.join(folder, f'tfidf_{name}.npy'), getattr(self, name))
+        with open(os.path.join(folder, 'tfidf_vocabulary.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.vocabulary, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        Loads the index saved in a folder, memory mapping the matrix.
+
+        Args:
+            folder (str): The folder.
+
+        Returns:
+            TfidfIndex: The index, or None if it was not saved.
+        """
+        if not os.path.exists(os.path.join(folder, 'tfidf_vocabulary.json')):
+            return None
+        with open(os.path.join(folder, 'tfidf_vocabulary.json'), 'r', encoding='utf-8') as f:
+            vocabulary = json.load(f)
+        arrays = [np.load(os.path.join(folder, f'tfidf_{name}.npy'), mmap_mode='r')
+                  for name in ('data', 'indices', 'indptr')]
+        return cls(*arrays, np.load(os.path.join(folder, 'tfidf_idf.npy')), vocabulary)
+
+
+def build_tfidf_index(texts):
+    """
+    Fits the TF-IDF vectors of some documents.
+
+    Args:
+        texts (list): The text of each document.
+
+    Returns:
+        TfidfIndex: The index, with one row per document.
+    """
+    vectorizer = TfidfVectorizer(analyzer=tokenize, dtype=np.float32)
+    matrix = vectorizer.fit_transform(texts).tocsr()
+    matrix.sort_indices()
+    vocabulary = {term: int(column) for term, column in vectorizer.vocabulary_.items()}
+    return TfidfIndex(matrix.data, matrix.indices, matrix.indptr, vectorizer.idf_.astype(np.float32), vocabulary)
+
+
+class NewsIndex:
+    """
+    Documents of a FAISS docstore sorted by date.
+
+    Args:
+        dates (np.ndarray): Sorted datetime64 dates of the documents.
+        ids (np.ndarray): Docstore ids of the documents, aligned with `dates`.
+        order (np.ndarray): Position of each document in the docstore, aligned with `dates`.
+        n_docs (int): Number of documents of the docstore when the index was built.
+        tfidf (TfidfIndex, optional): TF-IDF vectors of the documents, aligned with `dates`.
+    """
+
+    def __init__(self, dates, ids, order, n_docs, tfidf=None):
+        self.dates = dates
+        self.ids = ids
+        self.order = order
+        self.n_docs = n_docs
+        self.tfidf = tfidf
+
+    def __len__(self):
+        return len(self.ids)
+
+    def window(self, start_date, end_date):
+        """
+        Returns the rows of the documents published in a period.
+
+        Args:
+            start_date (datetime): Start of the date range (inclusive).
+            end_date (datetime): End of the date range (exclusive).
+
+        Returns:
+            slice: The rows of the index in the range.
+        """
+        start = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date), 'ns'), side='left')
+        end = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end_date), 'ns'), side='left')
+        return slice(int(start), int(max(start, end)))
+
+    def get_ids(self, rows=slice(None)):
+        """
+        Returns the docstore ids of some rows, in docstore order.
+
+        Args:
+            rows (slice, optional): The rows, as returned by `window`. Default is all the rows.
+
+        Returns:
+            list: The docstore ids.
+        """
+        ids = self.ids[rows]
+        return ids[np.argsort(self.order[rows], kind='stable')].tolist()
+
+    def save(self, save_path):
+        """
+        Saves the index in the folder of a FAISS database.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+        """
+        folder = os.path.join(save_path, index_folder)
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'dates.npy'), self.dates)
+        np.save(os.path.join(folder, 'ids.npy'), self.ids)
+        np.save(os.path.join(folder, 'order.npy'), self.order)
+        if self.tfidf is not None:
+            self.tfidf.save(folder)
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_docs': self.n_docs}, f)
+
+    @classmethod
+    def load(cls, save_path):
+        """
+        Loads the index saved in the folder of a FAISS database, memory mapping the arrays.
+
+        Args:
+            save_path (str): Path of the FAISS database.
+
+        Returns:
+            NewsIndex: The index.
+        """
+        folder = os.path.join(save_path, index_folder)
+        with open(os.path.join(folder, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(folder, 'dates.npy'), mmap_mode='r'),
+                   np.load(os.path.join(folder, 'ids.npy'), mmap_mode='r'),
+                   np.load(os.path.join(folder, 'order.npy'), mmap_mode='r'),
+                   meta['n_docs'], TfidfIndex.load(folder))
+
+
+def build_news_index(faiss_db, tfidf=True):
+    """
+    Builds the date index of a FAISS database. Documents without a valid date are left out.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        tfidf (bool, optional): If True, the TF-IDF vectors of the documents are computed too. Default is True.
+
+    Returns:
+        NewsIndex: The index.
+    """
+    docstore = faiss_db.docstore._dict
+    ids = np.array(list(docstore.keys()), dtype=str)
+    dates = pd.to_datetime(pd.Series([doc.metadata.get('date', '') for doc in docstore.values()], dtype=object),
+                           errors='coerce')
+    dates = dates.to_numpy(dtype='datetime64[ns]')
+    valid = np.flatnonzero(~np.isnat(dates))
+    sorted_valid = valid[np.argsort(dates[valid], kind='stable')]
+    tfidf_index = None
+    if tfidf:
+        texts = [doc.page_content for doc in docstore.values()]
+        tfidf_index = build_tfidf_index([texts[i] for i in sorted_valid])
+    return NewsIndex(dates[sorted_valid], ids[sorted_valid], sorted_valid.astype(np.int64), len(docstore),
+                     tfidf_index)
+
+
+def update_news_index(news_index, new_db):
+    """
+    Adds the documents of a new segment to the date index of a FAISS database, without reading its other documents.
+
+    The new documents are placed after the documents of the same date, as `build_news_index` sorts them. Their
+    TF-IDF vectors use the terms and IDF of the index, which are only fit again when the index is built again.
+
+    Args:
+        news_index (NewsIndex): The index of the database before the update.
+        new_db (FAISS): A FAISS object holding only the new documents, appended after the documents of the index.
+
+    Returns:
+        NewsIndex: The index of the updated database.
+    """
+    new_index = build_news_index(new_db, tfidf=False)
+    n_old, n_new = len(news_index), len(new_index)
+    # rows of the new documents in the updated index, the old documents keep their relative order
+    new_rows = np.searchsorted(news_index.dates, new_index.dates, side='right') + np.arange(n_new)
+    old_rows = np.delete(np.arange(n_old + n_new), new_rows)
+    permutation = np.empty(n_old + n_new, dtype=np.int64)
+    permutation[old_rows] = np.arange(n_old)
+    permutation[new_rows] = n_old + np.arange(n_new)
+    tfidf_index = None
+    if news_index.tfidf is not None:
+        docstore = new_db.docstore._dict
+        texts = [docstore[doc_id].page_content for doc_id in new_index.ids]
+        matrix = vstack([news_index.tfidf.get_matrix(), news_index.tfidf.transform_texts(texts)]).tocsr()
+        matrix = matrix[permutation]
+        matrix.sort_indices()
+        tfidf_index = TfidfIndex(matrix.data, matrix.indices, matrix.indptr, news_index.tfidf.idf,
+                                 news_index.tfidf.vocabulary)
+    return NewsIndex(np.concatenate([news_index.dates, new_index.dates])[permutation],
+                     np.concatenate([news_index.ids, new_index.ids])[permutation],
+                     np.concatenate([news_index.order, new_index.order + news_index.n_docs])[permutation],
+                     news_index.n_docs + len(new_db.docstore._dict), tfidf_index)
+
+
+def get_news_index(faiss_db, save_path=None, tfidf=False):
+    """
+    Returns the date index of a FAISS database, loading or building it once per database.
+
+    The index saved with the database in `save_path` is used if it matches the size of the docstore, otherwise it
+    is rebuilt in memory.
+
+    Args:
+        faiss_db (FAISS): The FAISS database.
+        save_path (str, optional): Path of the FAISS database, where the index is saved.
+        tfidf (bool, optional): If True, the index must contain the TF-IDF vectors. Default is False.
+
+    Returns:
+        NewsIndex: The index.
+    """
+    n_docs = len(faiss_db.docstore._dict)
+    news_index = _indexes.get(faiss_db)
+    if news_index is not None and news_index.n_docs == n_docs and (news_index.tfidf is not None or not tfidf):
+        return news_index
+    news_index = None
+    if save_path is not None:
+        news_index = load_indexes(save_path, index_folder, NewsIndex.load)
+        if news_index is not None and (news_index.n_docs != n_docs or (tfidf and news_index.tfidf is None)):
+            print(f'News index of {save_path} is outdated, rebuilding it')
+            news_index = None
+    if news_index is None:
+        news_index = build_news_index(faiss_db, tfidf=tfidf)
+    _indexes[faiss_db] = news_index
+    return news_index
@@ -0,0 +1,132 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Read the news CSV files and turn their valid rows into FAISS documents, with vectorized parsing and filtering
+"""
+import os
+import pandas as pd
+from langchain_core.documents import Document
+
+batch_size = 10000  # documents yielded at a time
+
+# columns of the news scraped by scrape_news_*.py, the date is the index
+news_columns = {'text_col': 'text', 'url_col': 'url', 'date_col': None, 'extra_cols': ()}
+# columns of the Yifangda news table
+yifangda_news_columns = {'text_col': 'news_title', 'url_col': 'news_url', 'date_col': 'news_publish_time',
+                         'extra_cols': ('s3_url',)}
+
+
+def parse_dates(values):
+    """
+    Parses dates in one vectorized pass, invalid values become NaT.
+
+    The format is inferred from the first value; values in another format are parsed one by one, as
+    `pd.to_datetime` would do for a single value.
+
+    Args:
+        values (array-like): The raw dates.
+
+    Returns:
+        pd.Series: The parsed dates.
+    """
+    values = pd.Series(values)
+    dates = pd.to_datetime(values, errors='coerce')
+    retry = dates.isna() & values.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(values[retry], errors='coerce', format='mixed')
+    return dates
+
+
+def read_news_csv(file_path, category, text_col='text', url_col='url', date_col=None, extra_cols=(),
+                  exclude_urls=None):
+    """
+    Reads a news CSV file and keeps its valid rows.
+
+    Rows without text or with an invalid date, rows whose URL appeared earlier in the file and rows whose URL is
+    in `exclude_urls` are dropped.
+
+    Args:
+        file_path (str): The CSV file.
+        category (str): Category of the news of the file.
+        text_col (str, optional): Column of the text. Default is 'text'.
+        url_col (str, optional): Column of the URL. Default is 'url'.
+        date_col (str, optional): Column of the date. Default is None, the date is the first column.
+        extra_cols (tuple, optional): Other columns stored in the document metadata.
+        exclude_urls (set, optional): URLs to drop, e.g. those already in the FAISS database.
+
+    Returns:
+        pd.DataFrame: The rows with columns text, date, url, category and `extra_cols`.
+    """
+    columns = [text_col, url_col, *extra_cols]
+    dtype = {col: 'object' for col in columns}
+    if date_col is None:
+        df = pd.read_csv(file_path, index_col=0, dtype=dtype)
+        dates = parse_dates(df.index)
+    else:
+        df = pd.read_csv(file_path, usecols=[date_col, *columns], dtype=dtype)
+        dates = parse_dates(df[date_col])
+    df = pd.DataFrame({
+        'text': df[text_col].values,
+        'date': dates.values,
+        'url': df[url_col].values,
+        **{col: df[col].values for col in extra_cols},
+    })
+    urls = df['url']
+    keep = df['date'].notna() & df['text'].notna() & ~(urls.notna() & urls.duplicated())
+    if exclude_urls:
+        keep &= ~urls.isin(exclude_urls)
+    df = df[keep].reset_index(drop=True)
+    df['category'] = category
+    return df
+
+
+def iter_documents(df, size=None):
+    """
+    Turns the rows returned by `read_news_csv` into documents.
+
+    Args:
+        df (pd.DataFrame): The news.
+        size (int, optional): Number of documents of each batch. Default is `batch_size`.
+
+    Yields:
+        list: Batches of Document objects, with the other columns as metadata.
+    """
+    size = size or batch_size
+    metadata_cols = [col for col in df.columns if col != 'text']
+    for start in range(0, len(df), size):
+        batch = df.iloc[start:start + size]
+        metadatas = batch[metadata_cols].to_dict('records')
+        yield [Document(page_content=text, metadata=metadata)
+               for text, metadata in zip(batch['text'].tolist(), metadatas)]
+
+
+def load_news_documents(data_path, news_files, yifangda_news_files=(), exclude_urls=None, size=None, verbose=True):
+    """
+    Reads the news files and yields their documents.
+
+    Args:
+        data_path (str): Folder of the scraped news files.
+        news_files (list): Names of the scraped news files, in `data_path`.
+        yifangda_news_files (list, optional): Paths of the Yifangda news tables.
+        exclude_urls (set, optional): URLs to skip, e.g. those already in the FAISS database.
+        size (int, optional): Number of documents of each batch. Default is `batch_size`.
+        verbose (bool, optional): If True, print the number of documents of each file. Default is True.
+
+    Yields:
+        list: Batches of Document objects.
+    """
+    sources = [(os.path.join(data_path, file), file.split('.csv')[0], news_columns) for file in news_files]
+    sources += [(file_path, file_path.split('.csv')[0], yifangda_news_columns) for file_path in yifangda_news_files]
+    for file_path, category, columns in sources:
+        if not os.path.exists(file_path):
+            print(f"Skipping missing file: {file_path}")
+            continue
+        print(f"Processing file: {file_path}")
+        df = read_news_csv(file_path, category, exclude_urls=exclude_urls, **columns)
+        if verbose:
+            print(f'Added new {len(df)} doc from {category}')
+        yield from iter_documents(df, size)
@@ -25,8 +25,11 @@ from scrape_ppi import scrape_ppi
 from faiss_db_generate import create_faiss_db
 from yifangda_news.retrieve_news_db import download_yifangda_news
 from __init__ import *
+from tracing import span
+from segment_store import has_faiss_db
 
 
+@span('scrape_all_data', category='scraper')
 def scrape_all_data(start_date='2016-01-01', end_date=None, use_yifangda_news=False):
     """
     Scrapes and updates all required data, including time-series (TS) data,
@@ -81,7 +84,7 @@ def scrape_all_data(start_date='2016-01-01', end_date=None, use_yifangda_news=Fa
             print(f'Yifangda news NOT downloaded')
 
     # Create FAISS db if not exist
-    if not os.path.exists('faiss_db/index.faiss'):
+    if not has_faiss_db('faiss_db'):
         print('FAISS db not found')
         create_faiss_db(no_embeddings=False, add_yifangda_news=True, save_path="faiss_db")
     else:
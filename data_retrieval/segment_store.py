@@ -0,0 +1,395 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Store the FAISS database as immutable segments listed by a manifest, so that an update only writes the new
+documents and a reader never loads a half-written database. The derived indexes (news index, shards, dedup index)
+are written in a new folder at each update, listed by the same manifest
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from langchain_community.vectorstores import FAISS
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+segments_folder = 'segments'  # folder of the FAISS database storing the segments
+indexes_folder = 'indexes'  # folder of the FAISS database storing each version of the derived indexes
+manifest_file = 'manifest.json'
+lock_file = '.lock'  # file of the FAISS database locked by the process replacing its manifest
+compact_min_segments = 8  # segments are merged in the background when the manifest lists at least this many
+legacy_segment = '.'  # the database saved with `save_local` in the database folder before segments were used
+load_attempts = 3  # a reader retries when a compaction removed the segments of the manifest it read
+
+_write_lock = threading.RLock()
+_lock_files = {}  # open lock file and depth of each database locked by this process
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after 10 seconds
+            pass
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def write_lock(save_path):
+    """
+    Locks a FAISS database against the writers of any process, e.g. around the read-modify-write of its manifest.
+    The lock is reentrant within a thread.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+    """
+    key = os.path.abspath(save_path)
+    with _write_lock:
+        if key not in _lock_files:
+            os.makedirs(save_path, exist_ok=True)
+            f = open(os.path.join(save_path, lock_file), 'a+')
+            try:
+                _lock(f)
+            except BaseException:
+                f.close()
+                raise
+            _lock_files[key] = [f, 0]
+        _lock_files[key][1] += 1
+        try:
+            yield
+        finally:
+            _lock_files[key][1] -= 1
+            if _lock_files[key][1] == 0:
+                f = _lock_files.pop(key)[0]
+                _unlock(f)
+                f.close()
+
+
+def read_manifest(save_path):
+    """
+    Reads the manifest of a FAISS database.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+
+    Returns:
+        dict: The manifest with the 'version', 'segments', 'n_docs' and 'indexes' keys, or None if there is no
+            manifest.
+    """
+    try:
+        with open(os.path.join(save_path, manifest_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(save_path, segments, n_docs, version, indexes=None):
+    """ Replaces the manifest atomically: readers see either the old or the new one. """
+    path = os.path.join(save_path, manifest_file)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'segments': segments, 'n_docs': n_docs, 'indexes': indexes,
+                   'time': time.time()}, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _current_segments(save_path):
+    """ Returns the manifest of a database, listing the legacy database as a segment if there is no manifest. """
+    manifest = read_manifest(save_path)
+    if manifest is not None:
+        return manifest
+    if os.path.exists(os.path.join(save_path, 'index.faiss')):
+        return {'version': 0, 'segments': [legacy_segment], 'n_docs': None, 'indexes': None}
+    return {'version': 0, 'segments': [], 'n_docs': 0, 'indexes': None}
+
+
+def has_faiss_db(save_path):
+    """
+    Checks whether a FAISS database exists.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+
+    Returns:
+        bool: True if the database has a manifest or was saved with `save_local`.
+    """
+    return len(_current_segments(save_path)['segments']) > 0
+
+
+def _load_segments(save_path, segments, embedding_model):
+    """ Loads some segments of a database into one FAISS object. """
+    faiss_db = None
+    for segment in segments:
+        folder = os.path.join(save_path, segments_folder, segment) if segment != legacy_segment else save_path
+        segment_db = FAISS.load_local(folder, embedding_model, allow_dangerous_deserialization=True)
+        if faiss_db is None:
+            faiss_db = segment_db
+        else:
+            faiss_db.merge_from(segment_db)
+    return faiss_db
+
+
+def load_faiss_db(save_path, embedding_model):
+    """
+    Loads the segments listed by the manifest of a FAISS database into one FAISS object.
+    Databases saved with `save_local` in `save_path` are loaded as before.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        embedding_model (Embeddings): The embedding model of the database.
+
+    Returns:
+        FAISS: The database.
+
+    Raises:
+        FileNotFoundError: If there is no database in `save_path`.
+    """
+    for attempt in range(1, load_attempts + 1):
+        segments = _current_segments(save_path)['segments']
+        if not segments:
+            raise FileNotFoundError(f"No FAISS database in {save_path}")
+        try:
+            return _load_segments(save_path, segments, embedding_model)
+        except FileNotFoundError:
+            if attempt == load_attempts:
+                raise
+            # a compaction replaced the manifest while the segments were read
+            time.sleep(0.1)
+
+
+def get_indexes_path(save_path):
+    """
+    Returns the folder of the derived indexes listed by the manifest of a FAISS database.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+
+    Returns:
+        str: The folder, or `save_path` for the databases whose manifest lists no indexes.
+    """
+    manifest = read_manifest(save_path)
+    if manifest is None or not manifest.get('indexes'):
+        return save_path
+    return os.path.join(save_path, indexes_folder, manifest['indexes'])
+
+
+def load_indexes(save_path, index_folder, load):
+    """
+    Loads a derived index of a FAISS database from the folder listed by its manifest.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        index_folder (str): Sub folder of the index, e.g. 'news_index'.
+        load (callable): Called with the folder of the derived indexes, returns the index.
+
+    Returns:
+        object: The value returned by `load`, or None if the index was not saved.
+    """
+    for attempt in range(1, load_attempts + 1):
+        path = get_indexes_path(save_path)
+        if not os.path.exists(os.path.join(path, index_folder, 'meta.json')):
+            return None
+        try:
+            return load(path)
+        except FileNotFoundError:
+            if attempt == load_attempts:
+                raise
+            # an update replaced the indexes of the manifest while they were read
+            time.sleep(0.1)
+
+
+def _new_name():
+    return f'{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+
+
+def _fsync_folder(folder):
+    for root, _, files in os.walk(folder):
+        for file in files:
+            with open(os.path.join(root, file), 'rb+') as f:
+                os.fsync(f.fileno())
+
+
+def _write_tmp(save_path, folder, write, created):
+    """
+    Writes a new segment or indexes folder under a temporary name, moved in place by `_publish` once the manifest
+    lock is held. The temporary folder is recorded in `created`, so that only this writer removes it.
+    """
+    name = _new_name()
+    tmp_folder = os.path.join(save_path, folder, f'.tmp-{name}')
+    created.append((tmp_folder, os.path.join(save_path, folder, name)))
+    write(tmp_folder)
+    _fsync_folder(tmp_folder)
+    return name
+
+
+def _write_segment(save_path, faiss_db, created):
+    """ Saves a FAISS object as a new segment. """
+    return _write_tmp(save_path, segments_folder, faiss_db.save_local, created)
+
+
+def _write_indexes(save_path, indexes, created):
+    """ Saves the derived indexes in a new folder. """
+    def write(tmp_folder):
+        os.makedirs(tmp_folder)
+        for index in indexes:
+            index.save(tmp_folder)
+    return _write_tmp(save_path, indexes_folder, write, created)
+
+
+def _publish(created):
+    """ Moves the temporary folders of a writer in place, before the manifest listing them is written. """
+    for tmp_folder, folder in created:
+        os.replace(tmp_folder, folder)
+
+
+def _remove_tmp(created):
+    """ Removes the temporary folders of a writer left by a failed or dropped write. """
+    for tmp_folder, _ in created:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def _remove_unreferenced(save_path):
+    """
+    Removes the segments and indexes not listed by the manifest, left by previous versions. Must be called with the
+    manifest lock held: the folders of the other writers are still temporary until they hold it, and are kept.
+    """
+    manifest = read_manifest(save_path)
+    if manifest is None:
+        return
+    for folder, referenced in ((segments_folder, manifest['segments']), (indexes_folder, [manifest.get('indexes')])):
+        folder = os.path.join(save_path, folder)
+        if os.path.isdir(folder):
+            for name in set(os.listdir(folder)) - set(referenced):
+                if not name.startswith('.tmp-'):
+                    shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+
+def save_faiss_db(save_path, faiss_db, indexes=()):
+    """
+    Replaces the content of a FAISS database with a new one, saved as a single segment.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        faiss_db (FAISS): The new database.
+        indexes (list, optional): Derived indexes of the new database, objects with a `save(save_path)` method.
+            They are listed by the same manifest as the segment.
+    """
+    created = []
+    try:
+        name = _write_segment(save_path, faiss_db, created)
+        indexes_name = _write_indexes(save_path, indexes, created) if indexes else None
+        with write_lock(save_path):
+            version = _current_segments(save_path)['version'] + 1
+            _publish(created)
+            _write_manifest(save_path, [name], len(faiss_db.docstore._dict), version, indexes_name)
+            _remove_unreferenced(save_path)
+    finally:
+        _remove_tmp(created)
+
+
+def append_segment(save_path, faiss_db, indexes=()):
+    """
+    Adds new documents to a FAISS database as a new segment, the existing segments are not rewritten.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        faiss_db (FAISS): A FAISS object holding only the new documents.
+        indexes (list, optional): Derived indexes of the whole updated database, objects with a
+            `save(save_path)` method. They are listed by the same manifest as the new segment, otherwise the
+            manifest keeps listing the previous ones.
+
+    Returns:
+        int: Number of segments of the database.
+    """
+    created = []
+    try:
+        name = _write_segment(save_path, faiss_db, created)
+        indexes_name = _write_indexes(save_path, indexes, created) if indexes else None
+        with write_lock(save_path):
+            manifest = _current_segments(save_path)
+            n_docs = manifest['n_docs'] + len(faiss_db.docstore._dict) if manifest['n_docs'] is not None else None
+            _publish(created)
+            _write_manifest(save_path, manifest['segments'] + [name], n_docs, manifest['version'] + 1,
+                            indexes_name or manifest.get('indexes'))
+            _remove_unreferenced(save_path)
+            return len(manifest['segments']) + 1
+    finally:
+        _remove_tmp(created)
+
+
+def compact(save_path, embedding_model):
+    """
+    Merges the segments of a FAISS database into one segment.
+
+    Segments appended while the compaction runs are kept after the merged one.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        embedding_model (Embeddings): The embedding model of the database.
+    """
+    segments = _current_segments(save_path)['segments']
+    if len(segments) < 2:
+        return
+    faiss_db = _load_segments(save_path, segments, embedding_model)
+    created = []
+    try:
+        name = _write_segment(save_path, faiss_db, created)
+        with write_lock(save_path):
+            manifest = _current_segments(save_path)
+            if manifest['segments'][:len(segments)] != segments:
+                # the database was replaced meanwhile, drop the merged segment
+                return
+            new_segments = [name] + manifest['segments'][len(segments):]
+            n_docs = manifest['n_docs']
+            if n_docs is None and len(new_segments) == 1:
+                n_docs = len(faiss_db.docstore._dict)
+            _publish(created)
+            _write_manifest(save_path, new_segments, n_docs, manifest['version'] + 1, manifest.get('indexes'))
+            _remove_unreferenced(save_path)
+    finally:
+        _remove_tmp(created)
+    print(f'FAISS database compacted: {len(segments)} segments merged')
+
+
+def compact_in_background(save_path, embedding_model, min_segments=None):
+    """
+    Starts the compaction of a FAISS database in a thread if it has too many segments.
+
+    Args:
+        save_path (str): Path of the FAISS database.
+        embedding_model (Embeddings): The embedding model of the database.
+        min_segments (int, optional): Number of segments from which to compact. Default is `compact_min_segments`.
+
+    Returns:
+        threading.Thread: The compaction thread, or None if no compaction is needed.
+    """
+    if len(_current_segments(save_path)['segments']) < (min_segments or compact_min_segments):
+        return None
+    # not a daemon thread, so the process waits for the compaction to finish before exiting
+    thread = threading.Thread(target=compact, args=(save_path, embedding_model), name='faiss-compaction')
+    thread.start()
+    return thread
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup_index import DedupIndex
+
+title = '易方达基金每日市场观察'
+article = '央行今日开展逆回购操作，维持流动性合理充裕，' * 5
+
+
+def test_short_text_duplicate_only_within_days():
+    dedup_index = DedupIndex()
+    dedup_index.add('https://a.com/1', title, '2024-03-01')
+    assert dedup_index.find_duplicate('https://a.com/2', title, '2024-03-02') == 'text'
+    assert dedup_index.find_duplicate('https://a.com/3', title, '2024-06-01') is None
+    assert dedup_index.find_duplicate('https://a.com/4', title) is None
+
+
+def test_long_text_duplicate_on_any_day():
+    dedup_index = DedupIndex()
+    dedup_index.add('https://a.com/1', article, '2024-03-01')
+    assert dedup_index.find_duplicate('https://a.com/2', article + '。', '2024-06-01') == 'text'
+    assert dedup_index.find_duplicate('https://a.com/1', title, '2024-06-01') == 'url'
+
+
+def test_save_and_load_keep_days(tmp_path):
+    dedup_index = DedupIndex()
+    dedup_index.add('https://a.com/1', title, '2024-03-01')
+    dedup_index.add('https://a.com/2', title)
+    dedup_index.save(str(tmp_path))
+    loaded = DedupIndex.load(str(tmp_path))
+    assert loaded.days == dedup_index.days
+    assert loaded.find_duplicate('https://a.com/3', title, '2024-03-01') == 'text'
+    assert loaded.find_duplicate('https://a.com/3', title, '2024-09-01') is None
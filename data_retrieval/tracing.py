@@ -0,0 +1,188 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Time nested spans of the data retrieval and report generation steps, save them as a Chrome trace and
+      optionally profile them with cProfile and tracemalloc.
+"""
+import atexit
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from contextlib import ContextDecorator
+
+# Chrome trace-event JSON written at exit, open it with chrome://tracing or https://ui.perfetto.dev (None: no trace)
+trace_path = os.environ.get('REPORT_TRACE_PATH')
+# folder of the cProfile stats of the profiled spans, one .prof file per span (None: no profiling)
+profile_dir = os.environ.get('REPORT_PROFILE_DIR')
+# if True the allocated and peak memory of the profiled spans are recorded with tracemalloc
+trace_memory = os.environ.get('REPORT_TRACE_MEMORY', '') == '1'
+
+_events = []
+_events_lock = threading.Lock()
+_thread_names = {}
+_profile_lock = threading.Lock()
+_origin = time.perf_counter_ns()
+
+
+def configure(path=None, profile_folder=None, memory=False):
+    """
+    Enables tracing from code (e.g. command line flags), the environment variables REPORT_TRACE_PATH,
+    REPORT_PROFILE_DIR and REPORT_TRACE_MEMORY=1 do the same without changing the code.
+
+    Args:
+        path (str, optional): The Chrome trace file, written at exit.
+        profile_folder (str, optional): The folder of the cProfile stats of the profiled spans.
+        memory (bool, optional): If True, record the memory of the profiled spans with tracemalloc.
+    """
+    global trace_path, profile_dir, trace_memory
+    trace_path = path or trace_path
+    profile_dir = profile_folder or profile_dir
+    trace_memory = memory or trace_memory
+
+
+def is_enabled():
+    """ Returns True if spans are recorded. """
+    return bool(trace_path or profile_dir or trace_memory)
+
+
+class span(ContextDecorator):
+    """
+    Times a block of code, as a context manager or a function decorator. Spans opened inside a span are nested
+    under it in the trace.
+
+    Args:
+        name (str): The span name.
+        category (str, optional): The span category (e.g. 'stage', 'scraper'). Default is 'report'.
+        profile (bool, optional): If True, the span is profiled when `profile_dir` or `trace_memory` is set.
+            Meant for coarse spans such as the report stages: profiling costs time and only one span is profiled
+            at a time.
+        **args: Values shown with the span in the trace (e.g. the report date).
+    """
+
+    def __init__(self, name, category='report', profile=False, **args):
+        self.name = name
+        self.category = category
+        self.profile = profile
+        self.args = args
+        self._profiler = None
+        self._memory = False
+
+    def _recreate_cm(self):
+        # a new span for each call of a decorated function, so calls from different threads do not share state
+        return span(self.name, self.category, self.profile, **self.args)
+
+    def __enter__(self):
+        if not is_enabled():
+            self._start = None
+            return self
+        if self.profile and (profile_dir or trace_memory) and _profile_lock.acquire(blocking=False):
+            if profile_dir:
+                self._profiler = cProfile.Profile()
+                try:
+                    self._profiler.enable()
+                except ValueError as e:  # another profiler is active
+                    warnings.warn(f"Span {self.name} not profiled: {e}", UserWarning)
+                    self._profiler = None
+            if trace_memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                self._memory_start = tracemalloc.get_traced_memory()[0]
+                self._memory = True
+            if self._profiler is None and not self._memory:
+                _profile_lock.release()
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._start is None:
+            return False
+        end = time.perf_counter_ns()
+        args = dict(self.args)
+        if exc_type is not None:
+            args['error'] = repr(exc)
+        if self._profiler is not None or self._memory:
+            if self._profiler is not None:
+                self._profiler.disable()
+                os.makedirs(profile_dir, exist_ok=True)
+                file_name = re.sub(r'[^\w.-]+', '_', f'{self.name}_{os.getpid()}_{end}') + '.prof'
+                self._profiler.dump_stats(os.path.join(profile_dir, file_name))
+                args['profile'] = file_name
+                self._profiler = None
+            if self._memory:
+                current, peak = tracemalloc.get_traced_memory()
+                args['memory_allocated_mb'] = round((current - self._memory_start) / 2 ** 20, 3)
+                args['memory_peak_mb'] = round(peak / 2 ** 20, 3)
+                self._memory = False
+            _profile_lock.release()
+        event = {
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': (self._start - _origin) / 1000,
+            'dur': (end - self._start) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        }
+        with _events_lock:
+            _events.append(event)
+            _thread_names[threading.get_ident()] = threading.current_thread().name
+        return False
+
+
+def get_events():
+    """
+    Returns the spans recorded so far.
+
+    Returns:
+        list: The Chrome trace events, durations in microseconds.
+    """
+    with _events_lock:
+        return list(_events)
+
+
+def save_trace(path=None):
+    """
+    Writes the recorded spans as a Chrome trace-event JSON file.
+
+    Args:
+        path (str, optional): The file. Default is `trace_path`.
+
+    Returns:
+        str: The path of the file, or None if there is nothing to write.
+    """
+    path = path or trace_path
+    if not path:
+        return None
+    with _events_lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+    if not events:
+        return None
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                for tid, name in thread_names.items()]
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, default=str)
+    print(f'Trace of {len(events)} spans saved to {path}')
+    return path
+
+
+atexit.register(save_trace)
+
+# the module is imported both as `tracing` (data_retrieval scripts) and `data_retrieval.tracing` (report
+# generation), both names must share the same recorded spans
+sys.modules.setdefault('tracing', sys.modules[__name__])
+sys.modules.setdefault('data_retrieval.tracing', sys.modules[__name__])
@@ -12,6 +12,7 @@ import time
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
+from tracing import span
 
 
 def setup_chrome_driver() -> webdriver.Chrome:
@@ -42,7 +43,8 @@ def retry(func, max_attempts=5, wait_seconds=10, *args, **kwargs):
     """
     for attempt in range(1, max_attempts + 1):
         try:
-            return func(*args, **kwargs)  # Execute with arguments
+            with span(getattr(func, '__name__', 'retry'), category='scraper', attempt=attempt):
+                return func(*args, **kwargs)  # Execute with arguments
         except Exception as e:
             print(f"Attempt {attempt} failed: {e}")
             if attempt < max_attempts:
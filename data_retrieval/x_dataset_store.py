@@ -0,0 +1,116 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Store the X dataset in a typed columnar file and load it once per process
+"""
+import os
+import warnings
+from functools import lru_cache
+import pandas as pd
+try:
+    import pyarrow  # noqa: F401 (parquet engine)
+    has_parquet = True
+except ImportError as e:
+    has_parquet = False
+    warnings.warn(f"pyarrow not available, X dataset will be read from CSV: {e}", UserWarning)
+
+# names of the X dataset columns used in the reports
+x_rename_dict = {
+    '逆回购:7日:回购利率': '7天期逆回购利率',
+    '逆回购:7日:回购金额': '7天期逆回购数量',
+    'China_GDP': '中国GDP',
+    'GDP:平减指数': '中国GDP平减指数',
+    'China_Inflation': '中国通货膨胀率',
+    'China_Public_Debt': '中国公共债务',
+    'China_Gov_Lending': '中国政府贷款',
+    'US_Interest_Rates': '美国利率',
+    'US_Composite_Leading_Indicator': '美国综合领先指标',
+    'China_Composite_Leading_Indicator': '中国综合领先指标',
+    'China_Business_Confidence': '中国商业信心',
+    'Shanghai_Composite': '上证指数',
+    'CNYUSD': '人民币对美元汇率',
+    'CNYEUR': '人民币对欧元汇率',
+    'M1_MOM': '中国：M1月度增长率',
+    'M2_MOM': '中国：M2月度增长率',
+    'TR_Interest_Rate': '泰勒利率',
+    'Bond_Spread': '债券利差',
+    '消费者指数:信心指数': '消费者信心指数',
+    'CPI:当月值': 'CPI'
+}
+x_raw_names_dict = {v: k for k, v in x_rename_dict.items()}
+
+
+def get_parquet_path(csv_path):
+    """
+    Returns the path of the Parquet copy of a CSV dataset.
+
+    Parameters:
+    csv_path (str): Path of the CSV file.
+
+    Returns:
+    str: Path of the Parquet file, in the same folder.
+    """
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def save_x_dataset(df, csv_path):
+    """
+    Saves the X dataset as Parquet next to its CSV file, with report column names and a datetime index.
+
+    Parameters:
+    df (pd.DataFrame): The X dataset, with a datetime index and raw column names.
+    csv_path (str): Path of the CSV file the dataset was saved to.
+
+    Returns:
+    str: Path of the Parquet file, or None if pyarrow is not installed.
+    """
+    if not has_parquet:
+        return None
+    df = df.rename(columns=x_rename_dict)
+    df.index = pd.to_datetime(df.index)
+    df.index.name = 'date'
+    parquet_path = get_parquet_path(csv_path)
+    tmp_path = parquet_path + '.tmp'
+    df.to_parquet(tmp_path, engine='pyarrow')
+    os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+
+@lru_cache(maxsize=8)
+def _load_x_dataset(csv_path, mtime):
+    """ Reads the dataset with report column names, `mtime` is only part of the cache key. """
+    parquet_path = get_parquet_path(csv_path)
+    if has_parquet and os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= mtime:
+        return pd.read_parquet(parquet_path, engine='pyarrow', memory_map=True)
+    df = pd.read_csv(csv_path, index_col=0, parse_dates=True)
+    if has_parquet:
+        # write the columnar copy so next processes skip CSV parsing
+        save_x_dataset(df, csv_path)
+    df = df.rename(columns=x_rename_dict)
+    df.index.name = 'date'
+    return df
+
+
+def load_x_dataset(csv_path, renamed=True):
+    """
+    Loads the X dataset, reading the Parquet copy when it is up to date and the CSV otherwise.
+
+    The dataset is parsed once per process and file version: results are cached and invalidated when the CSV
+    file is modified. A copy is returned, so callers can modify it.
+
+    Parameters:
+    csv_path (str): Path of the CSV file (e.g. 'data/XY_aug_feat.csv').
+    renamed (bool): If True columns use the report names of `x_rename_dict`, otherwise the raw names of the CSV.
+
+    Returns:
+    pd.DataFrame: The dataset, indexed by date.
+    """
+    df = _load_x_dataset(os.path.abspath(csv_path), os.path.getmtime(csv_path)).copy()
+    if not renamed:
+        df = df.rename(columns=x_raw_names_dict)
+        df.index.name = None
+    return df
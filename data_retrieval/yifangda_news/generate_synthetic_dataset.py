@@ -5,21 +5,147 @@ Author: davideliu
 
 E-mail: davide97ls@gmail.com
 
-Goal: Generake synthetic news (only for test)
+Goal: Generake synthetic news, X dataset and policy reports (only for test and benchmarks)
 """
+import os
+import numpy as np
 import pandas as pd
 import random
 from datetime import datetime, timedelta
 
+target_col = '中国:贷款市场报价利率(LPR):1年'
+# raw columns of XY_aug_feat.csv with their (start value, monthly volatility)
+x_columns = {
+    'China_GDP': (11.0, 0.3), 'China_Inflation': (2.0, 0.2), 'China_Public_Debt': (50.0, 0.5),
+    'China_Gov_Lending': (-3.4, 0.2), 'US_Interest_Rates': (0.3, 0.1), 'US_Composite_Leading_Indicator': (99.2, 0.3),
+    'China_Composite_Leading_Indicator': (99.8, 0.3), 'China_Business_Confidence': (98.0, 0.4),
+    'Shanghai_Composite': (2700.0, 80.0), 'CNYUSD': (0.15, 0.002), 'CNYEUR': (0.14, 0.002),
+    target_col: (4.35, 0.0), '中期借贷便利(MLF):操作利率:1年': (3.25, 0.02), 'GDP:不变价:当季同比': (6.9, 0.2),
+    '消费者指数:信心指数': (104.0, 1.5), '国债到期收益率:6月': (2.3, 0.05), '国债到期收益率:1年': (2.4, 0.05),
+    '国债到期收益率:2年': (2.5, 0.05), '国债到期收益率:3年': (2.6, 0.05), '国债到期收益率:4年': (2.7, 0.05),
+    '国债到期收益率:5年': (2.7, 0.05), '国债到期收益率:6年': (2.8, 0.05), '国债到期收益率:7年': (2.9, 0.05),
+    '国债到期收益率:8年': (2.9, 0.05), '国债到期收益率:9年': (2.9, 0.05), '国债到期收益率:10年': (2.9, 0.05),
+    '国债到期收益率:15年': (3.1, 0.05), '国债到期收益率:20年': (3.4, 0.05), '国债到期收益率:30年': (3.5, 0.05),
+    '中国银行:净息差': (1.9, 0.02), '国民总储蓄率': (45.0, 0.2), '未来3个月准备增加"购房"支出的比例': (20.0, 0.5),
+    '居民人均可支配收入': (6000.0, 150.0), '中债中国绿色债券指数(总值)净价指数': (100.0, 0.5), '制造业PMI': (50.0, 0.6),
+    '出口总值(人民币计价):当月值': (15000.0, 600.0), 'CPI:当月值': (101.5, 0.3), '房地产开发投资:当月值': (9000.0, 400.0),
+    '规模以上工业增加值:定基指数': (100.0, 0.8), '全国城镇调查失业率': (5.1, 0.1),
+    '存款准备金率:中小型存款类金融机构': (13.0, 0.0), 'GDP:平减指数': (101.0, 0.3), 'DR007': (2.3, 0.1),
+    '逆回购:7日:回购利率': (2.25, 0.02), '逆回购:7日:回购金额': (1000.0, 200.0), 'M2_MOM': (0.8, 0.3),
+    'M1_MOM': (0.6, 0.5), 'ppi': (-1.0, 0.5), 'TR_Interest_Rate': (4.0, 0.1), 'Bond_Spread': (0.5, 0.05),
+}
+# terms used in synthetic policy reports and news articles
+policy_terms = [
+    '稳健的货币政策', '逆周期调节', '降息', '降准', '实体经济', '社会融资成本', '房地产市场', '扩大内需战略', '高质量发展',
+    '金融风险防控', '人民币汇率', '通货膨胀', '经济复苏', '货币信贷政策', '科技创新', '普惠金融', '就业', '消费',
+]
 
-def generate_news_csv(file_path: str):
+
+def _synthetic_text(rng, num_sentences):
+    """ Returns a Chinese text made of sentences about random policy terms. """
+    templates = ['会议指出，要继续实施{0}，加强{1}。', '当前{0}面临新的挑战，{1}仍需进一步巩固。',
+                 '要统筹推进{0}和{1}，保持流动性合理充裕。', '数据显示，{0}稳中有进，{1}预期改善。']
+    return ''.join(rng.choice(templates).format(*rng.sample(policy_terms, 2)) for _ in range(num_sentences))
+
+
+def generate_x_dataset(file_path: str, start_date: str = '2016-01-31', end_date: str = '2024-12-31', seed: int = 0):
+    """
+    Generates a monthly X dataset with the columns of XY_aug_feat.csv, as random walks, and saves it as CSV.
+
+    The LPR decreases by 5 to 25 bp in about one month every eight, so historical declines and unchanged
+    periods can be computed.
+
+    Args:
+        file_path (str): The full path where the CSV file will be saved.
+        start_date (str): First month end of the dataset.
+        end_date (str): Last month end of the dataset.
+        seed (int): Seed of the random generator, the same seed always gives the same dataset.
+
+    Returns:
+        pd.DataFrame: The dataset, indexed by month end.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start_date, end_date, freq='ME')
+    data = {}
+    for column, (start, volatility) in x_columns.items():
+        data[column] = start + np.cumsum(rng.normal(0, volatility, len(index)))
+    cuts = rng.random(len(index)) < 0.125
+    cuts[0] = False
+    declines = np.where(cuts, rng.choice([0.05, 0.1, 0.15, 0.25], len(index)), 0)
+    data[target_col] = np.maximum(x_columns[target_col][0] - np.cumsum(declines), 2.5).round(2)
+    df = pd.DataFrame(data, index=index.strftime('%Y-%m-%d'))
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    df.to_csv(file_path, encoding='utf-8')
+    return df
+
+
+def generate_policy_reports(folder: str, start_date: str = '2016-01-31', end_date: str = '2024-12-31', seed: int = 0):
+    """
+    Generates quarterly synthetic policy reports and saves them with the names and columns read by the reports:
+    政策货币报告.csv, 政治局会议.csv and 中央银行会议报告.csv.
+
+    Args:
+        folder (str): The folder where the CSV files will be saved.
+        start_date (str): Date of the first reports.
+        end_date (str): Date of the last reports.
+        seed (int): Seed of the random generator.
+    """
+    rng = random.Random(seed)
+    dates = pd.date_range(start_date, end_date, freq='QE')
+    os.makedirs(folder, exist_ok=True)
+    for file_name, day, num_sentences in (('政策货币报告.csv', 10, 200), ('政治局会议.csv', 20, 30),
+                                          ('中央银行会议报告.csv', 25, 30)):
+        rows = [{
+            'date': (date.replace(day=1) + timedelta(days=day)).strftime('%Y-%m-%d %H:%M:%S'),
+            'text': _synthetic_text(rng, num_sentences),
+            'url': f'https://example.com/{os.path.splitext(file_name)[0]}/{i}',
+        } for i, date in enumerate(dates)]
+        df = pd.DataFrame(rows)
+        if file_name == '政治局会议.csv':
+            df.insert(2, 'title', [f'中共中央政治局召开会议 {date[:10]}' for date in df['date']])
+        df.to_csv(os.path.join(folder, file_name), index=False, encoding='utf-8')
+
+
+def generate_news_documents(num_entries: int = 500, start_date: str = '2016-01-01', end_date: str = '2024-12-31',
+                            seed: int = 0):
+    """
+    Generates synthetic news articles with the fields stored in the FAISS news database.
+
+    Args:
+        num_entries (int): Number of articles.
+        start_date (str): Earliest publication date.
+        end_date (str): Latest publication date.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        pd.DataFrame: One article per row with date, title, text, url and category columns.
+    """
+    rng = random.Random(seed)
+    start, end = datetime.strptime(start_date, '%Y-%m-%d'), datetime.strptime(end_date, '%Y-%m-%d')
+    rows = []
+    for i in range(num_entries):
+        date = start + timedelta(days=rng.randint(0, (end - start).days))
+        terms = rng.sample(policy_terms, 2)
+        rows.append({
+            'date': date.strftime('%Y-%m-%d'),
+            'title': f'{terms[0]}与{terms[1]}最新动态',
+            'text': _synthetic_text(rng, rng.randint(5, 40)),
+            'url': f'https://news_website/news_{i}.html',
+            'category': 'synthetic',
+        })
+    return pd.DataFrame(rows).sort_values('date', kind='stable').reset_index(drop=True)
+
+
+def generate_news_csv(file_path: str, num_entries: int = 100, seed: int = None):
     """
-    Generates a CSV file with at least 100 financial news entries and saves it to the specified directory.
+    Generates a CSV file with financial news entries and saves it to the specified directory.
 
     Args:
         file_path (str): The full path where the CSV file will be saved.
+        num_entries (int): Number of news entries. Default is 100.
+        seed (int): Seed of the random generator, None for a different file at each call.
     """
-    num_entries = 100
+    rng = random.Random(seed)
     start_date = datetime(2024, 1, 1)
     end_date = datetime(2025, 12, 31)
 
@@ -77,8 +203,8 @@ def generate_news_csv(file_path: str):
     ]
 
     data = {
-        'news_publish_time': [start_date + timedelta(days=random.randint(0, (end_date - start_date).days)) for _ in range(num_entries)],
-        'news_title': [random.choice(titles) for _ in range(num_entries)],
+        'news_publish_time': [start_date + timedelta(days=rng.randint(0, (end_date - start_date).days)) for _ in range(num_entries)],
+        'news_title': [rng.choice(titles) for _ in range(num_entries)],
         's3_url': [f'https://example-bucket.s3.amazonaws.com/news_{i}.pdf' for i in range(1, num_entries + 1)],
         'news_url': [f'https://news_website/news_{i}.pdf' for i in range(1, num_entries + 1)]
     }
@@ -88,6 +214,7 @@ def generate_news_csv(file_path: str):
     print(f"CSV file saved at: {file_path}")
 
 
-# Example usage
-filename = "yifangda_news/synthetic_news_data.csv"
-generate_news_csv(filename)
+if __name__ == '__main__':
+    # Example usage
+    filename = "yifangda_news/synthetic_news_data.csv"
+    generate_news_csv(filename)
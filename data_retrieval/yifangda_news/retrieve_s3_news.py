@@ -1,3 +1,8 @@
+import gzip
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.client import Config
 
@@ -15,47 +20,137 @@ prod_db_config = {
     'secret_key': "q8DYhzngkRoUIuIzXNN5eMYgWFedg8ZBjHBgAn2g",
     'bucket_name': "nsdc",
 }
+s3_key_template = "hermes/v1/newsbody/{}"
+news_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'news_cache')  # None disables the cache
+max_fetch_workers = 8  # maximum number of news bodies downloaded at the same time
+max_pool_connections = 16  # size of the connection pool of the S3 client
 
+_clients = {}
+_clients_lock = threading.Lock()
 
-def download_news_from_s3(news_code, local_filename=None, prod_env=False):
+
+def get_s3_client(prod_env=False):
     """
-    Download a file from a custom S3-compatible storage.
+    Return the S3 client of an environment, created once and shared by all threads.
 
-    :param news_code: News code.
-    :param local_filename: The local file path to save the downloaded file.
     :param prod_env: if True use prod env.
+    :return: Tuple (client, bucket_name).
+    """
+    db_config = prod_db_config if prod_env else test_db_config
+    key = (db_config['endpoint_url'], db_config['access_key'])
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = boto3.client(
+                "s3",
+                endpoint_url=db_config['endpoint_url'],
+                aws_access_key_id=db_config['access_key'],
+                aws_secret_access_key=db_config['secret_key'],
+                config=Config(signature_version="s3v4", max_pool_connections=max_pool_connections),
+            )
+    return _clients[key], db_config['bucket_name']
+
+
+def get_cache_path(news_code, bucket_name):
+    """
+    Return the path of the cached body of a news, addressed by the hash of its S3 location.
+
+    :param news_code: News code.
+    :param bucket_name: Bucket storing the news.
+    :return: Path of the gzip file.
+    """
+    digest = hashlib.sha256(f"{bucket_name}/{s3_key_template.format(news_code)}".encode('utf-8')).hexdigest()
+    return os.path.join(news_cache_dir, digest[:2], f"{digest}.txt.gz")
+
+
+def read_cached_news(news_code, bucket_name):
+    """
+    Read the cached body of a news.
+
+    :param news_code: News code.
+    :param bucket_name: Bucket storing the news.
+    :return: The news body, or None if it is not cached.
+    """
+    if news_cache_dir is None:
+        return None
+    try:
+        with gzip.open(get_cache_path(news_code, bucket_name), 'rt', encoding='utf-8') as f:
+            return f.read()
+    except (FileNotFoundError, EOFError, OSError):
+        return None
+
+
+def write_cached_news(news_code, bucket_name, content):
+    """
+    Write the body of a news in the cache.
+
+    :param news_code: News code.
+    :param bucket_name: Bucket storing the news.
+    :param content: The news body.
+    """
+    if news_cache_dir is None:
+        return
+    path = get_cache_path(news_code, bucket_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def fetch_news_body(news_code, prod_env=False):
     """
-    if not prod_env:
-        endpoint_url = test_db_config['endpoint_url']
-        access_key = test_db_config['access_key']
-        secret_key = test_db_config['secret_key']
-        bucket_name = test_db_config['bucket_name']
-        s3_key_template = "hermes/v1/newsbody/{}"
-    else:
-        endpoint_url = prod_db_config['endpoint_url']
-        access_key = prod_db_config['access_key']
-        secret_key = prod_db_config['secret_key']
-        bucket_name = prod_db_config['bucket_name']
-        s3_key_template = "hermes/v1/newsbody/{}"
-
-    # Create an S3 client with a custom endpoint
-    s3_key = s3_key_template.format(news_code)
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(signature_version="s3v4"),
-    )
+    Return the body of a news, from the cache or from S3.
 
+    :param news_code: News code.
+    :param prod_env: if True use prod env.
+    :return: The news body, or None if it could not be downloaded.
+    """
+    s3, bucket_name = get_s3_client(prod_env)
+    content = read_cached_news(news_code, bucket_name)
+    if content is not None:
+        return content
     try:
-        if local_filename:
-            s3.download_file(bucket_name, s3_key, local_filename)
-        response = s3.get_object(Bucket=bucket_name, Key=s3_key)
-        return response["Body"].read().decode("utf-8")  # Convert bytes to string
+        response = s3.get_object(Bucket=bucket_name, Key=s3_key_template.format(news_code))
+        content = response["Body"].read().decode("utf-8")  # Convert bytes to string
     except Exception as e:
         print(f"X Error downloading file: {e}")
+        return None
+    write_cached_news(news_code, bucket_name, content)
+    return content
+
+
+def fetch_news_bodies(news_codes, prod_env=False, max_workers=max_fetch_workers):
+    """
+    Return the bodies of some news, downloading the ones not cached in parallel.
+
+    :param news_codes: List of news codes.
+    :param prod_env: if True use prod env.
+    :param max_workers: Maximum number of concurrent downloads.
+    :return: Dict mapping each news code to its body, or to None if it could not be downloaded.
+    """
+    news_codes = list(dict.fromkeys(news_codes))
+    if not news_codes:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(news_codes)))) as executor:
+        contents = executor.map(lambda code: fetch_news_body(code, prod_env=prod_env), news_codes)
+        return dict(zip(news_codes, contents))
+
+
+def download_news_from_s3(news_code, local_filename=None, prod_env=False):
+    """
+    Download a file from a custom S3-compatible storage, using the local news cache.
+
+    :param news_code: News code.
+    :param local_filename: The local file path to save the downloaded file.
+    :param prod_env: if True use prod env.
+    """
+    content = fetch_news_body(news_code, prod_env=prod_env)
+    if content is None:
         return "No news content found"
+    if local_filename:
+        with open(local_filename, 'w', encoding='utf-8') as f:
+            f.write(content)
+    return content
 
 
 if __name__ == '__main__':
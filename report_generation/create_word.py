@@ -19,6 +19,10 @@ from PIL import Image
 import pandas as pd
 from io import StringIO
 from datetime import datetime
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data_retrieval.tracing import span
 
 
 # 可以将markdown里面的table加载word里面
@@ -165,6 +169,7 @@ def generate_title(date_str):
     return title
 
 
+@span('generate_word_doc')
 def generate_word_doc(date: str):
     """
     Generates a Word document based on the provided date.
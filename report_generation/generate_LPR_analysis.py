@@ -11,6 +11,10 @@ import os
 import pandas as pd
 from datetime import datetime
 from models import model_invoke
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data_retrieval.x_dataset_store import load_x_dataset
+from data_retrieval.tracing import span
 
 
 def analyze_series(series):
@@ -140,6 +144,7 @@ def generate_lpr_report_analysis(df, date, y, meeting_day=20, history_len=12, sa
     return response
 
 
+@span('generate_lpr_analysis')
 def generate_lpr_analysis(date, csv_file_path, y, save_folder, model="gpt-4o-mini"):
     """
     Generates an LPR analysis for a given date based on historical data from a CSV file.
@@ -156,7 +161,7 @@ def generate_lpr_analysis(date, csv_file_path, y, save_folder, model="gpt-4o-min
     """
     year, month, day = map(int, date.split('-'))
     cur_date = datetime(year, month, day)
-    df = pd.read_csv(csv_file_path, index_col=0, parse_dates=True)
+    df = load_x_dataset(csv_file_path, renamed=False)
     start_date = datetime(2019, 8, 31)
     history_len = (cur_date.year * 12 + cur_date.month) - (start_date.year * 12 + start_date.month)
     # history_len = 12
@@ -8,12 +8,12 @@ E-mail: davide97ls@gmail.com
 Goal: News Analysis based on historical data and statistics.
 """
 from keys import openai_key
-import json
+import asyncio
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from models import model_invoke
+from models import model_invoke, amodel_invoke
 from tqdm import tqdm
 import pandas as pd
 from typing import Optional
@@ -23,11 +23,17 @@ import warnings
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../data_retrieval")))
 from data_retrieval.faiss_db_utils import filter_by_similarity
+from data_retrieval.x_dataset_store import load_x_dataset
+from data_retrieval.tracing import span
+from data_retrieval.segment_store import load_faiss_db
+from main_utils import parse_json_response
+from prompt_budget import fit_prompt, get_prompt_budget, truncate_to_tokens
 
 
+faiss_db_path = "../data_retrieval/faiss_db"
 embedding_model = OpenAIEmbeddings(model="text-embedding-ada-002", api_key=openai_key)
 try:
-    faiss_db = FAISS.load_local("../data_retrieval/faiss_db", embedding_model, allow_dangerous_deserialization=True)
+    faiss_db = load_faiss_db(faiss_db_path, embedding_model)
     print("FAISS database loaded")
 except FileNotFoundError as e:
     warnings.warn(f"FAISS database not found: {e}", UserWarning)
@@ -35,6 +41,9 @@ except FileNotFoundError as e:
 except Exception as e:
     faiss_db = None
 
+news_impact_schema = {'prob_decrease': float, 'impact_on_LPR': str}  # keys of the news impact JSON
+news_analysis_schema = {**news_impact_schema, 'summary': str}  # keys of the single call news analysis JSON
+
 
 def generate_news_prompt(doc, y_history, cur_date):
     """
@@ -71,6 +80,44 @@ LPR历史数据为：{y_history}（按时间顺序从过去到现在列出，最
     return news_prompt
 
 
+def generate_news_analysis_prompt(doc, y_history, cur_date):
+    """
+    Generates a prompt asking both the impact of a news article on LPR and its summary in one JSON object.
+
+    Args:
+        doc: The news document containing metadata and content.
+        y_history (list): Historical LPR values in chronological order.
+        cur_date (datetime): The current date for prediction.
+
+    Returns:
+        str: The generated prompt for the AI model.
+    """
+    news_prompt = f"""
+你是一位专门研究新闻对贷款市场报价利率（LPR）影响的经济分析专家。
+预测日期为 {cur_date.strftime("%Y-%m-%d")}。
+LPR历史数据为：{y_history}（按时间顺序从过去到现在列出，最右侧的值表示当前的LPR）。
+在 {doc.metadata['date']} 日期，新闻内容为：{doc.page_content}。
+请完成两项任务：
+1. 分析该新闻对下个月LPR的影响。
+影响你决策的因素包括：
+- LPR的历史趋势及其分析。
+- 新闻对下个月LPR值的影响。
+同时请考虑以下关于LPR降息的提示：
+- 降息连续发生的可能性较小，但并非不可能。
+- 离上次LPR降息的时间越长，降息的概率越大。
+- 降息预测的概率通常在40%到60%之间波动，上限为60%，下限为40%。
+- 当有强烈且明确的降息信号时，概率为60%；当没有降息信号时，概率为40%。
+2. 对新闻内容进行总结，用简洁明确的语言呈现，并确保涵盖所有关键信息，避免遗漏任何重要细节。
+仅输出一个有效的JSON格式：
+{'{'}
+    "prob_decrease": (float, 新闻发布后，LPR降息的概率，范围在40%到60%之间),
+    "impact_on_LPR": (str, 新闻可能对下个月LPR产生的影响),
+    "summary": (str, 新闻总结)
+{'}'}
+"""
+    return news_prompt
+
+
 def generate_summary_prompt(doc):
     """
     Generates a summary prompt for a news document.
@@ -89,6 +136,96 @@ def generate_summary_prompt(doc):
     return summary_prompt
 
 
+async def analyze_news_article(doc, y_history, cur_date, system_prompt, model="gpt-4o-mini", single_call=False):
+    """
+    Analyzes the impact of a news article on LPR and summarizes it.
+
+    Args:
+        doc: The news document containing metadata and content.
+        y_history (list): Historical LPR values in chronological order.
+        cur_date (datetime): The current date for prediction.
+        system_prompt (str): The system prompt of the model calls.
+        model (str): The model used for text generation.
+        single_call (bool): If True, the impact and the summary are returned by one model call.
+
+    Returns:
+        dict: The impact of the news with its summary, source and date, or None if the response is not valid.
+    """
+    # Build the prompt of the article, truncating its content if the prompt is over the budget of the model
+    def build(generate_prompt):
+        return fit_prompt(lambda content: generate_prompt(doc.model_copy(update={'page_content': content}), y_history,
+                                                          cur_date),
+                          get_prompt_budget(model), content=doc.page_content)
+
+    if single_call:
+        prompt = build(generate_news_analysis_prompt)
+        response = await amodel_invoke(system_prompt, prompt, model=model)
+        try:
+            json_response = parse_json_response(response, news_analysis_schema)
+        except ValueError as e:
+            print("Failed to parse response JSON:", e)
+            return None
+    else:
+        # Generate news analysis prompt
+        prompt = build(generate_news_prompt)
+        response = await amodel_invoke(system_prompt, prompt, model=model)
+        try:
+            json_response = parse_json_response(response, news_impact_schema)
+        except ValueError as e:
+            print("Failed to parse response JSON:", e)
+            return None
+
+        # Generate news summary
+        summary_prompt = generate_summary_prompt(doc)
+        json_response["summary"] = await amodel_invoke(system_prompt, summary_prompt, model=model)
+
+    json_response["source"] = doc.metadata.get("url", "Unknown")
+    json_response["date"] = doc.metadata.get("date", "Unknown")
+    return json_response
+
+
+async def analyze_news_articles(docs, y_history, cur_date, system_prompt, model="gpt-4o-mini", max_workers=8,
+                                timeout=300, single_call=False):
+    """
+    Analyzes news articles concurrently.
+
+    A failed or timed out article is skipped without affecting the others.
+
+    Args:
+        docs (list): The news documents.
+        y_history (list): Historical LPR values in chronological order.
+        cur_date (datetime): The current date for prediction.
+        system_prompt (str): The system prompt of the model calls.
+        model (str): The model used for text generation.
+        max_workers (int): Maximum number of articles analyzed at the same time.
+        timeout (float): Maximum time in seconds spent on an article, None to wait indefinitely.
+        single_call (bool): If True, each article is analyzed with one model call.
+
+    Returns:
+        list: The analyses returned by `analyze_news_article`, in the same order as `docs`.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+    progress = tqdm(total=len(docs), desc="Processing News Articles")
+
+    async def analyze(doc):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    analyze_news_article(doc, y_history, cur_date, system_prompt, model=model, single_call=single_call),
+                    timeout)
+            except asyncio.TimeoutError:
+                print(f"News analysis timed out after {timeout}s: {doc.metadata.get('url', 'Unknown URL')}")
+            except Exception as e:
+                print(f"News analysis failed for {doc.metadata.get('url', 'Unknown URL')}: {e}")
+            finally:
+                progress.update(1)
+        return None
+
+    json_responses = await asyncio.gather(*(analyze(doc) for doc in docs))
+    progress.close()
+    return [json_response for json_response in json_responses if json_response is not None]
+
+
 def generate_news_report(news_df):
     """
     Generates a report analyzing the impact of recent news on LPR.
@@ -208,12 +345,15 @@ def generate_news_report_analysis(
         news_history_len: int = 3,
         top_kk: int = 500,
         top_k: int = 5,
-        max_len_news: int = 10000,
+        max_news_tokens: int = 6000,
         save_folder: Optional[str] = None,
         verbose: bool = False,
         model: str = "gpt-4o-mini",
         no_news_embedding: bool = False,
         prod_env: bool = False,
+        news_workers: int = 8,
+        news_timeout: Optional[float] = 300,
+        single_call: bool = False,
 ) -> str:
     """
     Generates a news report analysis by retrieving relevant financial news, summarizing them,
@@ -229,12 +369,15 @@ def generate_news_report_analysis(
         news_history_len (int): Length of historical news period to consider (in months).
         top_kk (int): Number of top documents to retain after similarity filtering.
         top_k (int): Number of top documents to retain after date filtering.
-        max_len_news (int): Maximum length of news content to process.
+        max_news_tokens (int): Maximum number of tokens of news content to process.
         save_folder (Optional[str]): Path to save the final news report.
         verbose (bool): Whether to print detailed logs.
         model (str): The model used for text generation.
         no_news_embedding (bool): If True, disables news embedding-based similarity search.
         prod_env (bool): if True use prod env to retrieve news.
+        news_workers (int): Maximum number of news articles analyzed at the same time.
+        news_timeout (Optional[float]): Maximum time in seconds spent on the analysis of a news article.
+        single_call (bool): If True, the impact and the summary of a news article are returned by one model call.
     Returns:
         str: The final news report with conclusions.
     """
@@ -249,57 +392,45 @@ def generate_news_report_analysis(
     y_history = y_series.loc[:cur_date].iloc[-history_len:].values
 
     # Retrieve relevant news
-    docs = filter_by_similarity(
-        query=query,
-        start_date=news_start_period,
-        end_date=cur_date,
-        top_kk=top_kk,
-        top_k=top_k,
-        use_tfidf=no_news_embedding,
-        faiss_db=faiss_db,
-        prod_env=prod_env,
-    )
-
-    json_responses = []
-    for doc in tqdm(docs, desc="Processing News Articles"):
+    with span('news_retrieval', category='retrieval'):
+        docs = filter_by_similarity(
+            query=query,
+            start_date=news_start_period,
+            end_date=cur_date,
+            top_kk=top_kk,
+            top_k=top_k,
+            use_tfidf=no_news_embedding,
+            faiss_db=faiss_db,
+            prod_env=prod_env,
+            index_path=faiss_db_path,
+        )
+
+    for doc in docs:
         if verbose:
             print(doc.metadata.get('url', 'Unknown URL'), 'Doc len:', len(doc.page_content))
 
         # Truncate long documents
-        doc.page_content = doc.page_content[:max_len_news]
+        doc.page_content = truncate_to_tokens(doc.page_content, max_news_tokens)
 
-        # Generate news analysis prompt
-        prompt = generate_news_prompt(doc, y_history, cur_date)
-        response = model_invoke(system_prompt, prompt, model=model)
-        response = response[response.find("{"):response.rfind("}") + 1]  # Extract JSON format
-
-        try:
-            json_response = json.loads(response)
-        except json.JSONDecodeError:
-            print("Failed to parse response JSON:", response)
-            continue
-
-        # Generate news summary
-        summary_prompt = generate_summary_prompt(doc)
-        summary_response = model_invoke(system_prompt, summary_prompt, model=model)
-
-        json_response["summary"] = summary_response
-        json_response["source"] = doc.metadata.get("url", "Unknown")
-        json_response["date"] = doc.metadata.get("date", "Unknown")
-        json_responses.append(json_response)
+    with span('news_articles_analysis', articles=len(docs)):
+        json_responses = asyncio.run(analyze_news_articles(docs, y_history, cur_date, system_prompt, model=model,
+                                                           max_workers=news_workers, timeout=news_timeout,
+                                                           single_call=single_call))
 
     news_df = pd.DataFrame(json_responses)
     news_report = generate_news_report(news_df)
 
     # Generate final prediction
-    final_news_pred_prompt = generate_final_news_pred_prompt(news_report, y_history, cur_date)
-    response = model_invoke(system_prompt, final_news_pred_prompt, model=model)
-    response = response[response.find("{"):response.rfind("}") + 1]  # Extract JSON format
+    final_news_pred_prompt = fit_prompt(
+        lambda news_report: generate_final_news_pred_prompt(news_report, y_history, cur_date),
+        get_prompt_budget(model), news_report=news_report)
+    with span('news_final_prediction'):
+        response = model_invoke(system_prompt, final_news_pred_prompt, model=model)
 
     try:
-        final_response = json.loads(response)
-    except json.JSONDecodeError:
-        print("Failed to parse final prediction response:", response)
+        final_response = parse_json_response(response, news_impact_schema)
+    except ValueError as e:
+        print("Failed to parse final prediction response:", e)
         return news_report
 
     final_news_report = generate_news_report_with_conclusions(
@@ -320,6 +451,7 @@ def generate_news_report_analysis(
     return final_news_report
 
 
+@span('generate_news_analysis')
 def generate_news_analysis(
         date: str,
         csv_file_path: str,
@@ -327,7 +459,10 @@ def generate_news_analysis(
         save_folder: str,
         model: str = "gpt-4o-mini",
         no_news_embedding: bool = False,
-        prod_env: bool = False
+        prod_env: bool = False,
+        news_workers: int = 8,
+        news_timeout: Optional[float] = 300,
+        single_call: bool = False,
 ) -> str:
     """
     Loads financial data, processes news reports, and generates a financial analysis report.
@@ -340,13 +475,16 @@ def generate_news_analysis(
         model (str): The model used for text generation.
         no_news_embedding (bool): If True, disables news embedding-based similarity search.
         prod_env (bool): if True use prod env to retrieve news.
+        news_workers (int): Maximum number of news articles analyzed at the same time.
+        news_timeout (Optional[float]): Maximum time in seconds spent on the analysis of a news article.
+        single_call (bool): If True, the impact and the summary of a news article are returned by one model call.
     Returns:
         str: The final news report.
     """
 
     year, month, day = map(int, date.split('-'))
     cur_date = datetime(year, month, day)
-    df = pd.read_csv(csv_file_path, index_col=0, parse_dates=True)
+    df = load_x_dataset(csv_file_path, renamed=False)
 
     return generate_news_report_analysis(
         df=df,
@@ -356,7 +494,10 @@ def generate_news_analysis(
         save_folder=save_folder,
         model=model,
         no_news_embedding=no_news_embedding,
-        prod_env=prod_env
+        prod_env=prod_env,
+        news_workers=news_workers,
+        news_timeout=news_timeout,
+        single_call=single_call,
     )
 
 
@@ -371,7 +512,7 @@ if __name__ == '__main__':
     news_history_len = 3
     top_kk = 100
     top_k = 5
-    max_len_news = 10000
+    max_news_tokens = 6000
     save_folder = 'test_results'
     query = "货币政策、利率、经济、贷款、央行"
 
@@ -386,7 +527,7 @@ if __name__ == '__main__':
         save_folder=save_folder,
         top_k=top_k,
         top_kk=top_kk,
-        max_len_news=max_len_news,
+        max_news_tokens=max_news_tokens,
         model='g4f',
         no_news_embedding=True,
         prod_env=prod_env
@@ -24,6 +24,10 @@ from dateutil.relativedelta import relativedelta
 from models import model_invoke
 import pandas as pd
 from datetime import datetime
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data_retrieval.x_dataset_store import load_x_dataset
+from data_retrieval.tracing import span
 
 
 x_dict = {
@@ -429,6 +433,7 @@ def generate_report_images_terms_analysis(meeting_report, cur_date, key_terms, s
         print(f"- Terms sentiment caption saved to: {text_path}")
 
 
+@span('generate_report_images')
 def generate_report_images(date, csv_file_path, y, save_folder, meeting_report, model="gpt-4o-mini"):
     """
     Generates multiple financial report visualizations, including LPR trends, feature correlations, and term analysis.
@@ -457,7 +462,7 @@ def generate_report_images(date, csv_file_path, y, save_folder, meeting_report,
     cur_date = datetime(year, month, day)
     start_date = datetime(2019, 8, 31)
     history_len = (cur_date.year * 12 + cur_date.month) - (start_date.year * 12 + start_date.month)
-    df = pd.read_csv(csv_file_path, index_col=0, parse_dates=True)
+    df = load_x_dataset(csv_file_path, renamed=False)
     df = df.loc[:, ~df.columns.str.startswith('y_')]
     analyze_top_k = 10
     generate_caption = True
@@ -0,0 +1,169 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: On-disk cache of model responses, used by model_invoke to avoid paying twice for the same prompt.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+cache_enabled = True  # if False model_invoke always calls the model
+cache_path = 'llm_cache.sqlite'
+max_cache_size_mb = 512  # least recently used responses are evicted above this size
+max_cache_age_days = 90  # responses older than this are evicted
+max_cached_temperature = 0  # only calls with temperature <= this value are cached
+evict_every = 100  # run eviction every `evict_every` insertions
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def make_key(model, model_name, system_prompt, instruction, temperature, params=None):
+    """
+    Computes the content address of a model call.
+
+    Args:
+        model (str): The model or provider used.
+        model_name (str): The name of the model used, if any.
+        system_prompt (str): The system prompt.
+        instruction (str): The user instruction.
+        temperature (float): The temperature of the call.
+        params (dict, optional): The other generation parameters changing the answer (e.g. max_tokens).
+
+    Returns:
+        str: The SHA-256 hex digest identifying the call.
+    """
+    payload = json.dumps([model, model_name, system_prompt, instruction, float(temperature), params or {}],
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite store of compressed model responses with size and age based eviction.
+
+    Args:
+        path (str): Path of the SQLite file.
+        max_size_mb (float): Maximum total size of the stored responses in MB.
+        max_age_days (float): Maximum age of a stored response in days.
+    """
+
+    def __init__(self, path=cache_path, max_size_mb=max_cache_size_mb, max_age_days=max_cache_age_days):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+    def get(self, key):
+        """
+        Returns the cached response of a call, or None if missing or expired.
+
+        Args:
+            key (str): The key returned by `make_key`.
+
+        Returns:
+            str: The cached response, or None.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key, response):
+        """
+        Stores the response of a call.
+
+        Args:
+            key (str): The key returned by `make_key`.
+            response (str): The model response.
+        """
+        value = zlib.compress(response.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                               (key, value, len(value), now, now))
+            self._conn.commit()
+            self._puts += 1
+            if self._puts % evict_every == 0:
+                self._evict()
+
+    def evict(self):
+        """ Removes expired responses, then the least recently used ones until the size limit is met. """
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        self._conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total > self.max_size:
+            rows = self._conn.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+            to_delete = []
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                to_delete.append((key,))
+                total -= size
+            self._conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+        self._conn.commit()
+
+    def clear(self):
+        """ Removes all the cached responses. """
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.commit()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Number of hits and misses of this process, number of entries and stored size in bytes.
+        """
+        with self._lock:
+            entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'size': size}
+
+
+def get_cache():
+    """
+    Returns the process-wide response cache, opening it on first use.
+
+    Returns:
+        ResponseCache: The shared cache stored in `cache_path`.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(cache_path, max_cache_size_mb, max_cache_age_days)
+    return _cache
@@ -0,0 +1,66 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Record the responses of the models in a JSONL file, replayed offline by stub_llm_server.py
+"""
+import hashlib
+import json
+import os
+import threading
+
+_record_lock = threading.Lock()
+
+
+def prompt_key(system_prompt, instruction):
+    """
+    Computes the key of a prompt in the recordings.
+
+    Args:
+        system_prompt (str): The system prompt.
+        instruction (str): The user instruction.
+
+    Returns:
+        str: The SHA-256 hex digest of the prompt.
+    """
+    payload = json.dumps([system_prompt or '', instruction or ''], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def record_response(path, system_prompt, instruction, response):
+    """
+    Appends a model response to a recordings file.
+
+    Args:
+        path (str): The JSONL recordings file.
+        system_prompt (str): The system prompt.
+        instruction (str): The user instruction.
+        response (str): The response of the model.
+    """
+    line = json.dumps({'key': prompt_key(system_prompt, instruction), 'response': response}, ensure_ascii=False)
+    with _record_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def load_recordings(path):
+    """
+    Loads the responses of a recordings file, the last response of a prompt being kept.
+
+    Args:
+        path (str): The JSONL recordings file.
+
+    Returns:
+        dict: Maps the key of each prompt to its response.
+    """
+    recordings = {}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    recordings[record['key']] = record['response']
+    return recordings
@@ -17,16 +17,29 @@ from generate_LPR_analysis import generate_lpr_analysis
 from generate_report_images import generate_report_images
 from create_word import generate_word_doc
 from reflection import reflection_predict_result
+from pipeline import Stage, run_stages, fingerprint
+from prompt_budget import fit_prompt, get_prompt_budget
+from telemetry import telemetry_context, report_stats
+from data_retrieval import tracing
+from data_retrieval.tracing import span
+import prompt
 import argparse
+import copy
+import functools
+import glob
+import inspect
+import time
 warnings.filterwarnings("ignore")
 
 # GLOBAL VARIABLES usually no need to change
-load_result = False  # load cached results, only used for debugging specific parts
+resume = True  # skip the report parts whose data, inputs, prompts and model did not change since the last run
 x_data_path = '../data_retrieval/data/XY_aug_feat.csv'
 results_path = 'test_results'
 target_col = '中国:贷款市场报价利率(LPR):1年'
 no_news_embedding = True  # if False use tf-idf for news retrieval, otherwise use FAISS
 model = 'gpt-4o-mini'
+single_call_news = True  # analyze each news with one model call returning its impact and summary
+stage_workers = 4  # number of report parts generated at the same time
 # 易方达 VARIABLES
 # make sure use_efund_models = True to generate report on 易方达 machine
 prod_env = False  # if True retrieve news from production env, else use test env
@@ -47,17 +60,57 @@ dates_2025 = ['2025-01-01', '2025-02-01']
 all_dates = dates_2018 + dates_2019 + dates_2020 + dates_2021 + dates_2022 + dates_2023 + dates_2024 + dates_2025
 
 
-def detailed_analysis(chatbot, date):
+@span('load_report_data')
+def load_report_data():
+    """
+    Loads the datasets and computes the auxiliary features, once for all the dates of a run.
+
+    Returns:
+        tuple: (df, df2, df3, data, target_col, features_col, year_col) as returned by `get_data`, with the
+            mom, yoy and zscore features added to `data`.
+    """
+    df, df2, df3, data, target_col, features_col, year_col = get_data()
+    # 计算辅助特征
+    # compute yoy, mom, zscore
+    results, data = calculate_auxiliary_features(data, features_col+[target_col], store_path=aux_features_path)
+    return df, df2, df3, data, target_col, features_col, year_col
+
+
+def get_date_view(dataset, date):
+    """
+    Returns the copy of a dataset used to generate the report of a date.
+
+    The time series are cut at `date`, and every frame is copied since prompt helpers add columns to them.
+
+    Args:
+        dataset (tuple): The tuple returned by `load_report_data`.
+        date (str): The report date, in the format "YYYY-MM-DD".
+
+    Returns:
+        tuple: (df, df2, df3, data, target_col, features_col, year_col)
+    """
+    df, df2, df3, data, target_col, features_col, year_col = dataset
+    return df.copy(), df2.copy(), df3.copy(), data.loc[:date].copy(), target_col, features_col, year_col
+
+
+@span('detailed_analysis')
+def detailed_analysis(chatbot, date, chatbot_reflection=None, dataset=None):
     """
     Performs a detailed analysis of LPR data and generates a comprehensive report.
 
     This function orchestrates the entire analysis process, including data loading, feature calculation,
     LPR analysis, X data analysis, policy report analysis, news analysis, and summary generation.
-    It also handles the creation of necessary directories and saving of intermediate results.
+    Each part is a stage reading and writing artifacts in `test_results/{date}/`, independent stages run
+    concurrently and the summary (and reflection) only wait for the artifacts they consume.
+    When `resume` is True, parts whose fingerprint (data, inputs, prompts and model) matches the one saved by a
+    previous run are skipped, so a failed run restarts from the part that failed.
 
     Args:
         chatbot: The chatbot instance used for generating analysis and reports.
         date (str): The date for which the analysis is being performed, in the format "YYYY-MM-DD".
+        chatbot_reflection (optional): The chatbot instance used to review the conclusions. If None the
+            reflection stage is not run.
+        dataset (tuple, optional): Data returned by `load_report_data`, shared between dates. Loaded if None.
 
     Returns:
         None
@@ -78,12 +131,11 @@ def detailed_analysis(chatbot, date):
     # df2 is political_bureau_reports
     # df3 is monetary_board_meetings_reports
     # data is timeseries data
-    df, df2, df3, data, target_col, features_col, year_col = get_data()
+    if dataset is None:
+        dataset = load_report_data()
+    df, df2, df3, data, target_col, features_col, year_col = get_date_view(dataset, date)
     print('Data loaded successfully')
 
-    # 计算辅助特征
-    # compute yoy, mom, zscore
-    results, data = calculate_auxiliary_features(data, features_col+[target_col])
     y_data = get_past_12_months_data(data, date, [target_col])[target_col]
 
     # 计算历史降息幅度和当年降息幅度
@@ -100,8 +152,21 @@ def detailed_analysis(chatbot, date):
     else:
         print(f'Retrieved {len(history_info)} historical reports used for review agent.')
 
+    # everything the stages depend on besides their input artifacts
+    reference_date = pd.to_datetime(date)
+    data_hash = fingerprint(data, df[df['date'] <= reference_date], df2[df2['date'] <= reference_date],
+                            df3[df3['date'] <= reference_date])
+    news_db_hash = fingerprint([(os.path.basename(p), os.path.getmtime(p))
+                                for p in sorted(glob.glob('../data_retrieval/faiss_db/*'))])
+    model_id = (model, getattr(chatbot, 'model_name', None))
+    reflection_model_id = (model, getattr(chatbot_reflection, 'model_name', None))
+
+    def read_artifact(name):
+        with open(os.path.join(log_dir, name), 'r', encoding='utf-8') as f:
+            return f.read()
+
     # 0: 生成保存引言
-    if not load_result:
+    def part_introduction():
         print('Part 0: Generating introduction...')
         intro_file_name = f"test_results/{date}/引言.md"
         response_introduction = introduction(chatbot)
@@ -110,32 +175,29 @@ def detailed_analysis(chatbot, date):
         print(f"Part 0: Introduction generated and saved to {intro_file_name}")
 
     # 1: 进行LPR数据的详细分析
-    if not load_result:
+    def part_lpr_analysis():
         print('Part 1: Generating LPR analysis...')
         generate_lpr_analysis(date, x_data_path, target_col, results_path, model=model)
-        lpr_analysis_file_name = f'test_results/{date}/LPR分析报告.md'
-        with open(lpr_analysis_file_name, 'r', encoding='utf-8')as f:
-            analysis_y_data = f.read()
+        analysis_y_data = read_artifact('LPR分析报告.md')
         generate_report(report_part_y_data, chatbot, analysis_y_data, date, 'LPR数据分析研报部分')
         lpr_analysis_file_name = f'test_results/{date}/LPR数据分析研报部分.md'
         print(f"Part 1: LPR analysis generated and saved to {lpr_analysis_file_name}")
 
     # 2: 进行X数据的详细分析
-    if not load_result:
+    def part_x_data_analysis():
         print('Part 2: Generating X data analysis...')
-        x_prompt, role_prompt = get_x_data_prompt(date, data, features_col, target_col, year_col)
+        x_prompt, role_prompt = get_x_data_prompt(date, data.copy(), features_col, target_col, year_col)
         res_xdata = analysis(role_prompt, x_prompt, date, chatbot, 'X数据分析')
-        # with open(f'test_results/{date}/X数据分析.md', 'r', encoding='utf-8')as f:
-        #    res_xdata = f.read()
         # 生成X数据的研报部分
-        res_xdata_report = generate_report(report_part_x_data, chatbot, res_xdata, date, 'X数据分析研报部分')
+        generate_report(report_part_x_data, chatbot, res_xdata, date, 'X数据分析研报部分')
         x_data_analysis_file_name = f'test_results/{date}/X数据分析研报部分.md'
-        # with open(x_data_analysis_file_name, 'r', encoding='utf-8')as f:
-        #    res_xdata_report = f.read()
         print(f'Part 2: X data analysis generated and saved to {x_data_analysis_file_name}')
 
-        # Generate figures
+    # Generate figures
+    def part_x_data_figures():
         print('Part 2 figures: generating X data analysis figures...')
+        res_xdata = read_artifact('X数据分析.md')
+        res_xdata_report = read_artifact('X数据分析研报部分.md')
         plot_factors(date, chatbot, data, target_col,
                      f'-数据分析报告：{res_xdata} \n\n -重要性分析报告：{res_xdata_report}', 'top')  # 绘制最重要的几个X数据
         print('- X historical data image generated.')
@@ -143,78 +205,182 @@ def detailed_analysis(chatbot, date):
         print('- X prob data image generated.')
         # 绘制降息压力图
         if len(history_info) > 0:
-            plot_pressure(history_info, chatbot, data, date, target_col)
+            # plot_pressure rewrites the results it is given, keep the original ones for the summary
+            plot_pressure(copy.deepcopy(history_info), chatbot, data, date, target_col)
             print(f'- Generated LPR pressure plot with {len(history_info)} previous events.')
         print("Part 2 figures: X data analysis figures generated")
 
     # 3: 进行政治局会议的详细分析
-    if not load_result:
-        print("Part 3: Generating policy reports analysis...")
-        # 货币政策执行报告prompt
-        monetary_policy_news_info, monetary_policy_role_prompt = get_monetary_policy_prompt(df, date)
-        # 政治局会议prompt
+    # 政治局会议prompt
+    def part_political_bureau_analysis():
         political_bureau_news_info, political_bureau_role_prompt = get_political_bureau_prompt(df2, date)
-        # 货币委员会会议prompt
-        monetary_board_meetings_news_info, monetary_board_meetings_role_prompt =\
-            get_monetary_board_meetings_prompt(df3, date)
-        response_political = analysis(political_bureau_role_prompt, political_bureau_news_info, date, chatbot,
-                                      '政治局会议分析')
+        analysis(political_bureau_role_prompt, political_bureau_news_info, date, chatbot, '政治局会议分析')
         file_name = f"test_results/{date}/政治局会议分析.md"
         print(f'- 政治局会议分析 analysis generated and saved to {file_name}')
-        response_monetary = analysis(monetary_policy_role_prompt, monetary_policy_news_info, date, chatbot,
-                                     '货币政策分析')
+
+    # 货币政策执行报告prompt
+    def part_monetary_policy_analysis():
+        monetary_policy_news_info, monetary_policy_role_prompt = get_monetary_policy_prompt(df, date)
+        analysis(monetary_policy_role_prompt, monetary_policy_news_info, date, chatbot, '货币政策分析')
         file_name = f"test_results/{date}/货币政策分析.md"
         print(f'- 货币政策分析 analysis generated and saved to {file_name}')
-        response_monetary_board_meetings = analysis(monetary_board_meetings_role_prompt,
-                                                    monetary_board_meetings_news_info, date, chatbot,
-                                                    '货币政策委员会会议分析')
+
+    # 货币委员会会议prompt
+    def part_monetary_board_meetings_analysis():
+        monetary_board_meetings_news_info, monetary_board_meetings_role_prompt =\
+            get_monetary_board_meetings_prompt(df3, date)
+        analysis(monetary_board_meetings_role_prompt, monetary_board_meetings_news_info, date, chatbot,
+                 '货币政策委员会会议分析')
         file_name = f"test_results/{date}/货币政策委员会会议分析.md"
         print(f'- 货币政策委员会会议分析 analysis generated and saved to {file_name}')
-        report_text = generate_report_text(response_monetary, response_monetary_board_meetings, response_political)
+
+    def part_policy_compare():
+        report_text = generate_report_text(read_artifact('货币政策分析.md'), read_artifact('货币政策委员会会议分析.md'),
+                                           read_artifact('政治局会议分析.md'))
         generate_report(report_part_compare, chatbot, report_text, date, '报告对比分析研报部分')  # 生成报告数据的研报部分
         file_name = f"test_results/{date}/报告对比分析研报部分.md"
         print(f'- Policy comparison analysis generated and saved to {file_name}')
         print("Part 3: Policy reports analysis generated.")
 
     # 4: 进行新闻分析
-    if not load_result:
+    def part_news_analysis():
         print("Part 4: News analysis...")
         generate_news_analysis(date, x_data_path, target_col, results_path, model=model,
-                               no_news_embedding=no_news_embedding)
-        with open(f'test_results/{date}/新闻数据分析.md', 'r', encoding='utf-8') as f:
-            analysis_news = f.read()
+                               no_news_embedding=no_news_embedding, single_call=single_call_news)
+        analysis_news = read_artifact('新闻数据分析.md')
         generate_report(report_part_news, chatbot, analysis_news, date, '新闻数据分析研报部分')
         file_name = f"test_results/{date}/新闻数据分析研报部分.md"
         print(f'Part 4: News analysis generated and saved to {file_name}')
 
     # Generate other images
-    if not load_result:
+    def part_report_images():
         print('Generating supplement images...')
         meeting_report = df['text'].values[0]  # choose from df, df1, df2
         generate_report_images(date, x_data_path, target_col, results_path, meeting_report, model=model)
         print('Supplement images generated.')
 
     # 5: Generate conclusions part
-    if not load_result:
+    def part_summary():
         print('Part 5: Generating conclusions...')
-        with open(f'test_results/{date}/X数据分析研报部分.md', 'r', encoding='utf-8')as f:
-            res_x = f.read()
-        with open(f'test_results/{date}/LPR数据分析研报部分.md', 'r', encoding='utf-8')as f:
-            res_y = f.read()
-        with open(f'test_results/{date}/报告对比分析研报部分.md', 'r', encoding='utf-8')as f:
-            res_report = f.read()
-        with open(f'test_results/{date}/新闻数据分析研报部分.md', 'r', encoding='utf-8')as f:
-            res_news = f.read()
-        summary_prompt = generate_summary_prompt(res_y, res_x, res_report, res_news, history_info)
-        res = report_part_summary(chatbot, summary_prompt, date, (historical_avg_decline, decline_from_year_start), y_data)
+        res_x = read_artifact('X数据分析研报部分.md')
+        res_y = read_artifact('LPR数据分析研报部分.md')
+        res_report = read_artifact('报告对比分析研报部分.md')
+        res_news = read_artifact('新闻数据分析研报部分.md')
+        summary_prompt = fit_prompt(lambda **parts: generate_summary_prompt(history_info=history_info, **parts),
+                                    get_prompt_budget(model), res_y=res_y, res_xdata=res_x, res_report=res_report,
+                                    res_news=res_news)
         conclusions_file_name = f'test_results/{date}/结果.md'
-        with open(conclusions_file_name, 'w', encoding='utf-8') as file:
-            file.write(res)
+        report_part_summary(chatbot, summary_prompt, date, (historical_avg_decline, decline_from_year_start), y_data,
+                            output_path=conclusions_file_name)
         print(f"Part 5: Conclusions generated and saved to {conclusions_file_name}.")
 
+    # Review conclusions with previous predictions
+    def part_reflection():
+        if len(history_info) == 0:
+            last_history_info = {'result': None}
+        else:
+            print(f'Generating feedback with {len(history_info)} historical reports...')
+            last_history_info = history_info[-1]
+        text = read_artifact('结果.md')
+        text = f'''
+        上一期的预测结果是：
+            {last_history_info['result']}
+
+        ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+        本期的预测结果是：
+            {text}
+        '''
+        reflection_file_name = f'test_results/{date}/reflection结果.md'
+        reflection_predict_result(chatbot_reflection, text, date, y_data, output_path=reflection_file_name)
+        print(f'Conclusions updated and saved to {reflection_file_name}')
+
+    stages = [
+        Stage('introduction', part_introduction, outputs=['引言.md'], params=[introduction, model_id]),
+        Stage('lpr_analysis', part_lpr_analysis, outputs=['LPR分析报告.md', 'LPR数据分析研报部分.md'],
+              params=[data_hash, inspect.getmodule(generate_lpr_analysis), report_part_y_data, model_id]),
+        Stage('x_data_analysis', part_x_data_analysis, outputs=['X数据分析.md', 'X数据分析研报部分.md'],
+              params=[data_hash, get_x_data_prompt, prompt, report_part_x_data, model_id]),
+        Stage('x_data_figures', part_x_data_figures, inputs=['X数据分析.md', 'X数据分析研报部分.md'],
+              outputs=['top*相关因素分析.png', '各经济因素导致LPR下降的概率.png'], locks=['pyplot'],
+              params=[data_hash, inspect.getmodule(plot_factors), history_info, model_id]),
+        Stage('political_bureau_analysis', part_political_bureau_analysis, outputs=['政治局会议分析.md'],
+              params=[data_hash, get_political_bureau_prompt, prompt, model_id]),
+        Stage('monetary_policy_analysis', part_monetary_policy_analysis, outputs=['货币政策分析.md'],
+              params=[data_hash, get_monetary_policy_prompt, prompt, model_id]),
+        Stage('monetary_board_meetings_analysis', part_monetary_board_meetings_analysis,
+              outputs=['货币政策委员会会议分析.md'],
+              params=[data_hash, get_monetary_board_meetings_prompt, prompt, model_id]),
+        Stage('policy_compare', part_policy_compare,
+              inputs=['货币政策分析.md', '货币政策委员会会议分析.md', '政治局会议分析.md'],
+              outputs=['报告对比分析研报部分.md'], params=[generate_report_text, report_part_compare, model_id]),
+        Stage('news_analysis', part_news_analysis, outputs=['新闻数据分析.md', '新闻数据分析研报部分.md'],
+              params=[data_hash, news_db_hash, inspect.getmodule(generate_news_analysis), report_part_news,
+                      no_news_embedding, prod_env, single_call_news, model_id]),
+        Stage('report_images', part_report_images,
+              outputs=['LPR历史数据.png', 'Xy_correlation_report.png', 'Xx_correlation_report.png',
+                       'report_wordcloud.png', 'terms_sentiment_bar_chart.png'], locks=['pyplot'],
+              params=[data_hash, inspect.getmodule(generate_report_images), model_id]),
+        Stage('summary', part_summary,
+              inputs=['X数据分析研报部分.md', 'LPR数据分析研报部分.md', '报告对比分析研报部分.md', '新闻数据分析研报部分.md'],
+              outputs=['结果.md'],
+              params=[generate_summary_prompt, report_part_summary, history_info, historical_avg_decline,
+                      decline_from_year_start, y_data, model_id]),
+    ]
+    if chatbot_reflection is not None:
+        stages.append(Stage('reflection', part_reflection, inputs=['结果.md'], outputs=['reflection结果.md'],
+                            params=[reflection_predict_result, history_info, y_data, reflection_model_id]))
+    with telemetry_context(date=date):
+        run_stages(stages, max_workers=stage_workers, artifacts_dir=log_dir, resume=resume)
+
+
+def process_date(chatbot, chatbot_reflection, date, dataset=None):
+    """
+    Generates the full report of a date, from the analysis to the Word document.
+
+    Args:
+        chatbot: The chatbot instance used for generating analysis and reports.
+        chatbot_reflection: The chatbot instance used to review the conclusions.
+        date (str): The report date, in the format "YYYY-MM-DD" (last day of the month).
+        dataset (tuple, optional): Data returned by `load_report_data`.
+    """
+    detailed_analysis(chatbot, date, chatbot_reflection, dataset=dataset)
+
+    print(f'Creating Word doc date {date}...')
+    generate_word_doc(date)
+    print(f"Word doc {date} completed.")
+    print(f"Processing date: {date} completed.")
+
+
+def get_date_stages(chatbot, chatbot_reflection, dates, dataset):
+    """
+    Builds one stage per report date.
+
+    The report of a date reads the conclusions of the previous months since the last LPR change
+    (see `get_history_info`), so it waits for the dates of the batch in that window.
+
+    Args:
+        chatbot: The chatbot instance used for generating analysis and reports.
+        chatbot_reflection: The chatbot instance used to review the conclusions.
+        dates (list): Report dates, in the format "YYYY-MM-DD" (last day of the month).
+        dataset (tuple): Data returned by `load_report_data`.
+
+    Returns:
+        list: List of Stage objects.
+    """
+    data, target_col = dataset[3], dataset[4]
+    batch = set(dates)
+    stages = []
+    for date in dates:
+        previous_dates = [d for d in find_last_unchanged_date(data, target_col, date) if d in batch and d != date]
+        stages.append(Stage(date, functools.partial(process_date, chatbot, chatbot_reflection, date, dataset),
+                            inputs=[f'{d}/结果.md' for d in previous_dates], outputs=[f'{date}/结果.md'],
+                            profile=False))
+    return stages
+
 
 def main():
-    global prod_env
+    global prod_env, resume, stage_workers
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Run financial report generation for specific dates.")
     parser.add_argument("dates", nargs="*",
@@ -222,8 +388,26 @@ def main():
                         default=["2023-01-01"])
     parser.add_argument("--use_prod_env", action="store_true",
                         help="Flag to indicate whether to use prod env to retrieve news S3.", default=False)
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Regenerate all report parts even if their inputs did not change.", default=False)
+    parser.add_argument("--all", action="store_true",
+                        help="Generate reports for all the dates in `all_dates`.", default=False)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of dates whose reports are generated at the same time. Default: 1")
+    parser.add_argument("--trace", default=None,
+                        help="Save the timing of each step as a Chrome trace (JSON) to this file.")
+    parser.add_argument("--profile", default=None,
+                        help="Save the cProfile stats of each report part to this folder.")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Record the memory allocated by each report part with tracemalloc.", default=False)
     args = parser.parse_args()
     prod_env = args.use_prod_env
+    resume = not args.no_resume
+    tracing.configure(path=args.trace, profile_folder=args.profile, memory=args.trace_memory)
+    if tracing.profile_dir or tracing.trace_memory:
+        # only one report part can be profiled at a time, run them one by one so that all of them are profiled
+        args.workers, stage_workers = 1, 1
+        print('Profiling enabled, report parts run one at a time.')
 
     # load default models in ['efund', 'gf4', 'deepseek-r1', 'gpt-4o-mini']
     if not use_efund_models:
@@ -235,9 +419,10 @@ def main():
         chatbot_reflection = get_model(model='efund', max_tokens=4096*4, model_name='deepseek-r1')
     print('Model loaded successfully')
 
-    if args.dates == 'all':
+    if args.all or args.dates == ['all']:
         args.dates = all_dates
 
+    dates = []
     for date in args.dates:
         try:
             # Validate date format
@@ -245,40 +430,23 @@ def main():
         except ValueError:
             print(f"Invalid date format: {date}. Skipping.")
             continue
-
         date = last_day_of_current_month(date).strftime('%Y-%m-%d')
-        detailed_analysis(chatbot, date)
-        df, df2, df3, data, target_col, features_col, year_col = get_data()
-        y_data = get_past_12_months_data(data, date, [target_col])[target_col]
-        history_info = eval(get_history_info(data, date, target_col))
-        if len(history_info) == 0:
-            history_info = {'result': None}
-        else:
-            print(f'Generating feedback with {len(history_info)} historical reports...')
-            history_info = history_info[-1]
-        with open(f'test_results/{date}/结果.md', 'r', encoding='utf-8') as file:
-            text = file.read()
-        text = f'''
-        上一期的预测结果是：
-            {history_info['result']}
+        if date not in dates:
+            dates.append(date)
 
-        ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-        本期的预测结果是：
-            {text}
-        '''
-        res = reflection_predict_result(chatbot_reflection, text, date, y_data)
-        reflection_file_name = f'test_results/{date}/reflection结果.md'
-        with open(f'test_results/{date}/reflection结果.md', 'w', encoding='utf-8') as file:
-            file.write(res)
-        print(f'Conclusions updated and saved to {reflection_file_name}')
-
-        print(f'Creating Word doc date {date}...')
-        generate_word_doc(date)
-        print(f"Word doc {date} completed.")
-        print(f"Processing date: {date} completed.")
+    # load data once for all dates
+    dataset = load_report_data()
+    print('Data loaded successfully')
+    start_time = time.time()
+    try:
+        run_stages(get_date_stages(chatbot, chatbot_reflection, dates, dataset), max_workers=args.workers)
+    finally:
+        # time and tokens spent by each report part in this run
+        report_stats(since=start_time)
 
 
 # example: python main.py 2024-01-01 2024-02-01 2024-03-01
+# example: python main.py --all --workers 4
+# example: python main.py 2024-01-01 --trace trace.json --profile profiles
 if __name__ == '__main__':
     main()
@@ -8,9 +8,10 @@ E-mail: davide97ls@gmail.com
 Goal: Utils functions.
 """
 import warnings
+import json
 from prompt import get_x_prompt, PoliticalAnalysis, MonetaryAnalysis, MonetaryBoardMeetingsAnalysis
 from models import model_invoke
-import tiktoken
+from prompt_budget import count_tokens, compact_value
 import pandas as pd
 from datetime import timedelta
 import re
@@ -18,8 +19,16 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import calendar
 import numpy as np
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data_retrieval.x_dataset_store import load_x_dataset, has_parquet
 warnings.filterwarnings("ignore")
 
+aux_suffixes = ('mom', 'yoy', 'zscore')  # auxiliary features computed for each feature column
+aux_history_len = 12  # rows needed before a row to compute its auxiliary features
+aux_features_path = '../data_retrieval/data/XY_aux_feat.parquet'
+
 
 def get_data(target_col='中国:贷款市场报价利率(LPR):1年'):
     """
@@ -42,7 +51,7 @@ def get_data(target_col='中国:贷款市场报价利率(LPR):1年'):
     df = pd.read_csv('../data_retrieval/data/政策货币报告.csv')
     df2 = pd.read_csv('../data_retrieval/data/政治局会议.csv')
     df3 = pd.read_csv('../data_retrieval/data/中央银行会议报告.csv')
-    data = pd.read_csv('../data_retrieval/data/XY_aug_feat.csv').round(4)
+    data = load_x_dataset('../data_retrieval/data/XY_aug_feat.csv').round(4)
     # 选取特征
     year_col = ['中国GDP', '中国通货膨胀率', '中国公共债务', '中国政府贷款', '美国综合领先指标', '中国综合领先指标', '中国商业信心', '泰勒利率']
     features_col = ['中国GDP', '中国通货膨胀率', '中国公共债务', '中国政府贷款',
@@ -56,32 +65,9 @@ def get_data(target_col='中国:贷款市场报价利率(LPR):1年'):
                     'ppi', '7天期逆回购利率', '7天期逆回购数量', '中国GDP平减指数',
                     '泰勒利率', '债券利差', '中期借贷便利(MLF):操作利率:1年',
                     'GDP:不变价:当季同比', '消费者信心指数']
-    rename_dict = {
-        '逆回购:7日:回购利率': '7天期逆回购利率',
-        '逆回购:7日:回购金额': '7天期逆回购数量',
-        'China_GDP': '中国GDP',
-        'GDP:平减指数': '中国GDP平减指数',
-        'China_Inflation': '中国通货膨胀率',
-        'China_Public_Debt': '中国公共债务',
-        'China_Gov_Lending': '中国政府贷款',
-        'US_Interest_Rates': '美国利率',
-        'US_Composite_Leading_Indicator': '美国综合领先指标',
-        'China_Composite_Leading_Indicator': '中国综合领先指标',
-        'China_Business_Confidence': '中国商业信心',
-        'Shanghai_Composite': '上证指数',
-        'CNYUSD': '人民币对美元汇率',
-        'CNYEUR': '人民币对欧元汇率',
-        'M1_MOM': '中国：M1月度增长率',
-        'M2_MOM': '中国：M2月度增长率',
-        'TR_Interest_Rate': '泰勒利率',
-        'Bond_Spread': '债券利差',
-        'Unnamed: 0': 'date',
-        '消费者指数:信心指数': '消费者信心指数',
-        'CPI:当月值': 'CPI'
-    }
-    data = data.rename(columns=rename_dict)
     data = data.dropna(subset=target_col)
     data = data.ffill()
+    data.insert(0, 'date', data.index.strftime('%Y-%m-%d'))
     # 日期处理
     df['date'] = pd.to_datetime(df['date'])
     df = df.sort_values('date')
@@ -89,43 +75,148 @@ def get_data(target_col='中国:贷款市场报价利率(LPR):1年'):
     df2 = df2.sort_values('date')
     df3['date'] = pd.to_datetime(df3['date'])
     df3 = df3.sort_values('date')
-    data['datetime'] = pd.to_datetime(data['date'])
-    data.set_index('datetime', inplace=True)
+    data.index.name = 'datetime'
     return df, df2, df3, data, target_col, features_col, year_col
 
 
+def parse_json_response(response, schema):
+    """
+    Extracts and validates the JSON object returned by a model.
+
+    The first valid JSON object of the response is decoded, so code fences and text around it are ignored.
+    Numbers given as strings (e.g. "55%") are converted to float.
+
+    Args:
+        response (str): The model response.
+        schema (dict): Maps each required key to its type (float or str).
+
+    Returns:
+        dict: The decoded object.
+
+    Raises:
+        ValueError: If the response contains no JSON object, or a required key is missing or has a wrong type.
+    """
+    if not response:
+        raise ValueError("Empty model response")
+    decoder = json.JSONDecoder()
+    start = response.find('{')
+    while start != -1:
+        try:
+            result, _ = decoder.raw_decode(response, start)
+            break
+        except json.JSONDecodeError:
+            start = response.find('{', start + 1)
+    else:
+        raise ValueError(f"No JSON object in model response: {response[:200]}")
+    for key, value_type in schema.items():
+        if key not in result:
+            raise ValueError(f"Missing key '{key}' in model response: {result}")
+        value = result[key]
+        if value_type is float and isinstance(value, str):
+            try:
+                result[key] = float(value.strip().rstrip('%'))
+            except ValueError:
+                raise ValueError(f"Invalid value for '{key}' in model response: {value}")
+        elif value_type is float and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"Invalid value for '{key}' in model response: {value}")
+        elif value_type is str and not isinstance(value, str):
+            result[key] = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+    return result
+
+
 # 计算辅助特征
-def calculate_auxiliary_features(data, features_col):
+def compute_auxiliary_block(data, features_col):
+    """
+    Computes the mom, yoy and zscore features of all the feature columns at once.
+
+    Args:
+        data (pd.DataFrame): The dataset containing financial indicators.
+        features_col (list): List of feature column names.
+
+    Returns:
+        pd.DataFrame: The features, with columns `{col}_mom`, `{col}_yoy`, `{col}_zscore` for each column.
+    """
+    x = data[features_col]
+    rolling = x.rolling(window=6, min_periods=6)
+    block = pd.concat({
+        # 环比 (MoM)
+        'mom': x.pct_change(fill_method=None),
+        # 同比 (YoY)
+        'yoy': x.pct_change(12, fill_method=None),
+        # 当前值相较于过去6个月均值的偏差 (z-score)
+        'zscore': (x - rolling.mean()) / rolling.std(),
+    }, axis=1)
+    block.columns = [f'{col}_{suffix}' for suffix, col in block.columns]
+    return block[[f'{col}_{suffix}' for col in features_col for suffix in aux_suffixes]]
+
+
+def _row_hashes(data, features_col):
+    return pd.util.hash_pandas_object(data[features_col], index=True).values
+
+
+def get_auxiliary_block(data, features_col, store_path=None):
+    """
+    Returns the auxiliary features of a dataset, reusing the ones saved in `store_path`.
+
+    Saved rows are kept up to the first row of the dataset that changed or was appended, the following
+    ones are computed again (with the `aux_history_len` previous rows needed by yoy and zscore) and saved.
+
+    Args:
+        data (pd.DataFrame): The dataset containing financial indicators.
+        features_col (list): List of feature column names.
+        store_path (str, optional): Parquet file storing the features. If None they are always computed.
+
+    Returns:
+        pd.DataFrame: The features, as returned by `compute_auxiliary_block`.
+    """
+    if store_path is None or not has_parquet:
+        return compute_auxiliary_block(data, features_col)
+    columns = [f'{col}_{suffix}' for col in features_col for suffix in aux_suffixes]
+    hashes = _row_hashes(data, features_col)
+    start = 0
+    if os.path.exists(store_path):
+        stored = pd.read_parquet(store_path, engine='pyarrow')
+        if list(stored.columns) == columns + ['row_hash']:
+            n = min(len(stored), len(data))
+            same = (stored.index[:n] == data.index[:n]) & (stored['row_hash'].values[:n] == hashes[:n])
+            start = n if same.all() else int(np.argmin(same))
+            if start == len(data) == len(stored):
+                return stored[columns]
+            stored = stored.iloc[:start]
+    if start == 0:
+        block = compute_auxiliary_block(data, features_col)
+    else:
+        new = compute_auxiliary_block(data.iloc[max(start - aux_history_len, 0):], features_col)
+        block = pd.concat([stored[columns], new.iloc[min(start, aux_history_len):]])
+    block['row_hash'] = hashes
+    tmp_path = store_path + '.tmp'
+    block.to_parquet(tmp_path, engine='pyarrow')
+    os.replace(tmp_path, store_path)
+    return block[columns]
+
+
+def calculate_auxiliary_features(data, features_col, store_path=None):
     """
     Computes additional statistical features for financial data.
 
     Args:
         data (pd.DataFrame): The dataset containing financial indicators.
         features_col (list): List of feature column names.
+        store_path (str, optional): Parquet file where the features are saved and incrementally updated.
 
     Returns:
         tuple: (results, data)
             - results (dict): Summary statistics for the features.
             - data (pd.DataFrame): Updated dataset with additional computed features.
     """
-    results = {}
-    for col in features_col:
-        if '同比' not in col and '环比' not in col:
-            # 环比 (MoM)
-            data[f'{col}_mom'] = data[col].pct_change()
-            # 同比 (YoY)
-            data[f'{col}_yoy'] = data[col].pct_change(12)
-            # 当前值相较于过去6个月均值的偏差 (z-score)
-            data[f'{col}_zscore'] = (
-                    (data[col] - data[col].rolling(window=6, min_periods=6).mean()) /
-                    data[col].rolling(window=6, min_periods=6).std()
-            )
-            # 统计环比、同比的均值
-            results[col] = {
-                'mom_mean': data[f'{col}_mom'].mean(),
-                'yoy_mean': data[f'{col}_yoy'].mean(),
-                'current_zscore': data[f'{col}_zscore'].iloc[-1]  # 取当前最新的偏差值
-            }
+    features_col = list(dict.fromkeys(col for col in features_col if '同比' not in col and '环比' not in col))
+    block = get_auxiliary_block(data, features_col, store_path)
+    data = pd.concat([data.drop(columns=block.columns, errors='ignore'), block], axis=1)
+    # 统计环比、同比的均值
+    means = block.mean()
+    current = block.iloc[-1]  # 取当前最新的偏差值
+    results = {col: {'mom_mean': means[f'{col}_mom'], 'yoy_mean': means[f'{col}_yoy'],
+                     'current_zscore': current[f'{col}_zscore']} for col in features_col}
     return results, data
 
 
@@ -146,9 +237,11 @@ def get_x_data_prompt(date, data, features_col, target_col, year_col):
     reference_date = date
     result = get_past_12_months_data(data, reference_date, features_col + [target_col])
     result.update(get_past_5_years_data(data, reference_date, year_col))
+    result = {feature: compact_value(values) for feature, values in result.items()}
     assist_col = [col for col in data.columns if any(keyword in col for keyword in ['mom', 'yoy', 'zscore'])]
     assist_result = get_data_for_specific_month(data, reference_date, assist_col)
-    assist_result = {feature: value if not np.isnan(value) else 0 for feature, value in assist_result.items()}
+    assist_result = {feature: compact_value(value) if not np.isnan(value) else 0
+                     for feature, value in assist_result.items()}
     x_prompt = get_x_prompt(reference_date, result, assist_result, target_col)
     return x_prompt
 
@@ -286,7 +379,6 @@ def analysis(role_prompt, prompt, date, chatbot, filename, load_result=False):
             response = file.read()
     else:
         response = model_invoke(role_prompt, prompt, chatbot=chatbot)
-    log_token_usage(role_prompt+prompt, response)
     file_name = f"test_results/{date}/{filename}.md"
     with open(file_name, 'w', encoding='utf-8') as file:
         file.write(response)
@@ -332,25 +424,7 @@ def num_tokens_from_string(string: str, encoding_name: str) -> int:
     Returns:
         int: The number of tokens in the string.
     """
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
-
-def log_token_usage(input_message, output_message, log_file='token_usage_log.txt'):
-    """
-    Logs token usage for input and output messages to a specified file.
-
-    Args:
-        input_message (str): The input message string.
-        output_message (str): The output message string.
-        log_file (str): The file to store the log. Default is 'token_usage_log.txt'.
-    """
-    input_tokens = num_tokens_from_string(input_message, 'cl100k_base')
-    output_tokens = num_tokens_from_string(output_message, 'cl100k_base')
-    # Append the updated token counts to the log file
-    with open(log_file, 'a', encoding='utf-8') as file:
-        file.write(f"Input tokens: {input_tokens}, Output tokens: {output_tokens}\n")
+    return count_tokens(string, encoding_name)
 
 
 def get_past_12_months_data(df, reference_date, feature_list):
@@ -384,10 +458,9 @@ def get_past_5_years_data(df, reference_date, feature_list):
         dict: A dictionary where keys are feature names and values are lists of first values from past five years.
     """
     reference_date = pd.to_datetime(reference_date)
-    df['date'] = pd.to_datetime(df['date'])
-    df = df[df['date'] <= reference_date]
-    df['year'] = df['date'].dt.year
-    first_value_per_year = df.groupby('year').first().reset_index().tail(6).iloc[:-1, :]
+    # a slice of the sorted DatetimeIndex, the dataframe is neither masked nor copied
+    past_df = df.loc[:reference_date, feature_list]
+    first_value_per_year = past_df.groupby(past_df.index.year).first().iloc[-6:-1]
     result = {}
     for feature in feature_list:
         feature_values = first_value_per_year[feature].tolist()
@@ -8,12 +8,24 @@ E-mail: davide97ls@gmail.com
 Goal: Implement a chatbot model selection function that returns an appropriate
        model instance based on the specified parameters
 """
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from langchain_openai.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 from keys import openai_key, deepseek_key, efund_key
+import llm_cache
+import telemetry
+import llm_recording
+import rate_limit
+from prompt_budget import count_tokens
+import os
 import traceback
+import inspect
+import queue
 import warnings
+import asyncio
+import threading
+import time
+import httpx
 try:
     from luluai.langchain_contrib.chat_models.openai import EFundChatModel
 except ImportError as e:
@@ -27,11 +39,390 @@ models_list = ["deepseek-chat", "deepseek-r1",
                "g4f"]
 
 
+# maximum number of requests in flight at the same time for each provider
+provider_concurrency = {
+    'openai': 8,
+    'siliconflow': 4,
+    'efund': 4,
+    'g4f': 2,
+}
+
+siliconflow_base_url = 'https://api.siliconflow.cn/v1/'
+openai_base_url = 'https://api.openai.com/v1'
+efund_base_url = 'http://luluai.efundsdemo.com/oneapi/v1'
+g4f_base_url = None  # g4f uses its own client
+
+# OpenAI-compatible server replacing every provider (e.g. stub_llm_server.py to run offline), set with LLM_STUB_URL
+stub_url = os.environ.get('LLM_STUB_URL')
+if stub_url:
+    siliconflow_base_url, openai_base_url, efund_base_url, g4f_base_url = (
+        f"{stub_url.rstrip('/')}/{provider}/v1" for provider in ('siliconflow', 'openai', 'efunds', 'g4f'))
+# if set, the responses of the providers are appended to this file to be replayed by stub_llm_server.py
+record_path = os.environ.get('LLM_RECORD_PATH')
+
+# keep-alive connections kept open for each (provider, base_url)
+pool_limits = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+_semaphores = {}
+
+
+def get_provider(model=None, chatbot=None):
+    """
+    Returns the name of the provider serving a model or a chatbot instance.
+
+    Args:
+        model (str, optional): The model name as accepted by `model_invoke`.
+        chatbot (object, optional): A chatbot instance returned by `get_model`.
+
+    Returns:
+        str: One of the keys of `provider_concurrency`.
+    """
+    if chatbot == 'g4f' or (chatbot is None and model == 'g4f'):
+        return 'g4f'
+    if chatbot is not None:
+        base_url = str(getattr(chatbot, 'openai_api_base', None) or '')
+        if type(chatbot).__name__ == 'EFundChatModel' or 'efunds' in base_url:
+            return 'efund'
+        if 'siliconflow' in base_url:
+            return 'siliconflow'
+        return 'openai'
+    if model in ["deepseek-chat", "deepseek-r1"]:
+        return 'siliconflow'
+    if model in ['efund']:
+        return 'efund'
+    return 'openai'
+
+
+def _get_registered(key, factory):
+    """ Returns the client registered under `key`, creating it with `factory` on first use. """
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_http_clients(provider, base_url):
+    """
+    Returns the pooled HTTP clients shared by every client of a provider endpoint.
+
+    Args:
+        provider (str): The provider name.
+        base_url (str): The base URL of the API.
+    Returns:
+        tuple: (httpx.Client, httpx.AsyncClient) with keep-alive connection pooling.
+    """
+    return _get_registered(
+        ('http', provider, base_url),
+        lambda: (DefaultHttpxClient(limits=pool_limits), DefaultAsyncHttpxClient(limits=pool_limits))
+    )
+
+
+def get_openai_client(provider, base_url, api_key):
+    """
+    Returns the process-wide `AsyncOpenAI` client of an OpenAI-compatible endpoint.
+
+    Args:
+        provider (str): The provider name.
+        base_url (str): The base URL of the API.
+        api_key (str): The API key.
+    Returns:
+        AsyncOpenAI: A client reusing the pooled connections of the endpoint.
+    """
+    _, http_async_client = get_http_clients(provider, base_url)
+    return _get_registered(
+        (provider, base_url, None),
+        lambda: AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_async_client)
+    )
+
+
+def _get_loop():
+    """
+    Returns the event loop used to run all model calls, starting it in a daemon thread on first use.
+
+    Using a single loop lets the sync and async APIs share the same concurrency limits.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='model-invoke-loop', daemon=True)
+            _loop_thread.start()
+    return _loop
+
+
+def _get_semaphore(provider):
+    """ Returns the semaphore bounding the concurrent calls to a provider (must run inside the model loop). """
+    if provider not in _semaphores:
+        _semaphores[provider] = asyncio.Semaphore(provider_concurrency.get(provider, 4))
+    return _semaphores[provider]
+
+
+async def _acall(system_prompt, instruction, model, chatbot, temperature, model_name):
+    """ Sends a single request to the selected model and returns the content of the answer. """
+    if chatbot:
+        prompt = [SystemMessage(content=system_prompt), HumanMessage(content=instruction)]
+        # pass the temperature per request instead of changing the shared chatbot instance
+        kwargs = {'temperature': temperature} if temperature != 0 else {}
+        response = await chatbot.ainvoke(prompt, **kwargs)
+        return response.content
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": instruction},
+    ]
+    if model in ["deepseek-chat", "deepseek-r1"]:
+        client = get_openai_client('siliconflow', siliconflow_base_url, deepseek_key)
+        response = await client.chat.completions.create(
+            model='Pro/deepseek-ai/DeepSeek-R1',
+            messages=messages,
+            temperature=temperature,
+        )
+    elif model in ["gpt-4", "gpt-3.5-turbo", "gpt-4o-mini"]:
+        client = get_openai_client('openai', openai_base_url, openai_key)
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+        )
+    elif model in ['efund']:
+        chatbot = get_model(model='efund', model_name=model_name)
+        data_message = [SystemMessage(content=system_prompt), HumanMessage(content=instruction)]
+        response = await chatbot.ainvoke(data_message)
+        return response.content
+    elif model in ["g4f"] and g4f_base_url:
+        client = get_openai_client('g4f', g4f_base_url, 'stub')
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=temperature,
+        )
+    elif model in ["g4f"]:
+        from g4f.client import AsyncClient
+        client = AsyncClient()
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            web_search=False,
+        )
+    else:
+        raise ValueError(f"Unsupported model type: {model}")
+    return response.choices[0].message.content
+
+
+async def _astream(system_prompt, instruction, model, chatbot, temperature, model_name):
+    """ Sends a single streaming request to the selected model and yields the content of the answer. """
+    if chatbot or model in ['efund']:
+        prompt = [SystemMessage(content=system_prompt), HumanMessage(content=instruction)]
+        kwargs = {'temperature': temperature} if chatbot and temperature != 0 else {}
+        chatbot = chatbot or get_model(model='efund', model_name=model_name)
+        async for chunk in chatbot.astream(prompt, **kwargs):
+            if chunk.content:
+                yield chunk.content
+        return
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": instruction},
+    ]
+    if model in ["deepseek-chat", "deepseek-r1"]:
+        client = get_openai_client('siliconflow', siliconflow_base_url, deepseek_key)
+        kwargs = {'model': 'Pro/deepseek-ai/DeepSeek-R1', 'temperature': temperature}
+    elif model in ["gpt-4", "gpt-3.5-turbo", "gpt-4o-mini"]:
+        client = get_openai_client('openai', openai_base_url, openai_key)
+        kwargs = {'model': model, 'temperature': temperature}
+    elif model in ["g4f"] and g4f_base_url:
+        client = get_openai_client('g4f', g4f_base_url, 'stub')
+        kwargs = {'model': "gpt-4o-mini", 'temperature': temperature}
+    elif model in ["g4f"]:
+        from g4f.client import AsyncClient
+        client = AsyncClient()
+        kwargs = {'model': "gpt-4o-mini", 'web_search': False}
+    else:
+        raise ValueError(f"Unsupported model type: {model}")
+    stream = client.chat.completions.create(messages=messages, stream=True, **kwargs)
+    if inspect.isawaitable(stream):
+        stream = await stream
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def _acall_stream(system_prompt, instruction, model, chatbot, temperature, model_name, on_chunk):
+    """ Streams the answer of the selected model to `on_chunk` and returns its full content. """
+    parts = []
+    async for chunk in _astream(system_prompt, instruction, model, chatbot, temperature, model_name):
+        parts.append(chunk)
+        on_chunk(chunk)
+    return ''.join(parts)
+
+
+cache_key_params = ['max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty', 'seed', 'stop', 'model_kwargs']
+
+
+def _cache_key(system_prompt, instruction, model, chatbot, temperature, model_name):
+    """ Returns the response cache key of a call, or None if the call must not be cached. """
+    params = {}
+    if model in ['efund'] and not chatbot:
+        # _acall answers with the EFund chatbot of `model_name` and its own temperature, key the call on them
+        chatbot = get_model(model='efund', model_name=model_name)
+        temperature = getattr(chatbot, 'temperature', None) or 0
+    elif chatbot:
+        model = get_provider(chatbot=chatbot)
+        if temperature == 0:
+            temperature = getattr(chatbot, 'temperature', None) or 0
+    else:
+        model_name = None  # only the EFund calls use it
+    if chatbot:
+        model_name = getattr(chatbot, 'model_name', None)
+        params = {name: getattr(chatbot, name, None) for name in cache_key_params}
+        params['base_url'] = str(getattr(chatbot, 'openai_api_base', None) or '')
+    else:
+        # the answers of a stub server (LLM_STUB_URL) must not be served to the calls of the real provider
+        params['base_url'] = {'siliconflow': siliconflow_base_url, 'openai': openai_base_url,
+                              'g4f': g4f_base_url}.get(get_provider(model))
+    if not llm_cache.cache_enabled or temperature > llm_cache.max_cached_temperature:
+        return None
+    return llm_cache.make_key(model, model_name, system_prompt, instruction, temperature, params)
+
+
+def _record_call(context, model, chatbot, system_prompt, instruction, response, started, queue_time, retries,
+                 cache_hit, error=None):
+    """ Records a model call in the telemetry sink. """
+    if not telemetry.telemetry_enabled:
+        return
+    model_name = getattr(chatbot, 'model_name', None) if chatbot else model
+    telemetry.record_call(context, get_provider(model, chatbot), model_name,
+                          count_tokens(system_prompt) + count_tokens(instruction),
+                          count_tokens(response) if response else 0,
+                          time.perf_counter() - started - queue_time, queue_time, retries, cache_hit, error)
+
+
+async def _ainvoke(system_prompt, instruction, model, chatbot, temperature, model_name, context=None,
+                   on_chunk=None):
+    """
+    Calls a model with retries, holding a slot of the provider semaphore. Runs inside the model loop.
+
+    Calls wait for the rate limiter of the provider, failed attempts are retried after a jittered exponential
+    backoff (or the Retry-After delay sent by the provider), and while the circuit breaker of the provider is
+    open calls wait for it to let calls through again, within the same retry budget. Rate limited (429) answers
+    do not count as failures of the provider. If `on_chunk` is given the answer is streamed to it, and a call
+    failing after part of the answer was streamed is not retried.
+    """
+    errors = 0
+    max_retry = 5
+    started = time.perf_counter()
+    context = context or {}
+    if system_prompt is None:
+        system_prompt = ""
+    if chatbot == 'g4f':
+        model = 'g4f'
+        chatbot = None
+    cache_key = _cache_key(system_prompt, instruction, model, chatbot, temperature, model_name)
+    if cache_key is not None:
+        response = llm_cache.get_cache().get(cache_key)
+        if response is not None:
+            _record_call(context, model, chatbot, system_prompt, instruction, response, started, 0, 0, True)
+            if on_chunk is not None:
+                on_chunk(response)
+            return response
+    provider = get_provider(model, chatbot)
+    limiter = rate_limit.get_rate_limiter(provider)
+    breaker = rate_limit.get_circuit_breaker(provider)
+    prompt_tokens = count_tokens(system_prompt) + count_tokens(instruction)
+    streamed = []
+
+    def emit(chunk):
+        streamed.append(chunk)
+        on_chunk(chunk)
+    async with _get_semaphore(provider):
+        queue_time = time.perf_counter() - started
+        while 1:
+            trial = False
+            try:
+                trial = breaker.check(provider)
+                await limiter.acquire(prompt_tokens)
+                if on_chunk is None:
+                    response = await _acall(system_prompt, instruction, model, chatbot, temperature, model_name)
+                else:
+                    response = await _acall_stream(system_prompt, instruction, model, chatbot, temperature,
+                                                   model_name, emit)
+            except asyncio.CancelledError:
+                # a cancelled trial records neither a success nor a failure, let the next call try instead
+                if trial:
+                    breaker.release_trial()
+                raise
+            except Exception as e:
+                if rate_limit.is_rate_limited(e):
+                    # throttling is handled by the rate limiter and the backoff, the provider is not failing
+                    if trial:
+                        breaker.release_trial()
+                elif not isinstance(e, rate_limit.CircuitOpenError):
+                    breaker.record_failure()
+                errors += 1
+                print(f"Error occurred: {e}")
+                if not rate_limit.is_retryable(e) or streamed or errors > max_retry:
+                    print("Max retries reached. Exiting..." if errors > max_retry else "Error is not retryable.")
+                    print(traceback.format_exc())  # Print detailed error traceback of the final failure
+                    _record_call(context, model, chatbot, system_prompt, instruction, None, started, queue_time,
+                                 errors, False, error=repr(e))
+                    raise
+                delay = rate_limit.get_backoff_delay(errors, e)
+                print(f"Retrying {errors}/{max_retry} in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            if cache_key is not None and response is not None:
+                llm_cache.get_cache().put(cache_key, response)
+            if record_path and response is not None:
+                llm_recording.record_response(record_path, system_prompt, instruction, response)
+            _record_call(context, model, chatbot, system_prompt, instruction, response, started, queue_time,
+                         errors, False)
+            return response
+
+
+def _submit(system_prompt, instruction, model, chatbot, temperature, model_name, on_chunk=None):
+    """ Schedules a model call on the model loop and returns a `concurrent.futures.Future`. """
+    loop = _get_loop()
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("Blocking model calls cannot be made from inside the model loop, use amodel_invoke.")
+    # the telemetry labels of the caller (stage, date) do not follow the call into the model loop thread
+    return asyncio.run_coroutine_threadsafe(
+        _ainvoke(system_prompt, instruction, model, chatbot, temperature, model_name, telemetry.get_context(),
+                 on_chunk),
+        loop)
+
+
+async def amodel_invoke(system_prompt, instruction, model="deepseek-chat", chatbot=None, temperature=0,
+                        model_name=None):
+    """
+    Asynchronous version of `model_invoke`, can be awaited from any event loop.
+
+    Args:
+        system_prompt (str): The system prompt for the model.
+        instruction (str): The user instruction.
+        model (str, optional): The model to use (default: "deepseek-chat").
+        chatbot (object, optional): A chatbot instance if applicable.
+        temperature (float, optional): The temperature setting for response randomness (default: 0).
+        model_name (str, optional): The name of the model to use (default: None).
+    Returns:
+        str: The response from the model or chatbot.
+    """
+    future = _submit(system_prompt, instruction, model, chatbot, temperature, model_name)
+    return await asyncio.wrap_future(future)
+
+
 def model_invoke(system_prompt, instruction, model="deepseek-chat", chatbot=None, temperature=0,
                  model_name=None):
     """
     Invoke a chatbot model with a given system prompt and instruction.
 
+    The call runs on the shared model loop, so concurrent calls made from different threads are bounded
+    by `provider_concurrency`. Deterministic calls are served from `llm_cache` when the same prompt was
+    already answered. Every call is recorded by `telemetry`, labeled with the current `telemetry_context`.
+
     Args:
         system_prompt (str): The system prompt for the model.
         instruction (str): The user instruction.
@@ -43,94 +434,76 @@ def model_invoke(system_prompt, instruction, model="deepseek-chat", chatbot=None
         str: The response from the model or chatbot.
 
     Raises:
-        Exception: If an error occurs more than 5 times.
+        Exception: The last error, if the call fails more than 5 times or cannot be retried.
     """
-    errors = 0
-    max_retry = 5
-    while 1:
-        try:
-            if system_prompt is None:
-                system_prompt = ""
-            if chatbot == 'g4f':
-                model = 'g4f'
-                chatbot = None
-            if chatbot:
-                if temperature != 0:
-                    chatbot.temperature = temperature
-                prompt = [SystemMessage(content=system_prompt), HumanMessage(content=instruction)]
-                response = chatbot.invoke(prompt).content
-                chatbot.temperature = 0
-                return response
-            elif model:
-                if model in ["deepseek-chat"]:
-                    client = OpenAI(api_key=deepseek_key, base_url='Pro/deepseek-ai/DeepSeek-R1')
-                    response = client.chat.completions.create(
-                        model='Pro/deepseek-ai/DeepSeek-R1',
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": instruction},
-                        ],
-                        temperature=temperature,
-                    )
-                elif model in ["deepseek-r1"]:
-                    client = OpenAI(api_key=deepseek_key,
-                                    base_url='https://api.siliconflow.cn/v1/')
-                    response = client.chat.completions.create(
-                        model='Pro/deepseek-ai/DeepSeek-R1',
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": instruction},
-                        ],
-                        temperature=temperature,
-                    )
-                elif model in ["gpt-4", "gpt-3.5-turbo", "gpt-4o-mini"]:
-                    client = OpenAI(api_key=openai_key)
-                    response = client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": instruction},
-                        ],
-                        temperature=temperature,
-                    )
-                elif model in ['efund']:
-                    if model_name == None:
-                        model_name = 'gpt-4o'
-                    chatbot = EFundChatModel(
-                        model_name=model_name,
-                        efunds_user_name='baiyun',
-                        openai_api_base='http://luluai.efundsdemo.com/oneapi/v1',
-                        openai_api_key=efund_key
-                    )
-                    data_message = [SystemMessage(content=system_prompt), HumanMessage(content=instruction)]
-                    response = chatbot.invoke(data_message).content
-                    return response
-                elif model in ["g4f"]:
-                    from g4f.client import Client
-                    client = Client()
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": instruction},
-                        ],
-                        web_search=False,
-                    )
-                return response.choices[0].message.content
-        except Exception as e:
-            errors += 1
-            print(f"Error occurred: {e}")
-            print(traceback.format_exc())  # Print detailed error traceback
-            print(f"Retrying {errors}/{max_retry}...")
-            if errors > max_retry:
-                print("Max retries reached. Exiting...")
+    return _submit(system_prompt, instruction, model, chatbot, temperature, model_name).result()
+
+
+def model_invoke_stream(system_prompt, instruction, model="deepseek-chat", chatbot=None, temperature=0,
+                        model_name=None, output_path=None):
+    """
+    Streaming version of `model_invoke`, yielding the answer as it is generated.
+
+    If `output_path` is given the answer is also written to the file as it arrives, so a call that fails or
+    times out keeps the part already generated on disk. Consumers needing only the beginning of the answer
+    can stop iterating: closing the generator cancels the request.
+
+    Args:
+        system_prompt (str): The system prompt for the model.
+        instruction (str): The user instruction.
+        model (str, optional): The model to use (default: "deepseek-chat").
+        chatbot (object, optional): A chatbot instance if applicable.
+        temperature (float, optional): The temperature setting for response randomness (default: 0).
+        model_name (str, optional): The name of the model to use (default: None).
+        output_path (str, optional): File the answer is written to (default: None).
+    Yields:
+        str: The chunks of the answer.
+
+    Raises:
+        Exception: The last error, if the call fails more than 5 times or cannot be retried.
+    """
+    chunks = queue.Queue()
+    future = _submit(system_prompt, instruction, model, chatbot, temperature, model_name, on_chunk=chunks.put)
+    future.add_done_callback(lambda _: chunks.put(None))
+    file = open(output_path, 'w', encoding='utf-8') if output_path else None
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
                 break
+            if file:
+                file.write(chunk)
+                file.flush()
+            yield chunk
+        future.result()
+    finally:
+        future.cancel()
+        if file:
+            file.close()
+
+
+def model_invoke_many(calls):
+    """
+    Invoke several independent prompts concurrently.
+
+    Args:
+        calls (list): List of dicts with the keyword arguments of `model_invoke`
+            (system_prompt, instruction, model, chatbot, temperature, model_name).
+    Returns:
+        list: The responses, in the same order as `calls`.
+    """
+    defaults = {'model': "deepseek-chat", 'chatbot': None, 'temperature': 0, 'model_name': None}
+    futures = [_submit(**{**defaults, **call}) for call in calls]
+    return [future.result() for future in futures]
 
 
 def get_model(model="deepseek-chat", max_tokens=16384, temp=0, model_name=None):
     """
     Returns a chatbot model instance based on the specified model type.
 
+    Instances are kept in a process-wide registry, so asking twice for the same configuration returns the
+    same object and its pooled HTTP connections.
+
     Args:
         model (str, optional): The model to use. Default is "deepseek-chat".
             Available options:
@@ -148,38 +521,57 @@ def get_model(model="deepseek-chat", max_tokens=16384, temp=0, model_name=None):
     Raises:
         ValueError: If an unsupported model type is specified.
     """
-    if model == "deepseek-chat":
-        chatbot = ChatOpenAI(
+    if model in ["deepseek-chat", "deepseek-r1"]:
+        http_client, http_async_client = get_http_clients('siliconflow', siliconflow_base_url)
+        key = ('siliconflow', siliconflow_base_url, 'Pro/deepseek-ai/DeepSeek-R1', temp, max_tokens)
+        chatbot = _get_registered(key, lambda: ChatOpenAI(
             model_name='Pro/deepseek-ai/DeepSeek-R1',
             temperature=temp,
             max_tokens=max_tokens,
             openai_api_key=deepseek_key,
-            base_url='https://api.siliconflow.cn/v1/',
-        )
-    elif model == "deepseek-r1":
-        chatbot = ChatOpenAI(
-            model_name='Pro/deepseek-ai/DeepSeek-R1',
-            temperature=temp,
-            max_tokens=max_tokens,
-            openai_api_key=deepseek_key,
-            base_url='https://api.siliconflow.cn/v1/'
-        )
+            base_url=siliconflow_base_url,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        ))
     elif model in ["gpt-4", "gpt-3.5-turbo", "gpt-4o-mini"]:
-        chatbot = ChatOpenAI(
+        http_client, http_async_client = get_http_clients('openai', openai_base_url)
+        key = ('openai', openai_base_url, model, temp, max_tokens)
+        chatbot = _get_registered(key, lambda: ChatOpenAI(
             model_name=model,
             temperature=temp,
             max_tokens=max_tokens,
             openai_api_key=openai_key,
-        )
+            base_url=openai_base_url,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        ))
     elif model in ["efund"]:
         if model_name is None:
             model_name = 'gpt-4o'
-        chatbot = EFundChatModel(
+        key = ('efund', efund_base_url, model_name, temp, max_tokens)
+        http_client, http_async_client = get_http_clients('efund', efund_base_url)
+        if stub_url:
+            # EFundChatModel only talks to the EFund gateway, use an OpenAI client with the same model name
+            return _get_registered(key, lambda: ChatOpenAI(
+                model_name=model_name,
+                temperature=temp,
+                max_tokens=max_tokens,
+                openai_api_key=efund_key,
+                base_url=efund_base_url,
+                http_client=http_client,
+                http_async_client=http_async_client,
+            ))
+        # EFundChatModel extends ChatOpenAI, so it takes the same generation and HTTP client settings
+        chatbot = _get_registered(key, lambda: EFundChatModel(
             model_name=model_name,
+            temperature=temp,
+            max_tokens=max_tokens,
             efunds_user_name='baiyun',
-            openai_api_base='http://luluai.efundsdemo.com/oneapi/v1',
+            openai_api_base=efund_base_url,
             openai_api_key=efund_key,
-        )
+            http_client=http_client,
+            http_async_client=http_async_client,
+        ))
     elif model in ["g4f"]:
         return 'g4f'
     else:
@@ -0,0 +1,321 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Run the report generation stages as a dependency graph on a thread pool.
+"""
+import contextvars
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from telemetry import telemetry_context
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from data_retrieval.tracing import span
+
+fingerprints_folder = '.fingerprints'  # folder of the artifacts directory storing the stage fingerprints
+
+_resource_locks = {}
+_resource_locks_lock = threading.Lock()
+_stage_observers = []
+
+
+class Stage:
+    """
+    A named step of the report pipeline.
+
+    Dependencies between stages are derived from their artifacts: a stage waits for every stage producing
+    one of its inputs. Inputs not produced by any stage are expected to exist already.
+    Output names can be glob patterns when the number of files is not known in advance.
+
+    Args:
+        name (str): Unique name of the stage.
+        func (callable): Function without arguments executing the stage.
+        inputs (list, optional): Names of the artifacts read by the stage.
+        outputs (list, optional): Names of the artifacts written by the stage.
+        locks (list, optional): Names of shared resources the stage needs exclusive access to
+            (e.g. 'pyplot', since matplotlib global state is not thread safe).
+        params (list, optional): Everything else the outputs depend on (data, prompt functions, model names...),
+            part of the stage fingerprint together with the content of the inputs.
+        profile (bool, optional): If True, the stage is profiled when profiling is enabled (see `tracing`).
+            Set it to False for stages wrapping other pipelines, so the inner stages are profiled. Default is True.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), locks=(), params=(), profile=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.locks = list(locks)
+        self.params = list(params)
+        self.profile = profile
+
+    def __repr__(self):
+        return f'Stage({self.name!r})'
+
+
+def add_stage_observer(observer):
+    """
+    Registers a function called after each stage run, e.g. to time the stages in benchmarks.
+
+    Args:
+        observer (callable): Called with the stage name, the `time.perf_counter()` values at the start and the end
+            of the stage and the error it raised (None if it succeeded). Skipped stages are not reported.
+    """
+    _stage_observers.append(observer)
+
+
+def remove_stage_observer(observer):
+    """
+    Unregisters a function added with `add_stage_observer`.
+
+    Args:
+        observer (callable): The function.
+    """
+    _stage_observers.remove(observer)
+
+
+def get_resource_lock(name):
+    """
+    Returns the process-wide lock of a shared resource.
+
+    Args:
+        name (str): The resource name.
+
+    Returns:
+        threading.Lock: The lock guarding the resource.
+    """
+    with _resource_locks_lock:
+        if name not in _resource_locks:
+            _resource_locks[name] = threading.Lock()
+        return _resource_locks[name]
+
+
+def _update_hash(h, value):
+    """ Adds a value to a hash: frames are hashed by content, functions and modules by source code. """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, bytes):
+        h.update(value)
+    elif isinstance(value, str):
+        h.update(value.encode('utf-8'))
+    elif inspect.isfunction(value) or inspect.ismethod(value) or inspect.ismodule(value):
+        h.update(inspect.getsource(value).encode('utf-8'))
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _update_hash(h, item)
+    else:
+        h.update(repr(value).encode('utf-8'))
+    h.update(b'\x00')
+
+
+def fingerprint(*values):
+    """
+    Computes the fingerprint of a list of values.
+
+    Args:
+        *values: Strings, bytes, DataFrames, functions and modules (hashed by source code, so prompt changes
+            are detected) or any value with a stable repr.
+
+    Returns:
+        str: The SHA-256 hex digest of the values.
+    """
+    h = hashlib.sha256()
+    for value in values:
+        _update_hash(h, value)
+    return h.hexdigest()
+
+
+def get_stage_fingerprint(stage, artifacts_dir):
+    """
+    Computes the fingerprint of a stage from its name, its params and the content of its inputs.
+
+    Args:
+        stage (Stage): The stage.
+        artifacts_dir (str): The directory containing the artifacts.
+
+    Returns:
+        str: The fingerprint of the stage.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, stage.name)
+    _update_hash(h, stage.params)
+    for name in stage.inputs:
+        for path in sorted(glob.glob(os.path.join(artifacts_dir, name))):
+            _update_hash(h, os.path.relpath(path, artifacts_dir))
+            with open(path, 'rb') as f:
+                _update_hash(h, f.read())
+    return h.hexdigest()
+
+
+def _fingerprint_path(stage, artifacts_dir):
+    return os.path.join(artifacts_dir, fingerprints_folder, f'{stage.name}.json')
+
+
+def is_stage_done(stage, artifacts_dir, stage_fingerprint):
+    """
+    Checks whether a stage was already run with the same fingerprint and its outputs are still there.
+
+    Args:
+        stage (Stage): The stage.
+        artifacts_dir (str): The directory containing the artifacts.
+        stage_fingerprint (str): The current fingerprint of the stage.
+
+    Returns:
+        bool: True if the stage can be skipped.
+    """
+    try:
+        with open(_fingerprint_path(stage, artifacts_dir), 'r', encoding='utf-8') as f:
+            record = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if record.get('fingerprint') != stage_fingerprint:
+        return False
+    outputs = [name for name in stage.outputs if not glob.has_magic(name)]
+    return all(os.path.exists(os.path.join(artifacts_dir, name)) for name in outputs)
+
+
+def save_stage_fingerprint(stage, artifacts_dir, stage_fingerprint):
+    """
+    Records the fingerprint of a completed stage next to its outputs.
+
+    Args:
+        stage (Stage): The stage.
+        artifacts_dir (str): The directory containing the artifacts.
+        stage_fingerprint (str): The fingerprint of the stage.
+    """
+    path = _fingerprint_path(stage, artifacts_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'stage': stage.name, 'fingerprint': stage_fingerprint, 'outputs': stage.outputs}, f,
+                  ensure_ascii=False, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def get_dependencies(stages):
+    """
+    Computes the stages each stage depends on.
+
+    Args:
+        stages (list): List of Stage objects.
+
+    Returns:
+        dict: Maps each stage name to the set of names of the stages it must wait for.
+
+    Raises:
+        ValueError: If two stages have the same name or produce the same artifact, or if the graph has a cycle.
+    """
+    producers = {}
+    names = set()
+    for stage in stages:
+        if stage.name in names:
+            raise ValueError(f"Duplicated stage name: {stage.name}")
+        names.add(stage.name)
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"Artifact {output} produced by both {producers[output]} and {stage.name}")
+            producers[output] = stage.name
+    dependencies = {stage.name: {producers[i] for i in stage.inputs if i in producers} - {stage.name}
+                    for stage in stages}
+
+    # Check the graph is acyclic
+    resolved = set()
+    while len(resolved) < len(dependencies):
+        ready = [name for name, deps in dependencies.items() if name not in resolved and deps <= resolved]
+        if not ready:
+            raise ValueError(f"Cycle between stages: {sorted(set(dependencies) - resolved)}")
+        resolved.update(ready)
+    return dependencies
+
+
+def _notify_stage_observers(name, start, end, error):
+    """ Calls the stage observers, an observer error is printed without replacing the result of the stage. """
+    for observer in list(_stage_observers):
+        try:
+            observer(name, start, end, error)
+        except Exception as e:
+            print(f"Stage observer {observer!r} failed on stage {name}: {e}")
+
+
+def _run_stage(stage, artifacts_dir=None, resume=True):
+    """ Runs a stage holding the locks of the resources it uses, skipping it if its fingerprint is unchanged. """
+    stage_fingerprint = None
+    if artifacts_dir is not None:
+        stage_fingerprint = get_stage_fingerprint(stage, artifacts_dir)
+        if resume and is_stage_done(stage, artifacts_dir, stage_fingerprint):
+            print(f"Stage {stage.name} up to date, skipped.")
+            return None
+    locks = [get_resource_lock(name) for name in sorted(stage.locks)]
+    for lock in locks:
+        lock.acquire()
+    start, error = time.perf_counter(), None
+    try:
+        with telemetry_context(stage=stage.name), span(stage.name, category='stage', profile=stage.profile):
+            result = stage.func()
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+        _notify_stage_observers(stage.name, start, time.perf_counter(), error)
+    if artifacts_dir is not None:
+        save_stage_fingerprint(stage, artifacts_dir, stage_fingerprint)
+    return result
+
+
+def run_stages(stages, max_workers=4, artifacts_dir=None, resume=True):
+    """
+    Runs stages concurrently, starting each one as soon as the stages it depends on are completed.
+
+    If a stage fails no new stage is started, the running ones are awaited and the first error is raised.
+    When `artifacts_dir` is given, the fingerprint of each completed stage is saved there and a stage whose
+    fingerprint did not change is skipped, so an interrupted run resumes from the failed stage.
+
+    Args:
+        stages (list): List of Stage objects.
+        max_workers (int, optional): Maximum number of stages running at the same time. Default is 4.
+        artifacts_dir (str, optional): Directory of the artifacts, enables fingerprints. Default is None.
+        resume (bool, optional): If False, stages are always run (fingerprints are still saved). Default is True.
+
+    Returns:
+        dict: Maps each stage name to the value returned by its function (None for skipped stages).
+
+    Raises:
+        Exception: The first exception raised by a stage.
+    """
+    dependencies = get_dependencies(stages)
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    results = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not errors:
+                ready = [name for name in pending if dependencies[name] <= results.keys()]
+                for name in ready:
+                    # run the stage in a copy of the caller context, so telemetry labels follow it
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, _run_stage, pending.pop(name), artifacts_dir, resume)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Stage {name} failed: {e}")
+                    errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,163 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Count prompt tokens with cached encoders and fit prompts to the context budget of each model.
+"""
+import re
+import warnings
+from functools import lru_cache
+import numpy as np
+import tiktoken
+
+default_encoding = 'cl100k_base'
+model_context_tokens = {
+    'gpt-4o-mini': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'deepseek-chat': 64000,
+    'deepseek-r1': 64000,
+    'efund': 128000,
+    'g4f': 8192,
+}
+default_context_tokens = 32000  # context of the models not listed above
+reserved_output_tokens = 4096  # tokens of the context left for the response
+max_news_tokens = 6000  # maximum tokens of a news article in a prompt
+
+
+class ApproximateEncoding:
+    """
+    Fallback used when a tiktoken encoding cannot be loaded (e.g. offline machines without the encoding files).
+
+    A Chinese character counts as one token and other text as one token every 4 characters, which slightly
+    overestimates the tokens of cl100k_base.
+    """
+
+    name = 'approximate'
+    _pattern = re.compile(r'[\u4e00-\u9fff]|[^\u4e00-\u9fff]{1,4}', re.S)
+
+    def encode(self, text):
+        return self._pattern.findall(text)
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=default_encoding):
+    """
+    Returns a tokenizer, loaded once per process.
+
+    Args:
+        encoding_name (str, optional): The tiktoken encoding. Default is 'cl100k_base'.
+
+    Returns:
+        object: The tiktoken encoding, or an `ApproximateEncoding` if it cannot be loaded.
+    """
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        warnings.warn(f"Failed to load tiktoken encoding {encoding_name}, token counts are approximated: {e}",
+                      UserWarning)
+        return ApproximateEncoding()
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text, encoding_name=default_encoding):
+    """
+    Counts the tokens of a text. Counts are cached, so each prompt fragment is tokenized once.
+
+    Args:
+        text (str): The text.
+        encoding_name (str, optional): The tiktoken encoding. Default is 'cl100k_base'.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, encoding_name=default_encoding):
+    """
+    Keeps the first tokens of a text.
+
+    Args:
+        text (str): The text.
+        max_tokens (int): Maximum number of tokens kept.
+        encoding_name (str, optional): The tiktoken encoding. Default is 'cl100k_base'.
+
+    Returns:
+        str: The text, truncated if longer than `max_tokens` tokens.
+    """
+    if count_tokens(text, encoding_name) <= max_tokens:
+        return text
+    encoding = get_encoding(encoding_name)
+    return encoding.decode(encoding.encode(text)[:max(max_tokens, 0)])
+
+
+def get_prompt_budget(model):
+    """
+    Returns the number of tokens a prompt can use with a model.
+
+    Args:
+        model (str): The model (e.g. 'gpt-4o-mini', 'efund').
+
+    Returns:
+        int: The context of the model minus the tokens reserved for the response.
+    """
+    return model_context_tokens.get(model, default_context_tokens) - reserved_output_tokens
+
+
+def fit_prompt(build, budget, **sections):
+    """
+    Builds a prompt, truncating its sections so that it fits in a token budget.
+
+    The tokens left by the fixed part of the prompt are shared between the sections: sections shorter than
+    their share are kept whole and the longest ones are truncated to what remains.
+
+    Args:
+        build (callable): Function building the prompt from the sections, passed as keyword arguments.
+        budget (int): Maximum number of tokens of the prompt.
+        **sections (str): The texts that can be truncated.
+
+    Returns:
+        str: The prompt.
+    """
+    sizes = {name: count_tokens(text) for name, text in sections.items()}
+    available = budget - count_tokens(build(**{name: '' for name in sections}))
+    if sum(sizes.values()) <= available:
+        return build(**sections)
+    limits = {}
+    remaining = max(available, 0)
+    for i, name in enumerate(sorted(sizes, key=sizes.get)):
+        limits[name] = min(sizes[name], remaining // (len(sizes) - i))
+        remaining -= limits[name]
+    print(f"Prompt over budget ({budget} tokens), truncated sections: "
+          f"{[name for name in sizes if limits[name] < sizes[name]]}")
+    return build(**{name: truncate_to_tokens(text, limits[name]) for name, text in sections.items()})
+
+
+def compact_value(value, decimals=4):
+    """
+    Converts a value to a short plain Python value for a prompt.
+
+    NumPy scalars are converted to Python numbers, whose repr is shorter (e.g. "0.1" instead of
+    "np.float64(0.1)"), and floats are rounded.
+
+    Args:
+        value: The value, or a list/tuple of values.
+        decimals (int, optional): Number of decimals kept. Default is 4.
+
+    Returns:
+        The compact value.
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value)(compact_value(item, decimals) for item in value)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, decimals)
+    return value
@@ -0,0 +1,278 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Rate limits, retry backoff and circuit breakers shared by all the model calls of a provider.
+"""
+import asyncio
+import email.utils
+import random
+import time
+
+# requests and tokens per minute allowed for each provider, adjust to the tier of the account (None: no limit)
+provider_rate_limits = {
+    'openai': {'requests_per_minute': 500, 'tokens_per_minute': 200000},
+    'siliconflow': {'requests_per_minute': 1000, 'tokens_per_minute': 500000},
+    'efund': {'requests_per_minute': 120, 'tokens_per_minute': 400000},
+    'g4f': {'requests_per_minute': 20, 'tokens_per_minute': None},
+}
+backoff_base = 1  # seconds waited before the first retry, doubled at each retry
+backoff_max = 60  # maximum seconds waited between two retries
+max_retry_after = 300  # maximum seconds waited when the provider sends a Retry-After header
+breaker_failure_threshold = 10  # consecutive failures opening the circuit of a provider
+breaker_reset_timeout = 60  # seconds before a call is tried again on an open circuit
+
+_rate_limiters = {}
+_circuit_breakers = {}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a provider keeps failing and its calls are rejected without being sent.
+
+    Args:
+        message (str): The error message.
+        retry_after (float, optional): Seconds before the circuit lets a call through again. Default is 0.
+    """
+
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously, allowing bursts up to one minute of capacity.
+
+    Args:
+        per_minute (float): Number of tokens added each minute.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """
+        Waits until `amount` tokens are available and takes them.
+
+        Args:
+            amount (float, optional): Number of tokens, capped to the capacity of the bucket. Default is 1.
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Limits the requests and tokens sent to a provider each minute.
+
+    Args:
+        requests_per_minute (float, optional): Maximum requests per minute, None for no limit.
+        tokens_per_minute (float, optional): Maximum prompt tokens per minute, None for no limit.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def acquire(self, tokens=0):
+        """
+        Waits until a request of `tokens` prompt tokens can be sent.
+
+        Args:
+            tokens (int, optional): Prompt tokens of the request. Default is 0.
+        """
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            await self.tokens.acquire(tokens)
+
+
+class CircuitBreaker:
+    """
+    Stops sending calls to a provider after consecutive failures. Rate limited calls are not failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are rejected. Once
+    `reset_timeout` seconds have passed, one call is let through: the circuit closes if it succeeds and opens
+    again if it fails.
+
+    Args:
+        failure_threshold (int): Consecutive failures opening the circuit.
+        reset_timeout (float): Seconds before a call is tried again.
+    """
+
+    def __init__(self, failure_threshold=breaker_failure_threshold, reset_timeout=breaker_reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def check(self, name=''):
+        """
+        Checks that a call can be sent.
+
+        Args:
+            name (str, optional): The provider name, used in the error message.
+
+        Returns:
+            bool: True if the call is the trial call of a half-open circuit.
+
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        if self.opened_at is None:
+            return False
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        if self.trial or remaining > 0:
+            raise CircuitOpenError(f"Circuit of provider {name} open after {self.failures} consecutive failures",
+                                   retry_after=max(remaining, 0))
+        self.trial = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+    def release_trial(self):
+        """ Lets another call be tried when the trial call ended without a result (e.g. it was cancelled). """
+        self.trial = False
+
+
+def get_rate_limiter(provider):
+    """
+    Returns the rate limiter of a provider (must be used inside the model loop).
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        RateLimiter: The limiter shared by all the calls to the provider.
+    """
+    if provider not in _rate_limiters:
+        _rate_limiters[provider] = RateLimiter(**provider_rate_limits.get(provider, {}))
+    return _rate_limiters[provider]
+
+
+def get_circuit_breaker(provider):
+    """
+    Returns the circuit breaker of a provider.
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        CircuitBreaker: The breaker shared by all the calls to the provider.
+    """
+    if provider not in _circuit_breakers:
+        _circuit_breakers[provider] = CircuitBreaker()
+    return _circuit_breakers[provider]
+
+
+def get_status_code(error):
+    """ Returns the HTTP status code of a provider error, or None. """
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def get_retry_after(error):
+    """
+    Reads the delay requested by the provider in the Retry-After headers of an error.
+
+    Args:
+        error (Exception): The error raised by the model call.
+
+    Returns:
+        float: The delay in seconds, or None if the provider did not send one.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(error):
+    """
+    Checks whether a call was rejected by the rate limit of the provider rather than failed.
+
+    Args:
+        error (Exception): The error raised by the model call.
+
+    Returns:
+        bool: True for 429 responses and responses with a Retry-After header.
+    """
+    return get_status_code(error) == 429 or get_retry_after(error) is not None
+
+
+def is_retryable(error):
+    """
+    Checks whether a failed call may succeed if sent again.
+
+    Args:
+        error (Exception): The error raised by the model call.
+
+    Returns:
+        bool: False for client errors (e.g. invalid request or authentication) and unsupported models.
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    status = get_status_code(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    return not isinstance(error, (ValueError, TypeError))
+
+
+def get_backoff_delay(attempt, error=None):
+    """
+    Computes the wait before retrying a call: the time left before an open circuit lets calls through, the
+    Retry-After delay of the provider if any, otherwise an exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of failed attempts so far (starting at 1).
+        error (Exception, optional): The error of the last attempt.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    if isinstance(error, CircuitOpenError):
+        return error.retry_after + random.uniform(0, backoff_base)
+    retry_after = get_retry_after(error) if error is not None else None
+    if retry_after is not None:
+        return min(retry_after, max_retry_after) + random.uniform(0, backoff_base)
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
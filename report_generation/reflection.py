@@ -8,12 +8,12 @@ E-mail: davide97ls@gmail.com
 Goal: Implements feedbacks agent
 """
 import pandas as pd
-from models import get_model
+from models import get_model, model_invoke_stream
 from main_utils import *
 from research_report_generation import get_history_info
 
 
-def reflection_predict_result(chatbot, text, date, y):
+def reflection_predict_result(chatbot, text, date, y, output_path=None):
     """
     Analyzes the LPR (Loan Prime Rate) prediction result based on historical trends and predefined rules.
 
@@ -22,6 +22,7 @@ def reflection_predict_result(chatbot, text, date, y):
         text (str): The predicted LPR result that needs to be reviewed.
         date (str): The current prediction date.
         y (list): A list of the last 12 months' LPR values, with the most recent value at the end.
+        output_path (str, optional): File the analysis is written to while it is generated.
 
     Returns:
         str: The chatbot's analysis of whether the LPR prediction aligns with the predefined rules,
@@ -56,7 +57,7 @@ def reflection_predict_result(chatbot, text, date, y):
         ....
 
 '''
-    res = model_invoke(role_prompt, text, chatbot=chatbot)
+    res = ''.join(model_invoke_stream(role_prompt, text, chatbot=chatbot, output_path=output_path))
     return res
 
 
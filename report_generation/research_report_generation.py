@@ -10,7 +10,7 @@ Goal: Prompts for report generation
 from main_utils import num_tokens_from_string, find_last_unchanged_date
 import os
 import json
-from models import model_invoke
+from models import model_invoke, model_invoke_stream
 
 
 def report_part_y_data(model, text):
@@ -242,7 +242,7 @@ def report_part_news(model, text):
     return res
 
 
-def report_part_summary(model, text, date, arg, y):
+def report_part_summary(model, text, date, arg, y, output_path=None):
     """
     Generates a summary report based on the analysis of various parts.
 
@@ -255,6 +255,7 @@ def report_part_summary(model, text, date, arg, y):
         date (str): The date for which the summary is being generated.
         arg (tuple): A tuple containing historical average decline and decline from year start.
         y (list): A list of the most recent 12 LPR data points.
+        output_path (str, optional): File the report is written to while it is generated.
 
     Returns:
         str: The generated summary report.
@@ -327,7 +328,7 @@ def report_part_summary(model, text, date, arg, y):
                 1、根据历史预测结果中的房地产展望分析可以看出，会出现降息现象，上期没有兑现，这一期降息概率将会增大
                 2、...
 '''
-    res = model_invoke(role_prompt, text, chatbot=model)
+    res = ''.join(model_invoke_stream(role_prompt, text, chatbot=model, output_path=output_path))
     return res
 
 
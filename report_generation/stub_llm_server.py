@@ -0,0 +1,294 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Local OpenAI-compatible server standing in for every model provider, used to run and benchmark the
+      report pipeline offline. It replays recorded responses, or returns synthetic answers in the format each
+      prompt asks for, after a configurable latency.
+"""
+import argparse
+import ast
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_recording import prompt_key, load_recordings
+
+stub_host = '127.0.0.1'
+stub_port = 8765
+recordings_path = 'stub_recordings.jsonl'  # responses replayed by the server, see llm_recording.py
+# latency of a response before its first token: 'constant' (median), 'uniform' (0 to 2 * median) or
+# 'lognormal' (median and sigma of the log)
+latency_distribution = 'lognormal'
+latency_median = 1.0
+latency_sigma = 0.5
+model_latency_median = {'Pro/deepseek-ai/DeepSeek-R1': 5.0}  # median latency of specific models
+stream_chunk_chars = 8  # characters of each streamed chunk
+stream_chunk_delay = 0.01  # seconds between two streamed chunks at the default latency, scaled with the median
+
+
+def _news_impact(rng):
+    return {'prob_decrease': round(rng.uniform(40, 60), 1), 'impact_on_LPR': '该新闻对下个月LPR的影响有限，降息概率变化不大。'}
+
+
+def _news_analysis(rng, prompt):
+    return json.dumps({**_news_impact(rng), 'summary': '新闻总结：宏观经济运行总体平稳，货币政策保持稳健。'},
+                      ensure_ascii=False)
+
+
+def _terms_sentiment(rng, prompt):
+    match = re.search(r'关键术语：(\[.*?\])', prompt)
+    terms = ast.literal_eval(match.group(1)) if match else []
+    scores = {term: rng.randint(1, 10) for term in terms}
+    return json.dumps({**scores, 'reasons': {term: '根据报告语气给出的评分。' for term in terms}}, ensure_ascii=False)
+
+
+def _factor_history(rng, prompt):
+    lines = []
+    for factor in ('中国GDP', 'CPI', '上证指数'):
+        history = ', '.join(f'{rng.uniform(40, 60):.4f}' for _ in range(12))
+        lines.append(f'主要因素是：{factor}、历史数据是：[{history}]，可能导致LPR下降的概率是：{rng.randint(40, 60)}%')
+    return '\n'.join(lines)
+
+
+def _factor_prob(rng, prompt):
+    return '\n'.join(f'主要因素是：{factor}、可能导致LPR下降的概率是：{rng.randint(40, 60)}%'
+                     for factor in ('中国GDP', 'CPI', '上证指数', '人民币对美元汇率'))
+
+
+def _lpr_history(rng, prompt):
+    return f"LPR历史数据是：[{', '.join(f'{rng.uniform(3, 4):.2f}' for _ in range(12))}]"
+
+
+def _format_sections(output_format):
+    """ Returns the markdown headings of an output format, each with the table rows written under it. """
+    sections = [['', []]]
+    for line in output_format.splitlines():
+        line = line.strip()
+        if re.match(r'#{1,2} ', line):
+            sections.append([line, []])
+        elif line.startswith('|') and line.strip('|. '):
+            sections[-1][1].append(line)
+    return [section for section in sections if section[0] or section[1]]
+
+
+def _report(rng, prompt):
+    prob = rng.randint(40, 60)
+    # answer with the markdown headings and tables of the output format asked by the prompt, the Word export
+    # splits the answers on them
+    output_format = re.split(r'输出(?:结果)?格式', prompt)
+    sections = _format_sections(output_format[-1]) if len(output_format) > 1 else []
+    if sections:
+        answer = []
+        for heading, rows in sections:
+            if heading:
+                answer.append(f'{heading}\n预测下一个月LPR下降的概率是{prob}%，降息幅度是10bp。')
+            if rows:
+                separator = '|' + '---|' * (rows[0].strip('|').count('|') + 1)
+                answer.append('\n'.join([rows[0], separator] + rows[1:]))
+        return '\n\n'.join(answer)
+    return (f'# 结果\n预测下一个月LPR下降的概率是{prob}%，降息幅度是10bp。\n\n'
+            f'# 理由\n## 一、历史LPR趋势中透露出的信号\n1、LPR已连续数月保持不变，有可能会降息。\n\n'
+            f'## 二、相关数据中透露出的信号\n1、通过对中国GDP的分析，经济增速放缓，有可能会降息。\n')
+
+
+# synthetic answer of the first rule whose markers all appear in the prompt (system prompt and instruction)
+synthetic_rules = [
+    (('prob_decrease', '"summary"'), _news_analysis),
+    (('prob_decrease',), lambda rng, prompt: json.dumps(_news_impact(rng), ensure_ascii=False)),
+    (('关键术语', '"reasons"'), _terms_sentiment),
+    (('历史数据是：[',), _factor_history),
+    (('主要因素是：', '可能导致LPR下降的概率是'), _factor_prob),
+    (('LPR历史数据是：[',), _lpr_history),
+    ((), _report),
+]
+
+
+def synthetic_response(system_prompt, instruction):
+    """
+    Generates a deterministic answer in the format asked by a prompt.
+
+    Args:
+        system_prompt (str): The system prompt.
+        instruction (str): The user instruction.
+
+    Returns:
+        str: The answer.
+    """
+    prompt = f'{system_prompt}\n{instruction}'
+    rng = random.Random(prompt_key(system_prompt, instruction))
+    for markers, generate in synthetic_rules:
+        if all(marker in prompt for marker in markers):
+            return generate(rng, prompt)
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering the OpenAI chat completions API.
+
+    Args:
+        address (tuple): (host, port) to listen on.
+        recordings (dict, optional): Recorded responses, as returned by `load_recordings`.
+        distribution (str, optional): The latency distribution. Default is `latency_distribution`.
+        median (float, optional): The median latency in seconds. Default is `latency_median`.
+        sigma (float, optional): The sigma of the lognormal latency. Default is `latency_sigma`.
+        seed (int, optional): Seed of the latencies, for reproducible runs.
+        chunk_delay (float, optional): Seconds between two streamed chunks. Default is `stream_chunk_delay` scaled by
+            `median / latency_median`, so that a faster server also streams faster.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, recordings=None, distribution=latency_distribution, median=latency_median,
+                 sigma=latency_sigma, seed=None, chunk_delay=None):
+        super().__init__(address, StubLLMHandler)
+        self.recordings = recordings or {}
+        self.distribution = distribution
+        self.median = median
+        self.sigma = sigma
+        self.chunk_delay = chunk_delay if chunk_delay is not None else stream_chunk_delay * median / latency_median
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.replayed = 0
+        self.synthetic = 0
+
+    def sample_latency(self, model):
+        """ Draws the latency of a response of `model` from the configured distribution. """
+        median = model_latency_median.get(model, self.median)
+        with self.rng_lock:
+            if self.distribution == 'constant':
+                return median
+            if self.distribution == 'uniform':
+                return self.rng.uniform(0, 2 * median)
+            return median * math.exp(self.rng.gauss(0, self.sigma))
+
+    def respond(self, system_prompt, instruction):
+        """ Returns the recorded response of a prompt, or a synthetic one. """
+        response = self.recordings.get(prompt_key(system_prompt, instruction))
+        if response is not None:
+            self.replayed += 1
+            return response
+        self.synthetic += 1
+        return synthetic_response(system_prompt, instruction)
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """ Handles the requests of `StubLLMServer`, every path ending with /chat/completions is accepted. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'stub', 'object': 'model', 'owned_by': 'stub'}]})
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        messages = request.get('messages', [])
+        system_prompt = '\n'.join(m.get('content') or '' for m in messages if m.get('role') == 'system')
+        instruction = '\n'.join(m.get('content') or '' for m in messages if m.get('role') == 'user')
+        model = request.get('model', 'stub')
+        content = self.server.respond(system_prompt, instruction)
+        time.sleep(self.server.sample_latency(model))
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        usage = {'prompt_tokens': len(system_prompt + instruction) // 4, 'completion_tokens': len(content) // 4}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if request.get('stream'):
+            self._stream(completion_id, model, content)
+            return
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def _stream(self, completion_id, model, content):
+        """ Sends the answer as server-sent events, in chunks of `stream_chunk_chars` characters. """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        pieces = [content[i:i + stream_chunk_chars] for i in range(0, len(content), stream_chunk_chars)]
+        for i, piece in enumerate(pieces + [None]):
+            delta = {'role': 'assistant', 'content': piece} if i == 0 else ({'content': piece} if piece else {})
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': None if piece else 'stop'}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+            if piece:
+                time.sleep(self.server.chunk_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+
+def start_server(host=stub_host, port=stub_port, recordings=None, **kwargs):
+    """
+    Starts the stub server in a daemon thread, e.g. inside a benchmark.
+
+    Args:
+        host (str, optional): The host to listen on. Default is `stub_host`.
+        port (int, optional): The port to listen on, 0 for a free port. Default is `stub_port`.
+        recordings (str, optional): The JSONL recordings file to replay.
+        **kwargs: The latency parameters of `StubLLMServer`.
+
+    Returns:
+        StubLLMServer: The running server, stopped with `shutdown()`.
+    """
+    server = StubLLMServer((host, port), load_recordings(recordings), **kwargs)
+    threading.Thread(target=server.serve_forever, name='stub-llm-server', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline OpenAI-compatible server standing in for the models.')
+    parser.add_argument('--host', default=stub_host)
+    parser.add_argument('--port', type=int, default=stub_port)
+    parser.add_argument('--recordings', default=recordings_path, help='JSONL file of the responses to replay')
+    parser.add_argument('--distribution', default=latency_distribution, choices=['constant', 'uniform', 'lognormal'])
+    parser.add_argument('--median', type=float, default=latency_median, help='median latency in seconds')
+    parser.add_argument('--sigma', type=float, default=latency_sigma, help='sigma of the lognormal latency')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the latencies')
+    parser.add_argument('--chunk_delay', type=float, default=None,
+                        help='seconds between two streamed chunks, default scaled with the median latency')
+    args = parser.parse_args()
+
+    server = StubLLMServer((args.host, args.port), load_recordings(args.recordings), distribution=args.distribution,
+                           median=args.median, sigma=args.sigma, seed=args.seed, chunk_delay=args.chunk_delay)
+    print(f'Stub LLM server listening on http://{args.host}:{args.port} with {len(server.recordings)} recorded '
+          f'responses, run the pipeline with LLM_STUB_URL=http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'Replayed {server.replayed} responses, generated {server.synthetic} synthetic responses.')
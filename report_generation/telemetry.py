@@ -0,0 +1,147 @@
+"""
+Created on Sat Mar 1 14:30:59 2024
+
+Author: davideliu
+
+E-mail: davide97ls@gmail.com
+
+Goal: Record one structured line per model call (stage, date, model, tokens, latency, retries, cache hits)
+       and summarize them at the end of a run.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+telemetry_enabled = True  # if False model calls are not recorded
+telemetry_path = 'llm_calls.jsonl'
+
+_context = contextvars.ContextVar('telemetry_context', default={})
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def telemetry_context(**fields):
+    """
+    Labels the model calls made inside the block (e.g. with the stage name or the report date).
+
+    Labels are kept in a context variable: they follow async tasks, and threads started through `pipeline`.
+
+    Args:
+        **fields: The labels, added to the ones of the enclosing blocks.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def get_context():
+    """
+    Returns the labels of the current block.
+
+    Returns:
+        dict: The labels set by the enclosing `telemetry_context` blocks.
+    """
+    return dict(_context.get())
+
+
+def record_call(context, provider, model, prompt_tokens, completion_tokens, latency, queue_time, retries,
+                cache_hit, error=None):
+    """
+    Appends the record of a model call to `telemetry_path`.
+
+    Args:
+        context (dict): Labels of the call, as returned by `get_context`.
+        provider (str): The provider of the model.
+        model (str): The model name.
+        prompt_tokens (int): Tokens of the system prompt and instruction.
+        completion_tokens (int): Tokens of the response.
+        latency (float): Seconds spent calling the model, retries included.
+        queue_time (float): Seconds spent waiting for a slot of the provider.
+        retries (int): Number of failed attempts.
+        cache_hit (bool): True if the response came from the response cache.
+        error (str, optional): The last error, if the call failed.
+    """
+    if not telemetry_enabled:
+        return
+    record = {
+        'time': time.time(),
+        'stage': context.get('stage'),
+        'date': context.get('date'),
+        'provider': provider,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'latency': round(latency, 3),
+        'queue_time': round(queue_time, 3),
+        'retries': retries,
+        'cache_hit': cache_hit,
+        'error': error,
+    }
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    with _write_lock:
+        if os.path.dirname(telemetry_path):
+            os.makedirs(os.path.dirname(telemetry_path), exist_ok=True)
+        with open(telemetry_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def load_records(path=None, since=None):
+    """
+    Loads the records of the model calls.
+
+    Args:
+        path (str, optional): The JSONL file. Default is `telemetry_path`.
+        since (float, optional): Only keep the calls made after this timestamp.
+
+    Returns:
+        pd.DataFrame: One row per call.
+    """
+    path = path or telemetry_path
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    records = pd.read_json(path, lines=True, convert_dates=False)
+    if since is not None and not records.empty:
+        records = records[records['time'] >= since]
+    return records
+
+
+def report_stats(path=None, since=None):
+    """
+    Prints the time and tokens spent by stage and model.
+
+    Args:
+        path (str, optional): The JSONL file. Default is `telemetry_path`.
+        since (float, optional): Only count the calls made after this timestamp (e.g. the start of the run).
+
+    Returns:
+        pd.DataFrame: The summary, sorted by total latency.
+    """
+    records = load_records(path, since)
+    if records.empty:
+        print('No model calls recorded.')
+        return records
+    records = records.fillna({'stage': '-', 'date': '-', 'model': '-'})
+    records['failed'] = records['error'].notna()
+    stats = records.groupby(['stage', 'model']).agg(
+        calls=('latency', 'size'),
+        cache_hits=('cache_hit', 'sum'),
+        retries=('retries', 'sum'),
+        failed=('failed', 'sum'),
+        prompt_tokens=('prompt_tokens', 'sum'),
+        completion_tokens=('completion_tokens', 'sum'),
+        latency=('latency', 'sum'),
+        max_latency=('latency', 'max'),
+        queue_time=('queue_time', 'sum'),
+    ).sort_values('latency', ascending=False)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(f"Model calls: {len(records)}, cache hits: {int(records['cache_hit'].sum())}, "
+              f"tokens: {int(records['prompt_tokens'].sum())} in / {int(records['completion_tokens'].sum())} out, "
+              f"latency: {records['latency'].sum():.1f}s")
+        print(stats)
+    return stats
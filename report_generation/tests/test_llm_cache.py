@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_cache
+import models
+
+
+def cache_key(model='gpt-4o-mini', chatbot=None, temperature=0):
+    return models._cache_key('system', 'question', model, chatbot, temperature, None)
+
+
+def test_key_depends_on_max_tokens():
+    short = models.get_model('gpt-4o-mini', max_tokens=100)
+    long = models.get_model('gpt-4o-mini', max_tokens=200)
+    assert cache_key(chatbot=short) != cache_key(chatbot=long)
+    assert cache_key(chatbot=short) == cache_key(chatbot=models.get_model('gpt-4o-mini', max_tokens=100))
+
+
+def test_key_depends_on_endpoint(monkeypatch):
+    production = cache_key()
+    monkeypatch.setattr(models, 'openai_base_url', 'http://127.0.0.1:8765/openai/v1')
+    assert cache_key() != production
+    assert cache_key(model='gpt-4') != cache_key()
+
+
+def test_key_not_computed_above_max_cached_temperature(monkeypatch):
+    monkeypatch.setattr(llm_cache, 'max_cached_temperature', 0)
+    assert cache_key(temperature=0.7) is None
+    monkeypatch.setattr(llm_cache, 'cache_enabled', False)
+    assert cache_key() is None
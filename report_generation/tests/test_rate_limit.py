@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+import time
+import types
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_cache
+import models
+import rate_limit
+import telemetry
+
+
+class ProviderError(Exception):
+    """ Error of a provider answer, with its HTTP status and headers. """
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f'status {status_code}')
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+class FlakyChatbot:
+    """ Chatbot raising some errors before answering. """
+    openai_api_base = 'http://localhost'
+    model_name = 'flaky'
+    temperature = 0
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def ainvoke(self, prompt, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return types.SimpleNamespace(content='answer')
+
+
+class HangingChatbot:
+    """ Chatbot whose calls never return, until they are cancelled. """
+    openai_api_base = 'http://localhost'
+    model_name = 'hanging'
+    temperature = 0
+
+    async def ainvoke(self, prompt, **kwargs):
+        await asyncio.sleep(3600)
+
+
+def test_check_returns_trial():
+    breaker = rate_limit.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    assert breaker.check() is False
+    breaker.record_failure()
+    assert breaker.check() is True
+    with pytest.raises(rate_limit.CircuitOpenError):
+        breaker.check()
+    breaker.release_trial()
+    assert breaker.check() is True
+
+
+def test_cancelled_trial_releases_circuit(monkeypatch):
+    breaker = rate_limit.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    monkeypatch.setitem(rate_limit._circuit_breakers, 'openai', breaker)
+    monkeypatch.setattr(llm_cache, 'cache_enabled', False)
+
+    async def call():
+        await asyncio.wait_for(models.amodel_invoke('', 'question', chatbot=HangingChatbot()), timeout=0.2)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(call())
+    deadline = time.monotonic() + 5
+    while breaker.trial and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not breaker.trial
+    assert breaker.check('openai') is True
+
+
+@pytest.fixture(autouse=True)
+def telemetry_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(telemetry, 'telemetry_path', str(tmp_path / 'llm_calls.jsonl'))
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = rate_limit.CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+    monkeypatch.setitem(rate_limit._circuit_breakers, 'openai', breaker)
+    monkeypatch.setattr(llm_cache, 'cache_enabled', False)
+    monkeypatch.setattr(rate_limit, 'backoff_base', 0.01)
+    return breaker
+
+
+def test_backoff_follows_retry_after(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'backoff_base', 0.5)
+    delay = rate_limit.get_backoff_delay(1, ProviderError(429, {'retry-after': '2'}))
+    assert 2 <= delay <= 2.5
+    delay = rate_limit.get_backoff_delay(1, ProviderError(503, {'retry-after-ms': '1500'}))
+    assert 1.5 <= delay <= 2
+    assert rate_limit.get_backoff_delay(1, ProviderError(503, {'retry-after': str(10 ** 6)})) <= \
+        rate_limit.max_retry_after + 0.5
+    assert 3 <= rate_limit.get_backoff_delay(1, rate_limit.CircuitOpenError('open', retry_after=3)) <= 3.5
+
+
+def test_rate_limited_calls_do_not_open_circuit(breaker):
+    chatbot = FlakyChatbot([ProviderError(429), ProviderError(429, {'retry-after-ms': '10'})])
+    assert models.model_invoke('', 'question', chatbot=chatbot) == 'answer'
+    assert chatbot.calls == 3
+    assert breaker.opened_at is None and breaker.failures == 0
+
+
+def test_open_circuit_waits_for_trial(breaker):
+    breaker.record_failure()
+    started = time.monotonic()
+    chatbot = FlakyChatbot()
+    assert models.model_invoke('', 'question', chatbot=chatbot) == 'answer'
+    assert time.monotonic() - started >= 0.15
+    assert chatbot.calls == 1
+    assert breaker.opened_at is None
+
+
+def test_open_circuit_fails_after_retry_budget(breaker):
+    breaker.reset_timeout = 0.05
+    chatbot = FlakyChatbot([ProviderError(500)] * 10)
+    with pytest.raises((ProviderError, rate_limit.CircuitOpenError)):
+        models.model_invoke('', 'question', chatbot=chatbot)
+    # the circuit opened after the first failure, the retries only sent the trial calls
+    assert 1 < chatbot.calls <= 6
+    assert breaker.opened_at is not None